@@ -0,0 +1,300 @@
+import argparse
+import asyncio
+import glob
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from labeling_checkpoint import CheckpointWriter, index_labelled_ids
+from labeling_engine import RateLimiter, label_prompts, make_async_client
+from near_dedup import iter_text_batches
+from prompt_selection import ReservoirSampler
+
+INFERENCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "inference")
+
+
+def uncertainty(probs):
+    # 1 for a 50/50 router, 0 for a certain one
+    return 1.0 - np.abs(probs[:, 1] - probs[:, 0])
+
+
+class PoolShortlist:
+    # Streams the scored candidate pool and keeps, with memory bounded by `size`, the `size` most
+    # uncertain candidates (with their embeddings for diversity), sorted by decreasing uncertainty, and
+    # a uniform sample of the pool (the random-sampling baseline). `remove` drops the candidates sent
+    # for labelling, so later rounds select from the rest.
+    def __init__(self, size, seed=42):
+        self.size = size
+        self.ids, self.texts = [], []
+        self.scores = np.zeros(0, dtype=np.float32)
+        self.embeddings = None
+        self.random = ReservoirSampler(size, seed=seed)
+        self.num_scored = 0
+
+    def add_batch(self, ids, texts, embeddings, probs):
+        scores = uncertainty(probs)
+        self.random.add_batch(list(zip(ids, texts)))
+        self.num_scored += len(ids)
+        all_scores = np.concatenate([self.scores, scores])
+        all_embeddings = embeddings if self.embeddings is None else np.concatenate([self.embeddings, embeddings])
+        keep = np.argsort(-all_scores, kind="stable")[: self.size]
+        all_ids, all_texts = self.ids + list(ids), self.texts + list(texts)
+        self.ids = [all_ids[i] for i in keep]
+        self.texts = [all_texts[i] for i in keep]
+        self.scores = all_scores[keep]
+        self.embeddings = all_embeddings[keep].astype(np.float16)
+
+    def remove(self, ids):
+        ids = set(ids)
+        keep = [i for i, cid in enumerate(self.ids) if cid not in ids]
+        self.ids = [self.ids[i] for i in keep]
+        self.texts = [self.texts[i] for i in keep]
+        self.scores = self.scores[keep]
+        self.embeddings = self.embeddings[keep]
+        self.random.items = [item for item in self.random.items if item[0] not in ids]
+
+
+def score_pool(paths, encoder, exclude_ids, shortlist_size, batch_size=4096, seed=42):
+    # scores every candidate of `paths` not in `exclude_ids` with the router (one batched forward pass
+    # gives both the route probabilities and the pooled embedding)
+    shortlist = PoolShortlist(shortlist_size, seed=seed)
+    for ids, texts in iter_text_batches(paths, batch_size=batch_size):
+        kept = [i for i, cid in enumerate(ids) if str(cid) not in exclude_ids and texts[i]]
+        if not kept:
+            continue
+        ids, texts = [ids[i] for i in kept], [texts[i] for i in kept]
+        embeddings, probs = encoder.encode(texts)
+        shortlist.add_batch(ids, texts, embeddings, probs)
+    return shortlist
+
+
+def k_center_greedy(embeddings, budget, scores=None, reference=None, chunk=4096):
+    # Picks `budget` rows of normalized `embeddings`, each the farthest (cosine distance) from the
+    # rows picked so far and from `reference` (e.g. the already labelled prompts); starts from the
+    # highest `scores` when there is no reference.
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    min_distance = np.full(len(embeddings), np.inf, dtype=np.float32)
+    if reference is not None and len(reference):
+        for start in range(0, len(reference), chunk):
+            block = 1.0 - embeddings @ np.asarray(reference[start:start + chunk], dtype=np.float32).T
+            min_distance = np.minimum(min_distance, block.min(axis=1))
+    picked = []
+    for _ in range(min(budget, len(embeddings))):
+        if np.isinf(min_distance).all():
+            idx = int(np.argmax(scores)) if scores is not None else 0
+        else:
+            idx = int(np.argmax(min_distance))
+        picked.append(idx)
+        min_distance = np.minimum(min_distance, 1.0 - embeddings @ embeddings[idx])
+        min_distance[idx] = -np.inf
+    return picked
+
+
+def select_candidates(shortlist, budget, strategy="hybrid", reference=None, num_candidates=None):
+    # (ids, texts) of the `budget` prompts to label:
+    # uncertainty: the most uncertain; hybrid: diverse (k-center) among the `num_candidates` (defaults
+    # to all) most uncertain; random: a uniform sample of the pool
+    if strategy == "random":
+        items = shortlist.random.items[:budget]
+        return [i for i, _ in items], [t for _, t in items]
+    if strategy == "uncertainty":
+        picked = list(range(min(budget, len(shortlist.ids))))
+    elif strategy == "hybrid":
+        n = len(shortlist.ids) if num_candidates is None else num_candidates
+        picked = k_center_greedy(shortlist.embeddings[:n], budget, scores=shortlist.scores[:n], reference=reference)
+    else:
+        raise ValueError(f"unknown strategy: {strategy}")
+    return [shortlist.ids[i] for i in picked], [shortlist.texts[i] for i in picked]
+
+
+def label_and_append(ids, texts, writer, args):
+    # labels with the same prompt as `create_synthetic_dataset.py`, appends the labelled rows and
+    # returns their positions in `texts`
+    from create_synthetic_dataset import create_prompt
+
+    pending = []
+
+    def on_result(idx, content):
+        pending.append((idx, content))
+        if len(pending) == args.checkpoint_batch_size or idx == len(texts) - 1:
+            writer.write_batch(
+                [
+                    {"conversation_id": ids[i], "initial_prompt": texts[i], "gpt_content": c}
+                    for i, c in pending
+                    if c is not None
+                ]
+            )
+            pending.clear()
+
+    async def run_labelling():
+        client = make_async_client(api_key=args.openai_api_key, base_url=args.openai_base_url)
+        try:
+            return await label_prompts(
+                [create_prompt(t) for t in texts],
+                model=args.openai_model,
+                client=client,
+                concurrency=args.concurrency,
+                limiter=RateLimiter(args.requests_per_min, args.tokens_per_min),
+                max_retries=args.max_retries,
+                on_result=on_result,
+                usage=usage,
+            )
+        finally:
+            await client.close()
+
+    usage = Counter()
+    contents = asyncio.run(run_labelling())
+    return [i for i, c in enumerate(contents) if c is not None]
+
+
+def proxy_f1(train_df, test_df):
+    # test F1 of the hashed n-gram first stage of `cascade_router.py` trained on `train_df`, a fast
+    # stand-in for retraining the BERT router after every round
+    from sklearn.metrics import f1_score
+
+    sys.path.append(INFERENCE_DIR)
+    from cascade_router import HashedNgramClassifier
+
+    classifier = HashedNgramClassifier().fit(train_df["text"].tolist(), train_df["target"].to_numpy())
+    preds = (classifier.predict_superior_proba(test_df["text"].tolist()) >= 0.5).astype(int)
+    return float(f1_score(test_df["target"], preds))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--pool",
+        type=str,
+        nargs="+",
+        default=["selected_prompts.jsonl"],
+        help="Glob patterns of candidate prompts (JSONL/parquet), e.g. a large output of `prompt_selection.py`",
+    )
+    parser.add_argument(
+        "--model_save_dir",
+        type=str,
+        default="../models/bert-base-uncased-router-finetuning-20240722T133228-save",
+        help="Router checkpoint that scores the pool (used `model.save_pretrained(...)`)",
+    )
+    parser.add_argument(
+        "--hf_model_name", type=str, default="bert-base-uncased", help="The tokenizer name in hugging face"
+    )
+    parser.add_argument(
+        "--seed_file",
+        type=str,
+        default="../final-datasets/router_dataset_all.jsonl",
+        help="Labelled dataset so far: JSONL, dataset store directory or Arrow snapshot",
+    )
+    parser.add_argument("--test_file", type=str, default="../final-datasets/original_questions_labelled.jsonl")
+    parser.add_argument("--strategy", type=str, default="hybrid", choices=["uncertainty", "hybrid", "random"])
+    parser.add_argument("--budget", type=int, default=500, help="Prompts sent for labelling per round")
+    parser.add_argument("--rounds", type=int, default=1)
+    parser.add_argument("--shortlist_factor", type=int, default=10, help="Uncertain candidates kept per labelled prompt")
+    parser.add_argument(
+        "--compare_random",
+        action="store_true",
+        help="Also label a random sample of the same size every round (doubles the labelling cost)",
+    )
+    parser.add_argument("--out_tag", type=str, default=time.strftime("%Y%m%dT%H%M%S"), help="Tag of the output files")
+    parser.add_argument("--openai_model", type=str, default="gpt-3.5-turbo", help="Open AI model used for labelling")
+    parser.add_argument("--openai_api_key", type=str, default=os.environ.get("OPENAI_API_KEY"))
+    parser.add_argument("--openai_base_url", type=str, default=None, help="Base url of an OpenAI-compatible API")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum number of labelling requests in flight")
+    parser.add_argument("--requests_per_min", type=int, default=None)
+    parser.add_argument("--tokens_per_min", type=int, default=None)
+    parser.add_argument("--max_retries", type=int, default=6)
+    parser.add_argument("--checkpoint_batch_size", type=int, default=50, help="Labelled prompts per checkpoint")
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from transformers import AutoTokenizer, BertForSequenceClassification
+
+    sys.path.append(INFERENCE_DIR)
+    from router_datasets import (
+        import_df_from_jsonl_file,
+        import_labelled_df,
+        process_questions_dataset,
+        process_synthetic_dataset,
+    )
+    from semantic_index import RouterEncoder, device
+
+    args = parse_args()
+    tokenizer = AutoTokenizer.from_pretrained(args.hf_model_name)
+    model = BertForSequenceClassification.from_pretrained(os.path.join(os.getcwd(), args.model_save_dir))
+    model.to(device).eval()
+    encoder = RouterEncoder(model, tokenizer)
+
+    arms = [args.strategy] + (["random"] if args.compare_random and args.strategy != "random" else [])
+    out_files = {
+        arm: f"router_dataset_labelled-openai_{args.openai_model}-amount_{args.budget}-active_{arm}-{args.out_tag}.jsonl"
+        for arm in arms
+    }
+    writers = {
+        arm: CheckpointWriter(path, run_info={"openai_model": args.openai_model, "strategy": arm})
+        for arm, path in out_files.items()
+    }
+    pool_paths = sorted(p for pattern in args.pool for p in glob.glob(pattern))
+    seed_df = import_labelled_df(args.seed_file)
+    test_df = process_questions_dataset(import_df_from_jsonl_file(args.test_file))
+
+    def arm_dataset(arm):
+        df = seed_df
+        if os.path.getsize(out_files[arm]):
+            df = pd.concat([seed_df, import_df_from_jsonl_file(out_files[arm])])
+        return process_synthetic_dataset(df, make_balanced=False, max_length=0)
+
+    # The router checkpoint does not change between rounds, so neither do its scores: the pool is
+    # scored once, into a shortlist deep enough for every round, and each round selects among the
+    # `--shortlist_factor * --budget` most uncertain candidates not sent for labelling yet.
+    t0 = time.perf_counter()
+    labelled_ids = index_labelled_ids(out_files.values())
+    exclude_ids = set(seed_df["conversation_id"].astype(str)) | {str(i) for i in labelled_ids}
+    num_candidates = args.shortlist_factor * args.budget
+    shortlist = score_pool(
+        pool_paths, encoder, exclude_ids, num_candidates + (args.rounds - 1) * len(arms) * args.budget, seed=args.seed
+    )
+    reference = None
+    if args.strategy == "hybrid":
+        # diversity also against what is labelled already, extended with the labels of every round
+        reference, _ = encoder.encode(arm_dataset(args.strategy)["text"].tolist())
+    seed_f1 = proxy_f1(process_synthetic_dataset(seed_df, make_balanced=False, max_length=0), test_df)
+    report = {
+        "seed_samples": len(seed_df),
+        "seed_f1": seed_f1,
+        "pool_scored": shortlist.num_scored,
+        "scoring_seconds": time.perf_counter() - t0,
+        "rounds": [],
+    }
+    for round_idx in range(args.rounds):
+        round_report = {"round": round_idx}
+        for arm in arms:
+            ids, texts = select_candidates(
+                shortlist, args.budget, strategy=arm, reference=reference, num_candidates=num_candidates
+            )
+            shortlist.remove(ids)
+            labelled = label_and_append(ids, texts, writers[arm], args)
+            num_labelled = len(labelled)
+            if arm == "hybrid" and labelled:
+                reference = np.concatenate([reference, encoder.encode([texts[i] for i in labelled])[0]])
+            train_df = arm_dataset(arm)
+            total_labels = writers[arm].manifest["num_labelled"]
+            f1 = proxy_f1(train_df, test_df)
+            round_report[arm] = {
+                "labelled": num_labelled,
+                "total_labels": total_labels,
+                "label_counts": {int(k): int(v) for k, v in train_df["target"].value_counts().items()},
+                "f1": f1,
+                "f1_gain_per_1k_labels": (f1 - seed_f1) * 1000 / max(total_labels, 1),
+            }
+        if len(arms) > 1:
+            round_report["f1_vs_random"] = round_report[args.strategy]["f1"] - round_report["random"]["f1"]
+        report["rounds"].append(round_report)
+        print(json.dumps(round_report))
+    with open(f"active_selection_report-{args.out_tag}.json", "w") as fp:
+        json.dump(report, fp, indent=2)
@@ -0,0 +1,97 @@
+import argparse
+import asyncio
+import time
+from collections import Counter
+
+from openai import OpenAI
+
+from create_synthetic_dataset import create_multi_prompt, create_prompt, get_gpt_completion, parse_multi_response
+from fake_openai_server import make_app, start_server_in_thread
+from labeling_engine import RateLimiter, label_prompts, label_prompts_packed, make_async_client
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_prompts", type=int, default=200, help="Number of prompts to label per mode")
+    parser.add_argument("--concurrency", type=int, default=32, help="Requests in flight for the concurrent engine")
+    parser.add_argument("--requests_per_min", type=int, default=None, help="Request rate limit of the concurrent engine")
+    parser.add_argument("--tokens_per_min", type=int, default=None, help="Token rate limit of the concurrent engine")
+    parser.add_argument("--pack_sizes", type=int, nargs="+", default=[1, 5, 10, 20], help="Questions per request to compare")
+    parser.add_argument("--latency_ms", type=float, default=100.0, help="Latency of the stand-in server")
+    parser.add_argument("--error_rate_429", type=float, default=0.05, help="Fraction of 429 responses")
+    parser.add_argument("--error_rate_500", type=float, default=0.02, help="Fraction of 500 responses")
+    parser.add_argument("--drop_rate", type=float, default=0.02, help="Fraction of missing answers in packed prompts")
+    parser.add_argument("--skip_sequential", action="store_true", help="Skip the one-request-at-a-time baseline")
+    return parser.parse_args()
+
+
+def make_questions(num_prompts):
+    words = "explain the difference between supervised and unsupervised learning with examples".split()
+    return [" ".join(words[: 3 + i % len(words)] * (1 + i % 4)) for i in range(num_prompts)]
+
+
+def report(mode, labels, elapsed, usage=None):
+    num_labels = len(labels) - labels.count(None)
+    line = f"{mode:>22}: {num_labels / elapsed:8.1f} labels/sec"
+    if usage:
+        tokens = usage["prompt_tokens"] + usage["completion_tokens"]
+        line += f", {tokens / max(num_labels, 1):8.1f} tokens/label, {usage['requests']} requests"
+        line += f", {usage['requeued']} re-queued"
+    print(line)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    app = make_app(args.latency_ms, args.error_rate_429, args.error_rate_500, args.drop_rate, seed=42)
+    base_url, stop = start_server_in_thread(app)
+    questions = make_questions(args.num_prompts)
+    prompts = [create_prompt(q) for q in questions]
+
+    if not args.skip_sequential:
+        # current script: one blocking request at a time (the sync client retries 429/5xx itself)
+        client = OpenAI(api_key="fake", base_url=base_url, max_retries=10)
+        t0 = time.perf_counter()
+        sequential = [get_gpt_completion(p, model="fake", client=client) for p in prompts]
+        report("sequential", sequential, time.perf_counter() - t0)
+
+    async def run_concurrent(pack_size, usage):
+        async_client = make_async_client(api_key="fake", base_url=base_url)
+        limiter = RateLimiter(args.requests_per_min, args.tokens_per_min)
+        try:
+            if pack_size == 1:
+                return await label_prompts(
+                    prompts,
+                    model="fake",
+                    client=async_client,
+                    concurrency=args.concurrency,
+                    limiter=limiter,
+                    base_delay=0.05,
+                    usage=usage,
+                )
+            return await label_prompts_packed(
+                questions,
+                create_prompt,
+                create_multi_prompt,
+                parse_multi_response,
+                model="fake",
+                client=async_client,
+                pack_size=pack_size,
+                concurrency=args.concurrency,
+                limiter=limiter,
+                base_delay=0.05,
+                usage=usage,
+            )
+        finally:
+            await async_client.close()
+
+    reference = None
+    for pack_size in args.pack_sizes:
+        usage = Counter()
+        t0 = time.perf_counter()
+        labels = asyncio.run(run_concurrent(pack_size, usage))
+        report(f"concurrent, pack {pack_size}", labels, time.perf_counter() - t0, usage)
+        reference = reference or labels
+        if labels != reference:
+            print(f"  labels differ from pack size {args.pack_sizes[0]} for {sum(a != b for a, b in zip(labels, reference))} prompts")
+    stop()
+    print(f"server stats: {app['stats']}")
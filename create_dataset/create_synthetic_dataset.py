@@ -3,9 +3,20 @@ import re
 import datetime
 from tqdm import tqdm
 
-from openai import OpenAI
 import argparse
+import asyncio
+import glob
 import os
+import time
+from collections import Counter
+
+import pandas as pd
+
+from dataset_store import read_labelled_jsonl
+from labeling_checkpoint import CheckpointWriter, index_labelled_ids
+from labeling_engine import RateLimiter, label_prompts, label_prompts_packed, make_async_client
+from near_dedup import near_duplicate_keep_mask
+from prompt_selection import select_prompts
 
 
 from dotenv import load_dotenv
@@ -62,6 +73,74 @@ def parse_args():
         default=5,
         help="Batch size of prompts to label before saving a checkpoint",
     )
+    parser.add_argument(
+        "--openai_base_url",
+        type=str,
+        default=None,
+        help="Base url of an OpenAI-compatible API (e.g. `fake_openai_server.py` for offline runs)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Maximum number of labelling requests in flight",
+    )
+    parser.add_argument(
+        "--requests_per_min",
+        type=int,
+        default=None,
+        help="Requests per minute limit of the labelling model (unlimited if not set)",
+    )
+    parser.add_argument(
+        "--tokens_per_min",
+        type=int,
+        default=None,
+        help="Tokens per minute limit of the labelling model (unlimited if not set)",
+    )
+    parser.add_argument(
+        "--max_retries",
+        type=int,
+        default=6,
+        help="Retries (with jittered backoff) of a prompt on 429 and 5xx responses",
+    )
+    parser.add_argument(
+        "--pack_size",
+        type=int,
+        default=1,
+        help="Questions per labelling request; above 1 the few-shot prefix is shared by numbered questions",
+    )
+    parser.add_argument(
+        "--selection",
+        type=str,
+        default="subset",
+        choices=["subset", "streaming"],
+        help="`subset` filters a random 1000-row subset of the corpus, `streaming` samples from the whole corpus",
+    )
+    parser.add_argument(
+        "--data_files",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Local parquet/JSONL shards of the corpus for `--selection streaming` (streams from the hub if not set)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip conversations that are already labelled in any of the `--labelled_files`",
+    )
+    parser.add_argument(
+        "--labelled_files",
+        type=str,
+        nargs="+",
+        default=["router_dataset_labelled-*.jsonl"],
+        help="Glob patterns of earlier output files, indexed by `conversation_id` when resuming",
+    )
+    parser.add_argument(
+        "--near_dup_threshold",
+        type=float,
+        default=None,
+        help="Skip prompts whose Jaccard similarity to another selected (or, with --resume, labelled) prompt reaches this",
+    )
     return parser.parse_args()
 
 
@@ -333,6 +412,40 @@ Replace ____ with your answer
     return prompt
 
 
+def create_multi_prompt(questions):
+    # same task and examples as `create_prompt`, followed by numbered slots for several questions,
+    # so that the long few-shot prefix is paid once per `len(questions)` labels
+    prefix = create_prompt("").split("YOUR TURN")[0]
+    slots = "\n\n".join(
+        f"* Question {i}: {question}\n* Label {i}: ____" for i, question in enumerate(questions, start=1)
+    )
+    return f"""{prefix}YOUR TURN
+
+{slots}
+
+Replace each ____ with your answer.
+Respond with exactly {len(questions)} lines, one per question, in the format `Label <number>: <label>`, and nothing else.
+"""
+
+
+def parse_multi_response(content, num_questions):
+    # {slot index (0-based): label} for every well-formed answer; missing, out of range,
+    # unknown or contradicting answers are left out so that those questions can be re-queued
+    labels = {}
+    conflicting = set()
+    for line in (content or "").splitlines():
+        match = re.match(r"^\W*(?:label\s*)?(\d+)\s*[:.)]\s*(ROUTE_TO_INFERIOR|ROUTE_TO_SUPERIOR)\b", line.strip(), flags=re.I)
+        if match is None:
+            continue
+        idx, label = int(match.group(1)) - 1, match.group(2).upper()
+        if not 0 <= idx < num_questions:
+            continue
+        if labels.get(idx, label) != label:
+            conflicting.add(idx)
+        labels[idx] = label
+    return {idx: label for idx, label in labels.items() if idx not in conflicting}
+
+
 def get_gpt_completion(prompt, model, client):
     completion = client.chat.completions.create(
         model=model, messages=[{"role": "user", "content": prompt}]
@@ -345,39 +458,109 @@ if __name__ == "__main__":
     HF_DATASET = "lmsys/lmsys-chat-1m"
     args = parse_args()
     OUT_FILE = f"router_dataset_labelled-openai_{args.openai_model}-amount_{args.amount}-{args.out_tag}.jsonl"
-    if not os.path.exists(OUT_FILE):
-        open(OUT_FILE, "w").close()
+    # repairs OUT_FILE (drops a batch that was half-written when a previous run crashed)
+    writer = CheckpointWriter(OUT_FILE, run_info={"openai_model": args.openai_model, "amount": args.amount})
 
-    dd = load_dataset(HF_DATASET, token=args.hf_token)
     seed, subset_lg = 42, 1000
-    data_df = (
-        dd["train"]
-        .shuffle(seed)
-        .select(range(subset_lg))
-        .filter(filter_func)
-        .shuffle(seed)
-        .select(range(args.amount))
-        .to_pandas()
-    )
-
-    client = OpenAI(api_key=args.openai_api_key)
-
-    num_batches = (len(data_df) + args.batch_size - 1) // args.batch_size
-    for i in tqdm(range(num_batches), desc="Processing batches"):
-        # set offsets
-        batch_start = i * args.batch_size
-        batch_end = min(batch_start + args.batch_size, len(data_df))
-        batch = data_df[batch_start:batch_end].copy()
-
-        # Process the batch
-        batch["initial_prompt"] = batch["conversation"].map(lambda x: x[0]["content"])
-        batch["gpt_prompt"] = batch["initial_prompt"].map(create_prompt)
-        batch["gpt_content"] = batch["gpt_prompt"].map(
-            lambda prompt: get_gpt_completion(
-                prompt, model=args.openai_model, client=client
-            )
+    if args.selection == "streaming":
+        rows, selection_stats = select_prompts(
+            args.data_files or [HF_DATASET], args.amount, hf_token=args.hf_token, seed=seed
         )
-        batch = batch[["conversation_id", "initial_prompt", "gpt_content"]]
-
-        # Append the processed batch to the JSON file
-        batch.to_json(OUT_FILE, orient="records", lines=True, mode="a")
+        print(f"selection: {selection_stats}")
+        data_df = pd.DataFrame(rows, columns=["conversation_id", "initial_prompt"])
+    else:
+        dd = load_dataset(HF_DATASET, token=args.hf_token)
+        data_df = (
+            dd["train"]
+            .shuffle(seed)
+            .select(range(subset_lg))
+            .filter(filter_func)
+            .shuffle(seed)
+            .select(range(args.amount))
+            .to_pandas()
+        )
+        data_df["initial_prompt"] = data_df["conversation"].map(lambda x: x[0]["content"])
+    if args.resume:
+        labelled_ids = index_labelled_ids(args.labelled_files)
+        already_labelled = data_df["conversation_id"].isin(labelled_ids)
+        print(f"resuming: skipping {already_labelled.sum()}/{len(data_df)} already labelled conversations")
+        data_df = data_df[~already_labelled].reset_index(drop=True)
+    if args.near_dup_threshold is not None:
+        # near-duplicates of an earlier prompt are not sent to the labeller (see `near_dedup.py`)
+        labelled_prompts = []
+        if args.resume:
+            for path in sorted(p for pattern in args.labelled_files for p in glob.glob(pattern)):
+                labelled_prompts.extend(read_labelled_jsonl(path)[0]["prompt"].to_pylist())
+        keep, _ = near_duplicate_keep_mask(labelled_prompts + data_df["initial_prompt"].tolist(), args.near_dup_threshold)
+        keep = keep[len(labelled_prompts):]
+        print(f"near-duplicates: skipping {(~keep).sum()}/{len(data_df)} prompts")
+        data_df = data_df[keep].reset_index(drop=True)
+
+    questions = data_df["initial_prompt"].tolist()
+
+    # labels arrive in input order, so every checkpoint is the next `batch_size` rows of `data_df`
+    pending = []
+    pbar = tqdm(total=len(data_df), desc="Labelling prompts")
+
+    def on_result(idx, content):
+        pending.append((idx, content))
+        pbar.update(1)
+        if len(pending) == args.batch_size or idx == len(data_df) - 1:
+            # failed prompts are not written, so that a resumed run retries them
+            rows = [
+                {
+                    "conversation_id": data_df["conversation_id"].iloc[i],
+                    "initial_prompt": data_df["initial_prompt"].iloc[i],
+                    "gpt_content": c,
+                }
+                for i, c in pending
+                if c is not None
+            ]
+            # Append the processed batch to the JSON file
+            writer.write_batch(rows)
+            pending.clear()
+
+    async def run_labelling():
+        client = make_async_client(api_key=args.openai_api_key, base_url=args.openai_base_url)
+        limiter = RateLimiter(args.requests_per_min, args.tokens_per_min)
+        try:
+            if args.pack_size > 1:
+                return await label_prompts_packed(
+                    questions,
+                    create_prompt,
+                    create_multi_prompt,
+                    parse_multi_response,
+                    model=args.openai_model,
+                    client=client,
+                    pack_size=args.pack_size,
+                    concurrency=args.concurrency,
+                    limiter=limiter,
+                    max_retries=args.max_retries,
+                    on_result=on_result,
+                    usage=usage,
+                )
+            return await label_prompts(
+                [create_prompt(q) for q in questions],
+                model=args.openai_model,
+                client=client,
+                concurrency=args.concurrency,
+                limiter=limiter,
+                max_retries=args.max_retries,
+                on_result=on_result,
+                usage=usage,
+            )
+        finally:
+            await client.close()
+
+    usage = Counter()
+    t0 = time.perf_counter()
+    contents = asyncio.run(run_labelling())
+    elapsed = time.perf_counter() - t0
+    pbar.close()
+    num_labelled = len(contents) - contents.count(None)
+    num_tokens = usage["prompt_tokens"] + usage["completion_tokens"]
+    print(f"labelled {num_labelled}/{len(contents)} prompts into {OUT_FILE}")
+    print(
+        f"{num_tokens / max(num_labelled, 1):.1f} tokens/label, {num_labelled / elapsed:.2f} labels/sec, "
+        f"{usage['requests']} requests"
+    )
@@ -0,0 +1,250 @@
+import argparse
+import datetime
+import glob
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as pads
+
+from labeling_checkpoint import write_json_atomic
+
+LABELS = ["ROUTE_TO_INFERIOR", "ROUTE_TO_SUPERIOR"]
+# one row per labelled prompt; `label` is also the partition key (`<store_dir>/label=<label>/`)
+SCHEMA = pa.schema(
+    [
+        ("conversation_id", pa.string()),
+        ("prompt", pa.string()),
+        ("label", pa.string()),
+        ("labeller_model", pa.string()),
+        ("labelled_at", pa.timestamp("s")),
+        ("prompt_chars", pa.int32()),
+        ("source_file", pa.string()),
+    ]
+)
+PARTITIONING = pads.partitioning(pa.schema([("label", pa.string())]), flavor="hive")
+SOURCES_FILENAME = "_sources.json"
+# labelling output files are named `router_dataset_labelled-openai_<model>-amount_<n>-<tag>.jsonl`
+LABELLER_MODEL_REGEX = re.compile(r"openai_(.+?)-amount_")
+
+
+def source_info(path):
+    # labeller model and labelling time of a labelling output file, from its `CheckpointWriter`
+    # manifest when there is one, else from its name and modification time
+    info = {"labeller_model": None, "labelled_at": None}
+    manifest_path = f"{path}.manifest.json"
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as fp:
+            manifest = json.load(fp)
+        info["labeller_model"] = manifest.get("run_info", {}).get("openai_model")
+        info["labelled_at"] = manifest.get("updated_at")
+    if info["labeller_model"] is None:
+        match = LABELLER_MODEL_REGEX.search(os.path.basename(path))
+        info["labeller_model"] = match.group(1) if match else "unknown"
+    if info["labelled_at"] is None:
+        info["labelled_at"] = datetime.datetime.fromtimestamp(os.path.getmtime(path)).isoformat(timespec="seconds")
+    return info
+
+
+def read_labelled_jsonl(path):
+    # labelled rows of a labelling output file as a table of `SCHEMA`; rows without a valid label
+    # and unparsable lines (e.g. half-written by a crashed run) are dropped
+    info = source_info(path)
+    conversation_ids, prompts, labels = [], [], []
+    num_dropped = 0
+    with open(path, "rb") as fp:
+        for line in fp:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                num_dropped += bool(line.strip())
+                continue
+            if row.get("gpt_content") not in LABELS:
+                num_dropped += 1
+                continue
+            conversation_ids.append(str(row.get("conversation_id")))
+            prompts.append(row.get("initial_prompt") or "")
+            labels.append(row["gpt_content"])
+    prompts = pa.array(prompts, type=pa.string())
+    n = len(prompts)
+    table = pa.table(
+        {
+            "conversation_id": pa.array(conversation_ids, type=pa.string()),
+            "prompt": prompts,
+            "label": pa.array(labels, type=pa.string()),
+            "labeller_model": pa.array([info["labeller_model"]] * n, type=pa.string()),
+            "labelled_at": pa.array([datetime.datetime.fromisoformat(info["labelled_at"])] * n, type=pa.timestamp("s")),
+            "prompt_chars": pc.cast(pc.utf8_length(prompts), pa.int32()),
+            "source_file": pa.array([os.path.basename(path)] * n, type=pa.string()),
+        },
+        schema=SCHEMA,
+    )
+    return table, num_dropped
+
+
+def compact(patterns, store_dir, max_rows_per_file=1_000_000):
+    # Compacts labelling output files (JSONL, glob patterns) into `store_dir`: one parquet file per
+    # source file and label partition. Sources already compacted and unchanged since (same size and
+    # modification time) are skipped; a source that grew is compacted again, replacing its files.
+    os.makedirs(store_dir, exist_ok=True)
+    sources_path = os.path.join(store_dir, SOURCES_FILENAME)
+    sources = {}
+    if os.path.exists(sources_path):
+        with open(sources_path) as fp:
+            sources = json.load(fp)
+    stats = {"num_sources": 0, "num_skipped_sources": 0, "num_rows": 0, "num_dropped_rows": 0}
+    paths = sorted({os.path.abspath(p) for pattern in patterns for p in glob.glob(pattern)})
+    if not paths:
+        raise FileNotFoundError(f"no labelling output matches {patterns}")
+    for path in paths:
+        st = os.stat(path)
+        fingerprint = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+        if sources.get(path, {}).get("fingerprint") == fingerprint:
+            stats["num_skipped_sources"] += 1
+            continue
+        table, num_dropped = read_labelled_jsonl(path)
+        # a stable file name per source, so re-compacting a source overwrites its files
+        basename = "part-" + hashlib.sha256(path.encode("utf-8")).hexdigest()[:16] + "-{i}.parquet"
+        for label in LABELS:
+            partition_dir = os.path.join(store_dir, f"label={label}")
+            for old_file in glob.glob(os.path.join(partition_dir, basename.format(i="*"))):
+                os.remove(old_file)
+        pads.write_dataset(
+            table,
+            store_dir,
+            format="parquet",
+            partitioning=PARTITIONING,
+            basename_template=basename,
+            existing_data_behavior="overwrite_or_ignore",
+            max_rows_per_file=max_rows_per_file,
+            max_rows_per_group=min(max_rows_per_file, 64 * 1024),
+        )
+        sources[path] = {"fingerprint": fingerprint, "num_rows": table.num_rows, "num_dropped_rows": num_dropped}
+        write_json_atomic(sources_path, sources)
+        stats["num_sources"] += 1
+        stats["num_rows"] += table.num_rows
+        stats["num_dropped_rows"] += num_dropped
+    return stats
+
+
+def open_store(store_dir):
+    return pads.dataset(store_dir, schema=SCHEMA, format="parquet", partitioning=PARTITIONING)
+
+
+def normalized_prompts(prompts):
+    # lower case with whitespace collapsed, so prompts differing only by case/spacing are duplicates
+    return pc.utf8_trim_whitespace(pc.replace_substring_regex(pc.utf8_lower(prompts), r"\s+", " "))
+
+
+def dedup(table, key="conversation_id"):
+    # keeps the latest labelled row of every `key` ("conversation_id" or "prompt", compared normalized)
+    if table.num_rows == 0:
+        return table
+    table = table.sort_by([("labelled_at", "descending")])
+    keys = table[key] if key != "prompt" else normalized_prompts(table["prompt"])
+    first = (
+        pa.table({"key": keys, "row": pa.array(np.arange(table.num_rows))})
+        .group_by("key", use_threads=False)
+        .aggregate([("row", "min")])["row_min"]
+    )
+    return table.take(np.sort(first.to_numpy()))
+
+
+def balance(table, seed=42):
+    # downsamples every label to the count of the rarest one (seeded, row order kept)
+    rng = np.random.default_rng(seed)
+    labels = table["label"].to_numpy(zero_copy_only=False)
+    counts = {label: int((labels == label).sum()) for label in LABELS}
+    count_min = min(counts.values())
+    keep = [rng.choice(np.flatnonzero(labels == label), size=count_min, replace=False) for label in LABELS]
+    return table.take(np.sort(np.concatenate(keep)))
+
+
+def load_table(
+    store_dir,
+    labels=None,
+    labeller_models=None,
+    min_chars=None,
+    max_chars=None,
+    dedup_key="conversation_id",
+    make_balanced=False,
+    columns=None,
+    seed=42,
+):
+    # Reads the store with filters pushed down to the parquet scan (partition pruning on `label`,
+    # row-group statistics on `prompt_chars`), then dedups (`dedup_key` None keeps duplicates) and
+    # optionally balances the labels. `max_chars` is exclusive like `process_synthetic_dataset`.
+    expr = None
+    for cond in [
+        pc.field("label").isin(labels) if labels else None,
+        pc.field("labeller_model").isin(labeller_models) if labeller_models else None,
+        pc.field("prompt_chars") >= min_chars if min_chars else None,
+        pc.field("prompt_chars") < max_chars if max_chars else None,
+    ]:
+        if cond is not None:
+            expr = cond if expr is None else expr & cond
+    table = open_store(store_dir).to_table(filter=expr)
+    if dedup_key is not None:
+        table = dedup(table, dedup_key)
+    if make_balanced:
+        table = balance(table, seed=seed)
+    return table.select(columns) if columns else table
+
+
+def write_snapshot(table, path):
+    # Arrow IPC file: readers memory-map it (`read_snapshot`) instead of parsing it
+    tmp_path = f"{path}.tmp"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path):
+    # zero-copy: the columns point into the memory-mapped file, pages are read on first access
+    with pa.memory_map(path, "r") as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sources",
+        type=str,
+        nargs="*",
+        default=["router_dataset_labelled-openai_*.jsonl"],
+        help="Glob patterns of labelling output files to compact into the store",
+    )
+    parser.add_argument("--store_dir", type=str, default="../final-datasets/router_dataset_store")
+    parser.add_argument(
+        "--snapshot_file",
+        type=str,
+        default=None,
+        help="Also write the filtered, deduplicated rows as a memory-mappable Arrow file (e.g. `router_dataset_all.arrow`)",
+    )
+    parser.add_argument("--dedup_key", type=str, default="conversation_id", choices=["conversation_id", "prompt"])
+    parser.add_argument("--make_balanced", action="store_true", help="Downsample the snapshot to balanced labels")
+    parser.add_argument("--max_chars", type=int, default=None, help="Keep prompts shorter than this in the snapshot")
+    parser.add_argument("--labeller_models", type=str, nargs="*", default=None, help="Keep only these labellers")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(json.dumps(compact(args.sources, args.store_dir)))
+    table = load_table(
+        args.store_dir,
+        labeller_models=args.labeller_models,
+        max_chars=args.max_chars,
+        dedup_key=args.dedup_key,
+        make_balanced=args.make_balanced,
+    )
+    counts = {label: int(pc.sum(pc.equal(table["label"], label)).as_py() or 0) for label in LABELS}
+    print(f"{table.num_rows} rows after dedup/filters: {counts}")
+    if args.snapshot_file is not None:
+        write_snapshot(table, args.snapshot_file)
+        print(f"snapshot written to {args.snapshot_file}")
@@ -0,0 +1,173 @@
+import argparse
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+
+from aiohttp import web
+
+# Minimal OpenAI-compatible stand-in for `/v1/chat/completions`, to benchmark and test the labeling
+# engine offline. It answers with a label derived from the question's length, after a configurable
+# latency, and fails a configurable fraction of the requests with 429 or 500. With `"stream": true`,
+# the answer is sent as server-sent events, 4 characters per chunk; `stream_disconnect_after` drops
+# the connection after that many chunks, like an upstream failing mid-stream.
+
+
+def fake_label(prompt):
+    # labels the last question of the prompt (single-question prompts end with `* Label: ____`)
+    questions = re.findall(r"\* Question: (.*?)\n\* Label:", prompt, flags=re.S)
+    question = questions[-1] if questions else prompt
+    return "ROUTE_TO_SUPERIOR" if len(question.split()) > 20 else "ROUTE_TO_INFERIOR"
+
+
+def fake_answer(prompt, rng=None, drop_rate=0.0):
+    # numbered slots (`create_multi_prompt`) get one `Label <i>: <label>` line each, some of which
+    # are dropped with probability `drop_rate`; otherwise a single label
+    slots = re.findall(r"\* Question (\d+): (.*?)\n\* Label \1:", prompt, flags=re.S)
+    if not slots:
+        return fake_label(prompt)
+    rng = rng or random.Random()
+    lines = [f"Label {i}: {fake_label(q)}" for i, q in slots if rng.random() >= drop_rate]
+    return "\n".join(lines)
+
+
+def make_completion(content, model, prompt):
+    prompt_tokens = len(prompt) // 4
+    completion_tokens = max(1, len(content) // 4)
+    return {
+        "id": f"chatcmpl-fake-{random.getrandbits(32):08x}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def make_completion_chunks(content, model, chunk_chars=4):
+    # `chat.completion.chunk` objects of a streamed answer, the last one with the finish reason
+    completion_id = f"chatcmpl-fake-{random.getrandbits(32):08x}"
+    pieces = [content[i:i + chunk_chars] for i in range(0, len(content), chunk_chars)]
+    deltas = [{"role": "assistant", "content": ""}] + [{"content": piece} for piece in pieces] + [{}]
+    for i, delta in enumerate(deltas):
+        yield {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": "stop" if i == len(deltas) - 1 else None}],
+        }
+
+
+def make_app(
+    latency_ms=200.0,
+    error_rate_429=0.0,
+    error_rate_500=0.0,
+    drop_rate=0.0,
+    seed=None,
+    chunk_delay_ms=0.0,
+    stream_disconnect_after=None,
+):
+    rng = random.Random(seed)
+    stats = {"requests": 0, "errors_429": 0, "errors_500": 0}
+
+    async def chat_completions(request):
+        body = await request.json()
+        stats["requests"] += 1
+        await asyncio.sleep(latency_ms / 1000)
+        roll = rng.random()
+        if roll < error_rate_429:
+            stats["errors_429"] += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}},
+                status=429,
+                headers={"retry-after": "0.05"},
+            )
+        if roll < error_rate_429 + error_rate_500:
+            stats["errors_500"] += 1
+            return web.json_response({"error": {"message": "Internal error", "type": "server_error"}}, status=500)
+        prompt = body["messages"][-1]["content"]
+        content = fake_answer(prompt, rng=rng, drop_rate=drop_rate)
+        if body.get("stream"):
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+            await response.prepare(request)
+            for i, chunk in enumerate(make_completion_chunks(content, body.get("model", "fake"))):
+                if stream_disconnect_after is not None and i == stream_disconnect_after:
+                    request.transport.close()
+                    return response
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                await asyncio.sleep(chunk_delay_ms / 1000)
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+            return response
+        return web.json_response(make_completion(content, body.get("model", "fake"), prompt))
+
+    app = web.Application(client_max_size=16 * 1024**2)
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app["stats"] = stats
+    return app
+
+
+async def start_server(app, host="127.0.0.1", port=0):
+    # returns the runner (to clean up) and the base url to give to the OpenAI client
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{port}/v1"
+
+
+def start_server_in_thread(app, host="127.0.0.1", port=0):
+    # serves `app` from its own event loop, so blocking (sync) clients can use it too; returns (base_url, stop)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    runner, base_url = asyncio.run_coroutine_threadsafe(start_server(app, host, port), loop).result()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+    return base_url, stop
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8399)
+    parser.add_argument("--latency_ms", type=float, default=200.0, help="Latency of every completion")
+    parser.add_argument("--error_rate_429", type=float, default=0.0, help="Fraction of requests failing with 429")
+    parser.add_argument("--error_rate_500", type=float, default=0.0, help="Fraction of requests failing with 500")
+    parser.add_argument("--drop_rate", type=float, default=0.0, help="Fraction of missing answers in packed prompts")
+    parser.add_argument("--chunk_delay_ms", type=float, default=0.0, help="Delay between the chunks of streamed answers")
+    parser.add_argument(
+        "--stream_disconnect_after", type=int, default=None, help="Drop streamed answers after this many chunks"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    app = make_app(
+        args.latency_ms,
+        args.error_rate_429,
+        args.error_rate_500,
+        args.drop_rate,
+        chunk_delay_ms=args.chunk_delay_ms,
+        stream_disconnect_after=args.stream_disconnect_after,
+    )
+    web.run_app(app, host=args.host, port=args.port)
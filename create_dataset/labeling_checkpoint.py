@@ -0,0 +1,92 @@
+import datetime
+import glob
+import json
+import os
+
+
+def index_labelled_ids(patterns):
+    # conversation ids that already have a label in any of the files matching `patterns`;
+    # half-written or unparsable lines (e.g. from a crash of an older run) are ignored
+    labelled_ids = set()
+    for pattern in patterns:
+        for path in glob.glob(pattern):
+            with open(path, "rb") as fp:
+                for line in fp:
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        continue
+                    if row.get("gpt_content") is not None:
+                        labelled_ids.add(row["conversation_id"])
+    return labelled_ids
+
+
+def write_json_atomic(path, obj):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump(obj, fp, indent=2)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
+
+
+class CheckpointWriter:
+    # Appends labelled batches to a JSONL file so that the file always ends on a complete batch.
+    # Every batch is written in one append and fsynced; only then the manifest (written atomically)
+    # moves its `committed_bytes` forward. On restart, anything past `committed_bytes` is a batch
+    # that was in flight during the crash and is truncated away, so a half-written line never stays
+    # in the dataset.
+    def __init__(self, out_file, run_info=None):
+        self.out_file = out_file
+        self.manifest_path = f"{out_file}.manifest.json"
+        self.manifest = {
+            "out_file": os.path.basename(out_file),
+            "committed_bytes": 0,
+            "num_labelled": 0,
+            "num_batches": 0,
+            "run_info": run_info or {},
+        }
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as fp:
+                self.manifest.update(json.load(fp))
+        elif os.path.exists(out_file):
+            # file of a run without manifest: keep everything up to its last complete line
+            self.manifest["committed_bytes"] = self._last_newline_offset()
+        self._repair()
+
+    def _last_newline_offset(self):
+        with open(self.out_file, "rb") as fp:
+            data = fp.read()
+        return data.rfind(b"\n") + 1
+
+    def _repair(self):
+        if not os.path.exists(self.out_file):
+            open(self.out_file, "w").close()
+        size = os.path.getsize(self.out_file)
+        committed = self.manifest["committed_bytes"]
+        if size > committed:
+            print(f"truncating {size - committed} uncommitted bytes from {self.out_file}")
+            with open(self.out_file, "r+b") as fp:
+                fp.truncate(committed)
+                fp.flush()
+                os.fsync(fp.fileno())
+        elif size < committed:
+            raise RuntimeError(
+                f"{self.out_file} is shorter ({size} bytes) than its manifest ({committed} bytes), "
+                "it was modified outside of this script"
+            )
+
+    def write_batch(self, rows):
+        if not rows:
+            return
+        # same layout as `DataFrame.to_json(orient="records", lines=True)`
+        data = "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in rows).encode("utf-8")
+        with open(self.out_file, "ab") as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        self.manifest["committed_bytes"] += len(data)
+        self.manifest["num_labelled"] += len(rows)
+        self.manifest["num_batches"] += 1
+        self.manifest["updated_at"] = datetime.datetime.now().isoformat(timespec="seconds")
+        write_json_atomic(self.manifest_path, self.manifest)
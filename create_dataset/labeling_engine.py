@@ -0,0 +1,227 @@
+import asyncio
+import random
+import time
+
+import openai
+
+# the labeller only answers with one of the two labels
+MAX_COMPLETION_TOKENS = 10
+
+
+def estimate_tokens(prompt, completion_tokens=MAX_COMPLETION_TOKENS):
+    # ~4 characters per token for English text, plus the expected completion
+    return len(prompt) // 4 + completion_tokens
+
+
+class TokenBucket:
+    # refills continuously at `rate_per_min`, holds at most `capacity` units
+    def __init__(self, rate_per_min, capacity=None):
+        self.rate_per_sec = rate_per_min / 60
+        self.capacity = capacity if capacity is not None else rate_per_min
+        self.level = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate_per_sec)
+        self.updated_at = now
+
+    async def acquire(self, amount=1):
+        # a request bigger than the bucket would wait forever, so it only waits for a full bucket
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            self._refill()
+            while self.level < amount:
+                await asyncio.sleep((amount - self.level) / self.rate_per_sec)
+                self._refill()
+            self.level -= amount
+
+
+class RateLimiter:
+    # OpenAI limits both requests and tokens per minute; either limit can be left unset
+    def __init__(self, requests_per_min=None, tokens_per_min=None):
+        self.requests = TokenBucket(requests_per_min) if requests_per_min else None
+        self.tokens = TokenBucket(tokens_per_min) if tokens_per_min else None
+
+    async def acquire(self, num_tokens):
+        if self.requests is not None:
+            await self.requests.acquire(1)
+        if self.tokens is not None:
+            await self.tokens.acquire(num_tokens)
+
+
+def is_retryable(e):
+    if isinstance(e, (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(e, openai.APIStatusError) and e.status_code >= 500
+
+
+def get_retry_delay(e, attempt, base_delay=1.0, max_delay=60.0):
+    # honour `Retry-After` when the server sends it, otherwise exponential backoff with full jitter
+    response = getattr(e, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), max_delay)
+        except ValueError:
+            pass
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+async def get_gpt_completion_async(
+    prompt, model, client, limiter=None, max_retries=6, base_delay=1.0, usage=None, max_completion_tokens=None
+):
+    # `usage` (a Counter), if given, accumulates requests and prompt/completion tokens of successful calls
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            await limiter.acquire(estimate_tokens(prompt, max_completion_tokens or MAX_COMPLETION_TOKENS))
+        try:
+            completion = await client.chat.completions.create(
+                model=model, messages=[{"role": "user", "content": prompt}]
+            )
+            if usage is not None:
+                usage["requests"] += 1
+                if completion.usage is not None:
+                    usage["prompt_tokens"] += completion.usage.prompt_tokens
+                    usage["completion_tokens"] += completion.usage.completion_tokens
+            return completion.choices[0].message.content
+        except Exception as e:
+            if not is_retryable(e) or attempt == max_retries:
+                raise
+            await asyncio.sleep(get_retry_delay(e, attempt, base_delay=base_delay))
+
+
+async def label_prompts(
+    prompts,
+    model,
+    client,
+    concurrency=8,
+    limiter=None,
+    max_retries=6,
+    base_delay=1.0,
+    on_result=None,
+    usage=None,
+):
+    # Labels `prompts` with at most `concurrency` requests in flight and returns the completions in
+    # input order. `on_result(idx, content)` is called in input order too, as soon as all earlier
+    # prompts are done, so callers can checkpoint deterministically. Prompts that still fail after
+    # `max_retries` get `None`.
+    results = [None] * len(prompts)
+    done = [False] * len(prompts)
+    next_to_emit = 0
+    indices = iter(range(len(prompts)))
+
+    def emit_ready():
+        nonlocal next_to_emit
+        while next_to_emit < len(prompts) and done[next_to_emit]:
+            if on_result is not None:
+                on_result(next_to_emit, results[next_to_emit])
+            next_to_emit += 1
+
+    async def worker():
+        for idx in indices:
+            try:
+                results[idx] = await get_gpt_completion_async(
+                    prompts[idx],
+                    model=model,
+                    client=client,
+                    limiter=limiter,
+                    max_retries=max_retries,
+                    base_delay=base_delay,
+                    usage=usage,
+                )
+            except Exception as e:
+                print(f"giving up on prompt {idx}: {e!r}")
+            done[idx] = True
+            emit_ready()
+
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    return results
+
+
+async def label_prompts_packed(
+    questions,
+    create_single_prompt,
+    create_packed_prompt,
+    parse_packed_response,
+    model,
+    client,
+    pack_size=10,
+    max_pack_attempts=2,
+    concurrency=8,
+    limiter=None,
+    max_retries=6,
+    base_delay=1.0,
+    on_result=None,
+    usage=None,
+):
+    # Labels `questions` by packing `pack_size` of them into one request, so the few-shot prefix is
+    # paid once per pack. `parse_packed_response(content, n)` returns {slot: label} for the answers
+    # it could parse; the other questions are re-queued into new packs, up to `max_pack_attempts`
+    # packed rounds, and are then asked one by one with `create_single_prompt`.
+    # Returns the labels in input order (`None` if all attempts failed); `on_result` as in `label_prompts`.
+    results = [None] * len(questions)
+    done = [False] * len(questions)
+    next_to_emit = 0
+
+    def emit_ready():
+        nonlocal next_to_emit
+        while next_to_emit < len(questions) and done[next_to_emit]:
+            if on_result is not None:
+                on_result(next_to_emit, results[next_to_emit])
+            next_to_emit += 1
+
+    pending = list(range(len(questions)))
+    for attempt in range(max_pack_attempts + 1):
+        if not pending:
+            break
+        is_last = attempt == max_pack_attempts
+        size = 1 if is_last else pack_size
+        packs = iter([pending[i:i + size] for i in range(0, len(pending), size)])
+        missing = []
+
+        async def worker():
+            for pack in packs:
+                pack_questions = [questions[i] for i in pack]
+                if is_last:
+                    prompt = create_single_prompt(pack_questions[0])
+                else:
+                    prompt = create_packed_prompt(pack_questions)
+                try:
+                    content = await get_gpt_completion_async(
+                        prompt,
+                        model=model,
+                        client=client,
+                        limiter=limiter,
+                        max_retries=max_retries,
+                        base_delay=base_delay,
+                        usage=usage,
+                        max_completion_tokens=MAX_COMPLETION_TOKENS * len(pack),
+                    )
+                except Exception as e:
+                    print(f"request failed for prompts {pack}: {e!r}")
+                    content = None
+                if is_last:
+                    results[pack[0]] = content
+                    done[pack[0]] = True
+                else:
+                    labels = parse_packed_response(content, len(pack)) if content is not None else {}
+                    for slot, idx in enumerate(pack):
+                        if slot in labels:
+                            results[idx] = labels[slot]
+                            done[idx] = True
+                        else:
+                            missing.append(idx)
+                emit_ready()
+
+        await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+        if usage is not None:
+            usage["requeued"] += len(missing) if not is_last else 0
+        pending = sorted(missing)
+    return results
+
+
+def make_async_client(api_key, base_url=None):
+    # retries are handled by `get_gpt_completion_async`, with jitter and the shared rate limiter
+    return openai.AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0)
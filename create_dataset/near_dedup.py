@@ -0,0 +1,311 @@
+import argparse
+import glob
+import itertools
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import zlib
+
+import numpy as np
+import pyarrow.parquet as pq
+
+WORD_REGEX = re.compile(r"\w+")
+TEXT_FIELDS = ["initial_prompt", "text", "prompt", "question"]
+ID_FIELDS = ["conversation_id", "id", "prompt_id", "question_id"]
+
+
+def shingle_hashes(text, ngram=3):
+    # 32-bit hashes of the word `ngram`-grams of the lower-cased prompt (the whole prompt for shorter ones)
+    words = WORD_REGEX.findall((text or "").lower())
+    if len(words) <= ngram:
+        return [zlib.crc32(" ".join(words).encode("utf-8"))]
+    return [zlib.crc32(" ".join(words[i:i + ngram]).encode("utf-8")) for i in range(len(words) - ngram + 1)]
+
+
+def make_permutations(num_perm=128, seed=1):
+    # multiply-shift hash functions h(x) = (a * x + b) >> 32 over 64-bit integers, `a` odd
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2**63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def minhash_signatures(texts, num_perm=128, ngram=3, seed=1, block_shingles=16_384):
+    # (len(texts), num_perm) uint32 MinHash signatures. The shingles of consecutive prompts are hashed
+    # together in blocks of about `block_shingles` (a long prompt spans several blocks), each block is
+    # reduced per prompt with `np.minimum.reduceat` and folded into the signatures, so the
+    # (shingles, num_perm) products never exceed one block however long the prompts are.
+    a, b = make_permutations(num_perm, seed)
+    signatures = np.full((len(texts), num_perm), np.iinfo(np.uint32).max, dtype=np.uint32)
+    first, hashes, num_pending = 0, [], 0
+    for i, text in enumerate(texts):
+        hashes.append(shingle_hashes(text, ngram))
+        num_pending += len(hashes[-1])
+        if num_pending >= block_shingles or i == len(texts) - 1:
+            _fold_shingles(signatures, first, hashes, a, b, block_shingles)
+            first, hashes, num_pending = i + 1, [], 0
+    return signatures
+
+
+def _fold_shingles(signatures, first, hashes, a, b, block_shingles):
+    # folds the shingle hashes of prompts `first`, `first + 1`, ... into their signatures, block by block
+    lengths = np.fromiter((len(h) for h in hashes), dtype=np.int64, count=len(hashes))
+    flat = np.fromiter(itertools.chain.from_iterable(hashes), dtype=np.uint64, count=int(lengths.sum()))
+    owners = np.repeat(np.arange(first, first + len(hashes)), lengths)
+    for start in range(0, len(flat), block_shingles):
+        block_owners = owners[start:start + block_shingles]
+        permuted = ((flat[start:start + block_shingles, None] * a[None, :] + b[None, :]) >> np.uint64(32)).astype(np.uint32)
+        offsets = np.concatenate([[0], np.flatnonzero(np.diff(block_owners)) + 1])
+        rows = block_owners[offsets]
+        signatures[rows] = np.minimum(signatures[rows], np.minimum.reduceat(permuted, offsets, axis=0))
+
+
+def lsh_params(threshold, num_perm=128, false_positive_weight=0.2):
+    # (bands, rows per band) minimizing the weighted probability mass of false positives (pairs below
+    # `threshold` becoming candidates) and false negatives (pairs above it that never do)
+    s_low = np.linspace(0.0, threshold, 101)
+    s_high = np.linspace(threshold, 1.0, 101)
+    best, best_error = (1, num_perm), np.inf
+    for rows in range(1, num_perm + 1):
+        for bands in range(1, num_perm // rows + 1):
+            false_positive = (1 - (1 - s_low**rows) ** bands).mean() * threshold
+            false_negative = ((1 - s_high**rows) ** bands).mean() * (1 - threshold)
+            error = false_positive_weight * false_positive + (1 - false_positive_weight) * false_negative
+            if error < best_error:
+                best, best_error = (bands, rows), error
+    return best
+
+
+def band_keys(band):
+    # one 64-bit key per row of a (n, rows) uint32 band (FNV-1a style fold, wraps around)
+    keys = np.full(len(band), 0xCBF29CE484222325, dtype=np.uint64)
+    for column in range(band.shape[1]):
+        keys = (keys ^ band[:, column].astype(np.uint64)) * np.uint64(0x100000001B3)
+    return keys
+
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def cluster_signatures(signatures, threshold=0.8, bands=None, rows=None, verify_chunk=65_536):
+    # Clusters near-duplicate prompts: prompts sharing a bucket in any LSH band become candidate pairs
+    # (each bucket member paired with the bucket's first prompt), kept when the MinHash estimate of
+    # their Jaccard similarity reaches `threshold`, and joined with union-find. Returns the cluster of
+    # every prompt as the index of its first prompt, so `labels == arange(n)` marks one prompt per cluster.
+    # `signatures` may be a memory-mapped array: one band of it is read at a time.
+    n, num_perm = signatures.shape
+    if bands is None or rows is None:
+        bands, rows = lsh_params(threshold, num_perm)
+    parent = np.arange(n)
+    num_candidates = num_verified = 0
+    for band in range(bands):
+        keys = band_keys(np.asarray(signatures[:, band * rows:(band + 1) * rows]))
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        same_as_previous = np.concatenate([[False], sorted_keys[1:] == sorted_keys[:-1]])
+        if not same_as_previous.any():
+            continue
+        # the first prompt of the bucket of every position in `order`
+        bucket_start = np.maximum.accumulate(np.where(~same_as_previous, np.arange(n), 0))
+        members = order[same_as_previous]
+        firsts = order[bucket_start[same_as_previous]]
+        num_candidates += len(members)
+        for start in range(0, len(members), verify_chunk):
+            m, f = members[start:start + verify_chunk], firsts[start:start + verify_chunk]
+            similarity = (np.asarray(signatures[m]) == np.asarray(signatures[f])).mean(axis=1)
+            for i, j in zip(m[similarity >= threshold], f[similarity >= threshold]):
+                root_i, root_j = _find(parent, i), _find(parent, j)
+                if root_i != root_j:
+                    parent[max(root_i, root_j)] = min(root_i, root_j)
+                    num_verified += 1
+    # pointer jumping: every prompt points to its root, the smallest index of its cluster
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            break
+        parent = grandparent
+    return parent, {"bands": bands, "rows_per_band": rows, "candidate_pairs": num_candidates, "merges": num_verified}
+
+
+def cluster_stats(labels):
+    # cluster size distribution and shrink of the dataset
+    sizes = np.bincount(labels, minlength=len(labels))
+    sizes = sizes[sizes > 0]
+    num_prompts = len(labels)
+    return {
+        "num_prompts": num_prompts,
+        "num_clusters": len(sizes),
+        "num_duplicates": num_prompts - len(sizes),
+        "shrink": 1 - len(sizes) / num_prompts if num_prompts else 0.0,
+        "num_clusters_with_duplicates": int((sizes > 1).sum()),
+        "max_cluster_size": int(sizes.max()) if len(sizes) else 0,
+        "cluster_size_histogram": {
+            name: int(((sizes >= low) & (sizes <= high)).sum())
+            for name, low, high in [("1", 1, 1), ("2-4", 2, 4), ("5-16", 5, 16), ("17-64", 17, 64), ("65+", 65, np.inf)]
+        },
+    }
+
+
+def near_duplicate_keep_mask(texts, threshold=0.8, num_perm=128, ngram=3, seed=1):
+    # True for the first prompt of every cluster of near-duplicates, in memory
+    signatures = minhash_signatures(texts, num_perm=num_perm, ngram=ngram, seed=seed)
+    labels, _ = cluster_signatures(signatures, threshold)
+    return labels == np.arange(len(texts)), labels
+
+
+def iter_text_batches(paths, batch_size=10_000, text_field=None, id_field=None):
+    # (ids, texts) batches of JSONL or parquet files, read lazily; unparsable JSONL lines are skipped
+    for path in paths:
+        if path.endswith(".parquet"):
+            pf = pq.ParquetFile(path)
+            names = pf.schema_arrow.names
+            text_col = text_field or next(f for f in TEXT_FIELDS if f in names)
+            id_col = id_field or next((f for f in ID_FIELDS if f in names), None)
+            columns = [text_col] + ([id_col] if id_col else [])
+            for batch in pf.iter_batches(batch_size=batch_size, columns=columns):
+                texts = batch.column(text_col).to_pylist()
+                yield (batch.column(id_col).to_pylist() if id_col else [None] * len(texts)), texts
+        else:
+            ids, texts = [], []
+            with open(path) as fp:
+                for line in fp:
+                    try:
+                        row = json.loads(line)
+                    except ValueError:  # blank or half-written line
+                        continue
+                    text_col = text_field or next(f for f in TEXT_FIELDS if f in row)
+                    id_col = id_field or next((f for f in ID_FIELDS if f in row), None)
+                    ids.append(row.get(id_col) if id_col else None)
+                    texts.append(row[text_col])
+                    if len(texts) == batch_size:
+                        yield ids, texts
+                        ids, texts = [], []
+            if texts:
+                yield ids, texts
+
+
+def dedup_files(
+    patterns, out_file, threshold=0.8, num_perm=128, ngram=3, seed=1, batch_size=10_000, work_dir=None, text_field=None
+):
+    # Two passes over the input, so memory does not grow with the corpus: the first writes the
+    # signatures to a memory-mapped file in `work_dir`, the second copies the first prompt of every
+    # cluster to `out_file` (JSONL, `conversation_id` and `initial_prompt`).
+    paths = sorted(p for pattern in patterns for p in glob.glob(pattern))
+    if not paths:
+        raise FileNotFoundError(f"no prompts match {patterns}")
+    work_dir = tempfile.mkdtemp(prefix="near-dedup-", dir=work_dir)
+    signatures_path = os.path.join(work_dir, "signatures.bin")
+    try:
+        t0 = time.perf_counter()
+        num_prompts = 0
+        with open(signatures_path, "wb") as fp:
+            for _, texts in iter_text_batches(paths, batch_size, text_field=text_field):
+                fp.write(minhash_signatures(texts, num_perm=num_perm, ngram=ngram, seed=seed).tobytes())
+                num_prompts += len(texts)
+        signature_seconds = time.perf_counter() - t0
+        signatures = np.memmap(signatures_path, dtype=np.uint32, mode="r", shape=(num_prompts, num_perm))
+        labels, lsh_stats = cluster_signatures(signatures, threshold)
+        cluster_seconds = time.perf_counter() - t0 - signature_seconds
+        keep = labels == np.arange(num_prompts)
+        # the 5 largest clusters, with their first prompt as example
+        roots, counts = np.unique(labels, return_counts=True)
+        largest = {int(roots[k]): {"size": int(counts[k])} for k in np.argsort(-counts, kind="stable")[:5] if counts[k] > 1}
+        offset = 0
+        with open(out_file, "w") as fp:
+            for ids, texts in iter_text_batches(paths, batch_size, text_field=text_field):
+                for i in np.flatnonzero(keep[offset:offset + len(texts)]):
+                    fp.write(json.dumps({"conversation_id": ids[i], "initial_prompt": texts[i]}) + "\n")
+                    if offset + i in largest:
+                        largest[offset + i]["example"] = (texts[i] or "")[:200]
+                offset += len(texts)
+        del signatures
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    stats = cluster_stats(labels)
+    stats["largest_clusters"] = sorted(largest.values(), key=lambda c: -c["size"])
+    stats.update(lsh_stats)
+    stats.update({"signature_seconds": signature_seconds, "cluster_seconds": cluster_seconds})
+    return stats
+
+
+def evaluate_f1(train_file, test_file, threshold=0.8):
+    # router F1 on the original questions with and without near-duplicates in the training set,
+    # using the cheap first stage of `cascade_router.py` as a fast stand-in for the BERT router
+    import sys
+
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "inference"))
+    from sklearn.metrics import f1_score
+
+    from cascade_router import HashedNgramClassifier
+    from router_datasets import (
+        import_df_from_jsonl_file,
+        import_labelled_df,
+        process_questions_dataset,
+        process_synthetic_dataset,
+    )
+
+    test_df = process_questions_dataset(import_df_from_jsonl_file(test_file))
+    report = {}
+    for name, near_dup_threshold in [("full", None), ("near_dedup", threshold)]:
+        train_df = process_synthetic_dataset(
+            import_labelled_df(train_file), make_balanced=True, max_length=250, near_dup_threshold=near_dup_threshold
+        )
+        t0 = time.perf_counter()
+        classifier = HashedNgramClassifier().fit(train_df["text"].tolist(), train_df["target"].to_numpy())
+        preds = (classifier.predict_superior_proba(test_df["text"].tolist()) >= 0.5).astype(int)
+        report[name] = {
+            "train_samples": len(train_df),
+            "train_seconds": time.perf_counter() - t0,
+            "test_f1": float(f1_score(test_df["target"], preds)),
+        }
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input",
+        type=str,
+        nargs="+",
+        default=["selected_prompts.jsonl"],
+        help="Glob patterns of JSONL/parquet prompts, e.g. the output of `prompt_selection.py`",
+    )
+    parser.add_argument("--out_file", type=str, default="selected_prompts_dedup.jsonl")
+    parser.add_argument("--threshold", type=float, default=0.8, help="Jaccard similarity of near-duplicates")
+    parser.add_argument("--num_perm", type=int, default=128, help="MinHash permutations")
+    parser.add_argument("--ngram", type=int, default=3, help="Words per shingle")
+    parser.add_argument("--batch_size", type=int, default=10_000, help="Prompts read at a time")
+    parser.add_argument("--text_field", type=str, default=None, help="Defaults to the first of: " + ", ".join(TEXT_FIELDS))
+    parser.add_argument("--work_dir", type=str, default=None, help="Directory of the temporary signature file")
+    parser.add_argument(
+        "--eval_train_file",
+        type=str,
+        default=None,
+        help="Labelled synthetic dataset: also report the router F1 when trained with and without near-duplicates",
+    )
+    parser.add_argument("--eval_test_file", type=str, default="../final-datasets/original_questions_labelled.jsonl")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    stats = dedup_files(
+        args.input,
+        args.out_file,
+        threshold=args.threshold,
+        num_perm=args.num_perm,
+        ngram=args.ngram,
+        batch_size=args.batch_size,
+        work_dir=args.work_dir,
+        text_field=args.text_field,
+    )
+    print(json.dumps(stats, indent=2))
+    if args.eval_train_file is not None:
+        print(json.dumps(evaluate_f1(args.eval_train_file, args.eval_test_file, args.threshold), indent=2))
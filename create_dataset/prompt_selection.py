@@ -0,0 +1,173 @@
+import argparse
+import glob
+import json
+import os
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# the columns of lmsys/lmsys-chat-1m used for selection
+COLUMNS = ["conversation_id", "conversation", "language", "openai_moderation"]
+# same as `\w+` in `filter_func` (RE2 has no unicode `\w`)
+WORD_REGEX = r"[\p{L}\p{N}_]+"
+
+
+def iter_record_batches(source, hf_token=None, batch_size=10_000):
+    # Yields `pyarrow.Table` batches of `COLUMNS`, either streamed from a hugging face dataset
+    # (e.g. `lmsys/lmsys-chat-1m`) or read lazily from local parquet / JSONL shards (glob patterns).
+    sources = [source] if isinstance(source, str) else list(source)
+    is_local = any("*" in s or s.endswith((".parquet", ".jsonl")) or os.path.exists(s) for s in sources)
+    if not is_local:
+        from datasets import load_dataset
+
+        ds = load_dataset(sources[0], split="train", streaming=True, token=hf_token)
+        for batch in ds.select_columns(COLUMNS).iter(batch_size=batch_size):
+            yield pa.Table.from_pydict(batch)
+        return
+    paths = sorted(p for pattern in sources for p in glob.glob(pattern))
+    if not paths:
+        raise FileNotFoundError(f"no shards match {sources}")
+    for path in paths:
+        if path.endswith(".parquet"):
+            pf = pq.ParquetFile(path)
+            for batch in pf.iter_batches(batch_size=batch_size, columns=COLUMNS):
+                yield pa.Table.from_batches([batch])
+        else:
+            rows = []
+            with open(path) as fp:
+                for line in fp:
+                    if line.strip():
+                        row = json.loads(line)
+                        rows.append({c: row[c] for c in COLUMNS})
+                    if len(rows) == batch_size:
+                        yield pa.Table.from_pylist(rows)
+                        rows = []
+            if rows:
+                yield pa.Table.from_pylist(rows)
+
+
+def first_prompts(table):
+    first_messages = pc.list_element(table["conversation"], 0)
+    return pc.struct_field(first_messages, "content")
+
+
+def flagged_mask(moderation):
+    # True for rows where any category of any message is flagged by the openai moderation
+    moderation = moderation.combine_chunks() if isinstance(moderation, pa.ChunkedArray) else moderation
+    flagged = np.zeros(len(moderation), dtype=bool)
+    parents = pc.list_parent_indices(moderation).to_numpy()
+    categories = pc.struct_field(pc.list_flatten(moderation), "categories")
+    for field in categories.type:
+        values = pc.fill_null(pc.struct_field(categories, field.name), False).to_numpy(zero_copy_only=False)
+        flagged[parents[values]] = True
+    return flagged
+
+
+def filter_batch(table, min_words=10, max_words=200):
+    # columnar version of `create_synthetic_dataset.filter_func`, returns a boolean mask
+    is_english = pc.equal(table["language"], "English").to_numpy(zero_copy_only=False)
+    is_small_conv = pc.equal(pc.list_value_length(table["conversation"]), 2).to_numpy(zero_copy_only=False)
+    prompts = first_prompts(table)
+    n_words = pc.fill_null(pc.count_substring_regex(prompts, WORD_REGEX), 0).to_numpy(zero_copy_only=False)
+    is_quality = (min_words < n_words) & (n_words < max_words)
+    return is_english & ~is_small_conv & ~flagged_mask(table["openai_moderation"]) & is_quality
+
+
+class ReservoirSampler:
+    # seeded uniform sample of `k` items from a stream of unknown length (algorithm R, one random
+    # draw per item, vectorized per batch); memory is bounded by `k`
+    def __init__(self, k, seed=42):
+        self.k = k
+        self.rng = np.random.default_rng(seed)
+        self.items = []
+        self.num_seen = 0
+
+    def add_batch(self, items):
+        n = len(items)
+        fill = min(max(self.k - len(self.items), 0), n)
+        self.items.extend(items[:fill])
+        if fill < n:
+            positions = np.arange(self.num_seen + fill, self.num_seen + n)
+            slots = self.rng.integers(0, positions + 1)
+            for offset in np.flatnonzero(slots < self.k):
+                self.items[slots[offset]] = items[fill + offset]
+        self.num_seen += n
+
+
+def select_prompts(
+    source,
+    amount,
+    hf_token=None,
+    seed=42,
+    min_words=10,
+    max_words=200,
+    batch_size=10_000,
+    max_rows=None,
+):
+    # Streams the whole corpus (or its first `max_rows` rows), keeps the rows passing `filter_batch`
+    # and returns a seeded random sample of `amount` of them as
+    # [{"conversation_id": ..., "initial_prompt": ...}], plus selection statistics.
+    sampler = ReservoirSampler(amount, seed=seed)
+    num_rows = 0
+    t0 = time.perf_counter()
+    for table in iter_record_batches(source, hf_token=hf_token, batch_size=batch_size):
+        if max_rows is not None and num_rows + len(table) > max_rows:
+            table = table.slice(0, max_rows - num_rows)
+        num_rows += len(table)
+        mask = filter_batch(table, min_words=min_words, max_words=max_words)
+        kept = table.filter(pa.array(mask))
+        ids = kept["conversation_id"].to_pylist()
+        prompts = first_prompts(kept).to_pylist()
+        sampler.add_batch([{"conversation_id": i, "initial_prompt": p} for i, p in zip(ids, prompts)])
+        if max_rows is not None and num_rows >= max_rows:
+            break
+    elapsed = time.perf_counter() - t0
+    stats = {
+        "rows_scanned": num_rows,
+        "rows_passing_filter": sampler.num_seen,
+        "rows_selected": len(sampler.items),
+        "seconds": elapsed,
+        "rows_per_sec": num_rows / elapsed if elapsed > 0 else 0.0,
+    }
+    return sampler.items, stats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--source",
+        type=str,
+        nargs="+",
+        default=["lmsys/lmsys-chat-1m"],
+        help="Hugging face dataset name (streamed) or glob patterns of local parquet/JSONL shards",
+    )
+    parser.add_argument("--amount", type=int, default=1000, help="Number of prompts to sample")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the reservoir sample")
+    parser.add_argument("--min_words", type=int, default=10)
+    parser.add_argument("--max_words", type=int, default=200)
+    parser.add_argument("--batch_size", type=int, default=10_000, help="Rows per columnar batch")
+    parser.add_argument("--max_rows", type=int, default=None, help="Only scan the first rows of the corpus")
+    parser.add_argument("--hf_token", type=str, default=None, help="The hugging face token")
+    parser.add_argument("--out_file", type=str, default="selected_prompts.jsonl", help="Output JSONL file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    rows, stats = select_prompts(
+        args.source,
+        args.amount,
+        hf_token=args.hf_token,
+        seed=args.seed,
+        min_words=args.min_words,
+        max_words=args.max_words,
+        batch_size=args.batch_size,
+        max_rows=args.max_rows,
+    )
+    with open(args.out_file, "w") as fp:
+        for row in rows:
+            fp.write(json.dumps(row) + "\n")
+    print(json.dumps(stats))
@@ -0,0 +1,241 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from sklearn.model_selection import train_test_split
+from transformers import AutoTokenizer, BertConfig, BertForSequenceClassification
+
+# the data preparation and batched inference helpers live next to the inference scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "inference"))
+from cascade_router import get_metrics  # noqa: E402
+from router_datasets import (  # noqa: E402
+    import_df_from_jsonl_file,
+    import_labelled_df,
+    process_questions_dataset,
+    process_synthetic_dataset,
+)
+
+device = "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--teacher_dir",
+        type=str,
+        default="../models/bert-base-uncased-router-finetuning-20240722T133228-save",
+        help="The fine-tuned router to distill (used `model.save_pretrained(...)`)",
+    )
+    parser.add_argument("--hf_model_name", type=str, default="bert-base-uncased", help="The tokenizer name in hugging face")
+    parser.add_argument(
+        "--train_file",
+        type=str,
+        default="../final-datasets/router_dataset_all.jsonl",
+        help="Labelled synthetic dataset: JSONL, dataset store directory or Arrow snapshot (see `dataset_store.py`)",
+    )
+    parser.add_argument("--test_file", type=str, default="../final-datasets/original_questions_labelled.jsonl")
+    parser.add_argument("--out_dir", type=str, default=None, help="Defaults to `<teacher_dir>-student-L<layers>-H<hidden>`")
+    parser.add_argument("--num_layers", type=int, default=4, help="Transformer layers of the student")
+    parser.add_argument("--hidden_size", type=int, default=384, help="Hidden size of the student")
+    parser.add_argument("--num_heads", type=int, default=6, help="Attention heads of the student")
+    parser.add_argument(
+        "--student_init",
+        type=str,
+        default="google/bert_uncased_L-4_H-384_A-6",
+        help="Pretrained compact BERT of the student's shape, used when the student is narrower than the teacher "
+        "(a student of the teacher's width starts from the teacher's layers); `none` for a random initialization",
+    )
+    parser.add_argument("--temperature", type=float, default=2.0, help="Softmax temperature of the soft targets")
+    parser.add_argument("--alpha", type=float, default=0.9, help="Weight of the soft-target loss vs the hard labels")
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--lr", type=float, default=1e-4)
+    parser.add_argument("--max_length", type=int, default=512)
+    parser.add_argument("--max_train_samples", type=int, default=None, help="Subsample the training set")
+    parser.add_argument("--seed", type=int, default=1702)
+    return parser.parse_args()
+
+
+def iter_batches(texts, tokenizer, batch_size, max_length, order=None):
+    # dynamically padded batches of `texts`, in `order` (defaults to input order)
+    order = np.arange(len(texts)) if order is None else order
+    for start in range(0, len(order), batch_size):
+        idx = order[start:start + batch_size]
+        encoding = tokenizer(
+            [texts[i] for i in idx],
+            max_length=max_length,
+            padding="longest",
+            truncation=True,
+            return_tensors="pt",
+        )
+        yield idx, encoding["input_ids"].to(device), encoding["attention_mask"].to(device)
+
+
+def get_logits(model, texts, tokenizer, batch_size=64, max_length=512):
+    model.eval()
+    logits = np.zeros((len(texts), model.config.num_labels), dtype=np.float32)
+    # batching prompts of similar length keeps the padding small
+    order = np.argsort([len(t) for t in texts], kind="stable")
+    with torch.no_grad():
+        for idx, ids, mask in iter_batches(texts, tokenizer, batch_size, max_length, order=order):
+            logits[idx] = model(ids, token_type_ids=None, attention_mask=mask)[0].float().cpu().numpy()
+    return logits
+
+
+def make_student(teacher, num_layers, hidden_size, num_heads, init_from=None):
+    # A student of the teacher's width starts from the teacher's embeddings and evenly spaced layers.
+    # A narrower one starts from the pretrained compact BERT `init_from` (e.g. one of Google's BERT
+    # miniatures, same uncased vocabulary) when given, otherwise from a random initialization.
+    teacher_config = teacher.config
+    if hidden_size != teacher_config.hidden_size and init_from is not None:
+        student = BertForSequenceClassification.from_pretrained(
+            init_from,
+            num_labels=teacher_config.num_labels,
+            id2label=teacher_config.id2label,
+            label2id=teacher_config.label2id,
+        )
+        config = student.config
+        shape = (config.num_hidden_layers, config.hidden_size, config.num_attention_heads)
+        if shape != (num_layers, hidden_size, num_heads) or config.vocab_size != teacher_config.vocab_size:
+            raise ValueError(
+                f"{init_from} has {shape[0]} layers, hidden size {shape[1]}, {shape[2]} heads and a vocabulary of "
+                f"{config.vocab_size}, the student {num_layers}, {hidden_size}, {num_heads} and "
+                f"{teacher_config.vocab_size} (pick the matching google/bert_uncased_L-<layers>_H-<hidden>_A-<heads>)"
+            )
+        return student
+    config = BertConfig.from_dict(
+        {
+            **teacher_config.to_dict(),
+            "num_hidden_layers": num_layers,
+            "hidden_size": hidden_size,
+            "num_attention_heads": num_heads,
+            # same feed-forward expansion ratio as the teacher (4x for bert-base-uncased)
+            "intermediate_size": teacher_config.intermediate_size * hidden_size // teacher_config.hidden_size,
+        }
+    )
+    student = BertForSequenceClassification(config)
+    if hidden_size == teacher_config.hidden_size:
+        # same width: start from the teacher's embeddings and evenly spaced layers
+        student.bert.embeddings.load_state_dict(teacher.bert.embeddings.state_dict())
+        layer_ids = np.linspace(0, teacher_config.num_hidden_layers - 1, num_layers).round().astype(int)
+        for student_layer, teacher_id in zip(student.bert.encoder.layer, layer_ids):
+            student_layer.load_state_dict(teacher.bert.encoder.layer[teacher_id].state_dict())
+        student.bert.pooler.load_state_dict(teacher.bert.pooler.state_dict())
+        student.classifier.load_state_dict(teacher.classifier.state_dict())
+    return student
+
+
+def distillation_loss(student_logits, teacher_probs, targets, temperature, alpha):
+    # KL to the temperature-softened teacher (scaled by T^2) plus cross-entropy on the hard labels
+    log_probs = torch.nn.functional.log_softmax(student_logits / temperature, dim=1)
+    soft_loss = torch.nn.functional.kl_div(log_probs, teacher_probs, reduction="batchmean") * temperature**2
+    hard_loss = torch.nn.functional.cross_entropy(student_logits, targets)
+    return alpha * soft_loss + (1 - alpha) * hard_loss
+
+
+def train_student(student, texts, teacher_logits, targets, tokenizer, args):
+    teacher_probs = torch.softmax(torch.as_tensor(teacher_logits) / args.temperature, dim=1)
+    targets = torch.as_tensor(targets, dtype=torch.long)
+    optimizer = torch.optim.AdamW(student.parameters(), lr=args.lr)
+    rng = np.random.default_rng(args.seed)
+    student.to(device)
+    for epoch in range(1, args.epochs + 1):
+        student.train()
+        t0 = time.perf_counter()
+        losses = []
+        for idx, ids, mask in iter_batches(texts, tokenizer, args.batch_size, args.max_length, order=rng.permutation(len(texts))):
+            logits = student(ids, token_type_ids=None, attention_mask=mask)[0]
+            loss = distillation_loss(
+                logits, teacher_probs[idx].to(device), targets[idx].to(device), args.temperature, args.alpha
+            )
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.detach())
+        elapsed = time.perf_counter() - t0
+        print(
+            f"epoch {epoch}/{args.epochs}: loss {torch.stack(losses).mean().item():.4f}, "
+            f"{len(texts) / elapsed:.1f} samples/sec"
+        )
+    student.eval()
+    return student
+
+
+def model_footprint(model):
+    num_params = sum(p.numel() for p in model.parameters())
+    num_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    num_bytes += sum(b.numel() * b.element_size() for b in model.buffers())
+    return {"num_params": num_params, "size_mb": num_bytes / 1024**2}
+
+
+def measure_latency(model, texts, tokenizer, batch_size, max_length, repeats=3):
+    # best-of-`repeats` milliseconds per prompt
+    model.eval()
+    best = float("inf")
+    with torch.no_grad():
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            for _, ids, mask in iter_batches(texts, tokenizer, batch_size, max_length):
+                model(ids, token_type_ids=None, attention_mask=mask)
+            best = min(best, time.perf_counter() - t0)
+    return best * 1000 / len(texts)
+
+
+def build_report(teacher, student, test_texts, test_targets, tokenizer, max_length):
+    teacher_preds = get_logits(teacher, test_texts, tokenizer, max_length=max_length).argmax(axis=1)
+    student_preds = get_logits(student, test_texts, tokenizer, max_length=max_length).argmax(axis=1)
+    latency_texts = test_texts[:64]
+    report = {}
+    for name, model, preds in [("teacher", teacher, teacher_preds), ("student", student, student_preds)]:
+        report[name] = {
+            **model_footprint(model),
+            "latency_ms_batch_1": measure_latency(model, latency_texts, tokenizer, 1, max_length),
+            "latency_ms_batch_32": measure_latency(model, latency_texts, tokenizer, 32, max_length),
+            "test": get_metrics(test_targets, preds),
+        }
+    report["student_teacher_agreement"] = float((teacher_preds == student_preds).mean())
+    report["speedup_batch_1"] = report["teacher"]["latency_ms_batch_1"] / report["student"]["latency_ms_batch_1"]
+    report["size_ratio"] = report["student"]["size_mb"] / report["teacher"]["size_mb"]
+    return report
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(args.seed)
+
+    tokenizer = AutoTokenizer.from_pretrained(args.hf_model_name)
+    teacher_dir = os.path.join(os.getcwd(), args.teacher_dir)
+    teacher = BertForSequenceClassification.from_pretrained(teacher_dir)
+    teacher.to(device)
+
+    # soft targets on the whole synthetic dataset (not only a balanced subset)
+    router_df = process_synthetic_dataset(import_labelled_df(args.train_file), make_balanced=False, max_length=0)
+    if args.max_train_samples is not None and len(router_df) > args.max_train_samples:
+        router_df = router_df.sample(n=args.max_train_samples, random_state=args.seed)
+    train_df, _ = train_test_split(router_df, train_size=0.9, shuffle=True, random_state=args.seed)
+    test_df = process_questions_dataset(import_df_from_jsonl_file(args.test_file))
+    train_texts = train_df["text"].tolist()
+
+    t0 = time.perf_counter()
+    teacher_logits = get_logits(teacher, train_texts, tokenizer, max_length=args.max_length)
+    print(f"teacher soft targets for {len(train_texts)} prompts in {time.perf_counter() - t0:.1f}s")
+
+    init_from = None if args.student_init.lower() == "none" else args.student_init
+    student = make_student(teacher, args.num_layers, args.hidden_size, args.num_heads, init_from=init_from)
+    student = train_student(student, train_texts, teacher_logits, train_df["target"].to_numpy(), tokenizer, args)
+
+    out_dir = args.out_dir or f"{teacher_dir.rstrip('/')}-student-L{args.num_layers}-H{args.hidden_size}"
+    student.save_pretrained(out_dir)
+
+    report = build_report(
+        teacher, student, test_df["text"].tolist(), test_df["target"].to_numpy(), tokenizer, args.max_length
+    )
+    report["args"] = vars(args)
+    with open(os.path.join(out_dir, "distillation_report.json"), "w") as fp:
+        json.dump(report, fp, indent=2)
+    print(json.dumps({k: v for k, v in report.items() if k != "args"}, indent=2))
+    print(f"saved the student to {out_dir}")
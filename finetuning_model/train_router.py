@@ -0,0 +1,387 @@
+import argparse
+import datetime
+import functools
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+import torch
+from sklearn.model_selection import train_test_split
+from torch.utils.data import DataLoader, Dataset
+from transformers import AutoTokenizer, BertForSequenceClassification
+
+# the data preparation and batching helpers live next to the inference scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "inference"))
+from router_datasets import (  # noqa: E402
+    import_df_from_jsonl_file,
+    import_labelled_df,
+    process_questions_dataset,
+    process_synthetic_dataset,
+)
+from run_model import LengthBucketSampler, pad_collate  # noqa: E402
+
+device = "cuda" if torch.cuda.is_available() else "cpu"
+CHECKPOINT_FILENAME = "checkpoint.pt"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--train_file",
+        type=str,
+        default="../final-datasets/router_dataset_all.jsonl",
+        help="Labelled synthetic dataset: JSONL, dataset store directory or Arrow snapshot (see `dataset_store.py`)",
+    )
+    parser.add_argument("--test_file", type=str, default="../final-datasets/original_questions_labelled.jsonl")
+    parser.add_argument("--hf_model_name", type=str, default="bert-base-uncased", help="The model name in hugging face")
+    parser.add_argument("--tokenizer_name", type=str, default=None, help="Defaults to --hf_model_name")
+    parser.add_argument(
+        "--out_dir",
+        type=str,
+        default=None,
+        help="Defaults to `../models/<hf_model_name>-router-finetuning-<time>-save`; pass it again with --resume",
+    )
+    parser.add_argument("--lr", type=float, default=2e-6)
+    parser.add_argument("--eps", type=float, default=1e-8)
+    parser.add_argument("--epochs", type=int, default=4)
+    parser.add_argument("--batch_size", type=int, default=8, help="Prompts per forward pass")
+    parser.add_argument(
+        "--grad_accum_steps", type=int, default=1, help="Forward passes per optimizer step (multiplies the batch size)"
+    )
+    parser.add_argument("--make_balanced", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument(
+        "--max_chars", type=int, default=250, help="Drop synthetic prompts with more characters (0 keeps all)"
+    )
+    parser.add_argument(
+        "--near_dup_threshold",
+        type=float,
+        default=None,
+        help="Keep one synthetic prompt per cluster of near-duplicates at this Jaccard similarity (see `near_dedup.py`)",
+    )
+    parser.add_argument("--max_length", type=int, default=512, help="Maximum tokens per prompt")
+    parser.add_argument("--bf16", action="store_true", help="bf16 autocast (on CPU and on GPUs that support it)")
+    parser.add_argument("--num_workers", type=int, default=2, help="DataLoader worker processes")
+    parser.add_argument(
+        "--cache_dir", type=str, default="../final-datasets/.token_cache", help="Where the pre-tokenized datasets go"
+    )
+    parser.add_argument(
+        "--checkpoint_steps", type=int, default=200, help="Save a resumable checkpoint every this many optimizer steps"
+    )
+    parser.add_argument(
+        "--resume", action="store_true", help="Continue from the checkpoint of --out_dir (in `<out_dir>-checkpoints`)"
+    )
+    parser.add_argument("--max_train_samples", type=int, default=None, help="Subsample the synthetic dataset")
+    parser.add_argument("--seed", type=int, default=1702)
+    return parser.parse_args()
+
+
+def get_isolike_time():
+    return datetime.datetime.today().strftime("%Y%m%dT%H%M%S")
+
+
+def pretokenize(texts, targets, tokenizer, tokenizer_name, max_length, cache_dir):
+    # Tokenizes `texts` once, without padding, into a flat token array plus offsets (`.npy` files in
+    # `cache_dir`, keyed by the texts, tokenizer and max length) and returns them memory-mapped, so that
+    # DataLoader workers share the same pages.
+    key = hashlib.sha256(
+        json.dumps([tokenizer_name, max_length, list(texts), [int(t) for t in targets]]).encode("utf-8")
+    ).hexdigest()[:16]
+    paths = {name: os.path.join(cache_dir, f"{key}-{name}.npy") for name in ["ids", "offsets", "targets"]}
+    if not all(os.path.exists(p) for p in paths.values()):
+        os.makedirs(cache_dir, exist_ok=True)
+        input_ids = tokenizer(
+            list(texts), add_special_tokens=True, max_length=max_length, truncation=True
+        )["input_ids"]
+        arrays = {
+            "ids": np.fromiter((t for ids in input_ids for t in ids), dtype=np.int32),
+            "offsets": np.cumsum([0] + [len(ids) for ids in input_ids]).astype(np.int64),
+            "targets": np.asarray(targets, dtype=np.int64),
+        }
+        for name, path in paths.items():
+            # written under a temporary name first, so an interrupted run never leaves a partial cache
+            tmp_path = f"{path[:-4]}.tmp.npy"
+            np.save(tmp_path, arrays[name])
+            os.replace(tmp_path, path)
+    return {name: np.load(path, mmap_mode="r") for name, path in paths.items()}
+
+
+class TokenizedDataset(Dataset):
+    # items of `pretokenize`; batches are padded to their longest prompt by `pad_collate`
+    def __init__(self, arrays):
+        self.ids = arrays["ids"]
+        self.offsets = arrays["offsets"]
+        self.targets = torch.as_tensor(np.asarray(arrays["targets"]), dtype=torch.long)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __getitem__(self, idx):
+        input_ids = torch.as_tensor(self.ids[self.offsets[idx]:self.offsets[idx + 1]], dtype=torch.long)
+        return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids), "idx": idx}
+
+
+def make_loader(dataset, batch_sampler, pad_token_id, num_workers):
+    return DataLoader(
+        dataset,
+        batch_sampler=batch_sampler,
+        collate_fn=functools.partial(pad_collate, pad_token_id=pad_token_id),
+        num_workers=num_workers,
+        pin_memory=device == "cuda",
+        persistent_workers=False,
+    )
+
+
+def epoch_batches(num_samples, batch_size, seed, epoch):
+    # shuffled batches of one epoch; seeded by (seed, epoch) so a resumed run replays the same order
+    order = np.random.default_rng([seed, epoch]).permutation(num_samples)
+    return [order[i:i + batch_size].tolist() for i in range(0, num_samples, batch_size)]
+
+
+class MetricAccumulator:
+    # loss and confusion counts kept on the device; only `compute` copies them to the host
+    def __init__(self):
+        self.state = torch.zeros(6, dtype=torch.float64, device=device)  # loss sum, n, tp, fp, fn, tn
+
+    def update(self, loss, logits, targets):
+        preds = logits.argmax(dim=1)
+        n = targets.numel()
+        self.state += torch.stack(
+            [
+                loss.detach().double() * n,
+                torch.tensor(n, dtype=torch.float64, device=device),
+                ((preds == 1) & (targets == 1)).sum().double(),
+                ((preds == 1) & (targets == 0)).sum().double(),
+                ((preds == 0) & (targets == 1)).sum().double(),
+                ((preds == 0) & (targets == 0)).sum().double(),
+            ]
+        )
+
+    def compute(self):
+        loss_sum, n, tp, fp, fn, tn = self.state.tolist()
+        precision = tp / (tp + fp) if tp + fp else 0.0
+        recall = tp / (tp + fn) if tp + fn else 0.0
+        return {
+            "loss": loss_sum / n if n else 0.0,
+            "accuracy": (tp + tn) / n if n else 0.0,
+            "precision": precision,
+            "recall": recall,
+            "f1": 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+        }
+
+
+def autocast(enabled):
+    return torch.autocast(device_type="cuda" if device == "cuda" else "cpu", dtype=torch.bfloat16, enabled=enabled)
+
+
+def get_metrics_and_loss(model, loader, targets, bf16=False):
+    model.eval()
+    metrics = MetricAccumulator()
+    with torch.no_grad():
+        for data in loader:
+            batch_targets = targets[data["idx"]].to(device, non_blocking=True)
+            with autocast(bf16):
+                loss, logits = model(
+                    data["input_ids"].to(device, non_blocking=True),
+                    token_type_ids=None,
+                    attention_mask=data["attention_mask"].to(device, non_blocking=True),
+                    labels=batch_targets,
+                ).to_tuple()
+            metrics.update(loss, logits.float(), batch_targets)
+    model.train()
+    return metrics.compute()
+
+
+def save_checkpoint(path, model, optimizer, state):
+    tmp_path = f"{path}.tmp"
+    torch.save(
+        {
+            "model": model.state_dict(),
+            "optimizer": optimizer.state_dict(),
+            "torch_rng": torch.get_rng_state(),
+            **state,
+        },
+        tmp_path,
+    )
+    os.replace(tmp_path, path)
+
+
+def print_metrics(name, metrics):
+    print(f"---{name} METRICS---")
+    for k, v in metrics.items():
+        print(f"{k:<10} {v:.4f}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(args.seed)
+
+    out_dir = args.out_dir or f"../models/{args.hf_model_name}-router-finetuning-{get_isolike_time()}-save"
+    # the model and optimizer state (~1.3 GB for bert-base) stays out of the model directory that the
+    # inference scripts load, and is removed once the model is saved
+    checkpoint_dir = f"{out_dir.rstrip('/')}-checkpoints"
+    checkpoint_path = os.path.join(checkpoint_dir, CHECKPOINT_FILENAME)
+    if args.resume and not os.path.exists(checkpoint_path):
+        raise FileNotFoundError(f"no checkpoint to resume from in {checkpoint_dir}")
+    os.makedirs(out_dir, exist_ok=True)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+
+    router_df = process_synthetic_dataset(
+        import_labelled_df(args.train_file),
+        make_balanced=args.make_balanced,
+        max_length=args.max_chars,
+        near_dup_threshold=args.near_dup_threshold,
+    )
+    if args.max_train_samples is not None and len(router_df) > args.max_train_samples:
+        router_df = router_df.sample(n=args.max_train_samples, random_state=args.seed)
+    train_data, valid_data = train_test_split(router_df, train_size=0.9, shuffle=True, random_state=args.seed)
+    test_data = process_questions_dataset(import_df_from_jsonl_file(args.test_file))
+    print(f"{len(train_data):>5,} Training samples")
+    print(f"{len(valid_data):>5,} Validation samples")
+    if not args.resume:
+        train_data.to_json(f"{out_dir}/train_data.jsonl", orient="records", lines=True)
+        valid_data.to_json(f"{out_dir}/valid_data.jsonl", orient="records", lines=True)
+        test_data.to_json(f"{out_dir}/test_data.jsonl", orient="records", lines=True)
+        with open(f"{out_dir}/hparams.jsonl", "w") as fp:
+            json.dump(vars(args), fp)
+
+    tokenizer_name = args.tokenizer_name or args.hf_model_name
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+    pad_token_id = tokenizer.pad_token_id or 0
+    t0 = time.perf_counter()
+    datasets = {
+        name: TokenizedDataset(
+            pretokenize(df["text"], df["target"], tokenizer, tokenizer_name, args.max_length, args.cache_dir)
+        )
+        for name, df in [("train", train_data), ("valid", valid_data), ("test", test_data)]
+    }
+    print(f"tokenized datasets ready in {time.perf_counter() - t0:.1f}s")
+    eval_loaders = {
+        name: make_loader(
+            datasets[name],
+            LengthBucketSampler(datasets[name].lengths(), 4 * args.batch_size),
+            pad_token_id,
+            args.num_workers,
+        )
+        for name in ["valid", "test"]
+    }
+
+    model = BertForSequenceClassification.from_pretrained(
+        args.hf_model_name, num_labels=2, output_attentions=False, output_hidden_states=False
+    )
+    model.to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr, eps=args.eps)
+
+    start_epoch, start_batch, global_step, training_stats = 1, 0, 0, []
+    running_state = None
+    if args.resume:
+        checkpoint = torch.load(checkpoint_path, map_location=device, weights_only=False)
+        model.load_state_dict(checkpoint["model"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        torch.set_rng_state(checkpoint["torch_rng"])
+        start_epoch, start_batch = checkpoint["epoch"], checkpoint["batches_done"]
+        global_step, training_stats = checkpoint["global_step"], checkpoint["training_stats"]
+        running_state = checkpoint["running_metrics"]
+        print(f"resuming at epoch {start_epoch}, batch {start_batch} (optimizer step {global_step})")
+
+    train_dataset = datasets["train"]
+    train_targets = train_dataset.targets.to(device)
+    model.train()
+    for epoch in range(start_epoch, args.epochs + 1):
+        print(f"\n================ Epoch {epoch} / {args.epochs} ================")
+        batches = epoch_batches(len(train_dataset), args.batch_size, args.seed, epoch)
+        first_batch = start_batch if epoch == start_epoch else 0
+        loader = make_loader(train_dataset, batches[first_batch:], pad_token_id, args.num_workers)
+        train_metrics = MetricAccumulator()
+        if running_state is not None and epoch == start_epoch:
+            train_metrics.state = running_state.to(device)
+        num_samples = 0
+        t0 = time.perf_counter()
+        optimizer.zero_grad(set_to_none=True)
+        for step, data in enumerate(loader, start=first_batch + 1):
+            targets = train_targets[data["idx"].to(device, non_blocking=True)]
+            with autocast(args.bf16):
+                loss, logits = model(
+                    data["input_ids"].to(device, non_blocking=True),
+                    token_type_ids=None,
+                    attention_mask=data["attention_mask"].to(device, non_blocking=True),
+                    labels=targets,
+                ).to_tuple()
+            train_metrics.update(loss, logits.float(), targets)
+            (loss / args.grad_accum_steps).backward()
+            num_samples += len(data["idx"])
+            if step % args.grad_accum_steps == 0 or step == len(batches):
+                optimizer.step()
+                optimizer.zero_grad(set_to_none=True)
+                global_step += 1
+                if global_step % args.checkpoint_steps == 0:
+                    save_checkpoint(
+                        checkpoint_path,
+                        model,
+                        optimizer,
+                        {
+                            "epoch": epoch,
+                            "batches_done": step,
+                            "global_step": global_step,
+                            "training_stats": training_stats,
+                            "running_metrics": train_metrics.state.cpu(),
+                        },
+                    )
+            if step % 40 == 0:
+                elapsed = str(datetime.timedelta(seconds=int(round(time.perf_counter() - t0))))
+                print(f"  Batch {step:>5,}  of  {len(batches):>5,}.    Elapsed: {elapsed}.")
+        elapsed = time.perf_counter() - t0
+        samples_per_sec = num_samples / elapsed if elapsed > 0 else 0.0
+
+        train_metrics = train_metrics.compute()
+        print_metrics("TRAIN", train_metrics)
+        valid_metrics = get_metrics_and_loss(model, eval_loaders["valid"], datasets["valid"].targets, args.bf16)
+        print_metrics("VALIDATION", valid_metrics)
+        print(f"epoch {epoch}: {samples_per_sec:.1f} samples/sec")
+        training_stats.append(
+            {
+                "epoch": epoch,
+                "Training Loss": train_metrics["loss"],
+                "Training Accuracy": train_metrics["accuracy"],
+                "Training Precision": train_metrics["precision"],
+                "Training Recall": train_metrics["recall"],
+                "Training F1": train_metrics["f1"],
+                "Validation Loss": valid_metrics["loss"],
+                "Validation Accuracy": valid_metrics["accuracy"],
+                "Validation Precision": valid_metrics["precision"],
+                "Validation Recall": valid_metrics["recall"],
+                "Validation F1": valid_metrics["f1"],
+                "Samples/sec": samples_per_sec,
+            }
+        )
+        # the epoch boundary is a checkpoint too, so a resume never repeats a finished epoch
+        save_checkpoint(
+            checkpoint_path,
+            model,
+            optimizer,
+            {
+                "epoch": epoch + 1,
+                "batches_done": 0,
+                "global_step": global_step,
+                "training_stats": training_stats,
+                "running_metrics": None,
+            },
+        )
+
+    model.save_pretrained(out_dir)
+    with open(f"{out_dir}/trainvalid_statistics.jsonl", "w") as fp:
+        for row in training_stats:
+            fp.write(json.dumps(row) + "\n")
+
+    test_metrics = get_metrics_and_loss(model, eval_loaders["test"], datasets["test"].targets, args.bf16)
+    print_metrics("TEST", test_metrics)
+    with open(f"{out_dir}/test_metrics.jsonl", "w") as fp:
+        json.dump(test_metrics, fp)
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    print(f"saved the model to {out_dir}")
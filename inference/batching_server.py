@@ -0,0 +1,233 @@
+import argparse
+import asyncio
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from run_gradio_model import device, infer_batch, infer_single
+
+
+class QueueFullError(RuntimeError):
+    pass
+
+
+class MicroBatcher:
+    # Collects concurrent `route` calls into a queue and runs one batched forward pass per group.
+    # A group is closed when it reaches `max_batch_size` prompts or when its first prompt has waited
+    # `max_wait_ms`. The forward pass runs on a single background thread, so the event loop keeps
+    # accepting prompts (which form the next group) while the model is busy.
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        id2label,
+        max_batch_size=32,
+        max_wait_ms=5.0,
+        max_queue_size=1024,
+        block_when_full=False,
+        cache=None,
+        infer_batch_fn=infer_batch,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.id2label = id2label
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue_size = max_queue_size
+        self.block_when_full = block_when_full
+        self.cache = cache
+        self.infer_batch_fn = infer_batch_fn
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.worker = None
+        self.batch_size_hist = Counter()
+        self.queue_depth_hist = Counter()
+        self.num_rejected = 0
+        self.max_queue_depth = 0
+
+    def _ensure_started(self):
+        # the queue and worker are bound to the running event loop, so they are created lazily
+        if self.worker is None or self.worker.done():
+            self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self.worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def route(self, text):
+        if self.cache is not None:
+            from route_cache import get_model_identity, make_cache_key
+
+            model_id = get_model_identity(self.model)
+            self.cache.bind_model(model_id)
+            key = make_cache_key(text, model_id)
+            res = self.cache.get(key)
+            if res is None:
+                res = await self._route_uncached(text)
+                self.cache.put(key, res)
+            return res
+        return await self._route_uncached(text)
+
+    async def _route_uncached(self, text):
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        if self.block_when_full:
+            await self.queue.put((text, future))
+        else:
+            try:
+                self.queue.put_nowait((text, future))
+            except asyncio.QueueFull:
+                self.num_rejected += 1
+                raise QueueFullError(f"routing queue is full ({self.max_queue_size} prompts waiting)")
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return await future
+
+    async def _collect_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # take whatever is already queued without waiting
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            timeout = deadline - loop.time()
+            if len(batch) >= self.max_batch_size or timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect_batch()
+            self.batch_size_hist[len(batch)] += 1
+            self.queue_depth_hist[self.queue.qsize()] += 1
+            texts = [text for text, _ in batch]
+            try:
+                results = await loop.run_in_executor(
+                    self.executor,
+                    lambda: self.infer_batch_fn(texts, model=self.model, tokenizer=self.tokenizer, id2label=self.id2label),
+                )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), res in zip(batch, results):
+                if not future.done():  # the caller may have been cancelled
+                    future.set_result(res)
+
+    def stats(self):
+        num_batches = sum(self.batch_size_hist.values())
+        num_prompts = sum(size * count for size, count in self.batch_size_hist.items())
+        return {
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "max_queue_depth": self.max_queue_depth,
+            "num_batches": num_batches,
+            "num_prompts": num_prompts,
+            "num_rejected": self.num_rejected,
+            "mean_batch_size": num_prompts / num_batches if num_batches else 0.0,
+            "batch_size_hist": dict(sorted(self.batch_size_hist.items())),
+            "queue_depth_hist": dict(sorted(self.queue_depth_hist.items())),
+        }
+
+    async def close(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+        self.executor.shutdown(wait=False)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_save_dir",
+        type=str,
+        default="../models/bert-base-uncased-router-finetuning-20240722T133228-save",
+        help="The directory where the BERT model weights are stored (used `model.save_pretrained(...)`",
+    )
+    parser.add_argument(
+        "--hf_model_name",
+        type=str,
+        default="bert-base-uncased",
+        help="The tokenizer name in hugging face",
+    )
+    parser.add_argument("--num_requests", type=int, default=512, help="Number of simulated requests")
+    parser.add_argument("--concurrency", type=int, default=64, help="Number of concurrent simulated clients")
+    parser.add_argument("--max_batch_size", type=int, default=32)
+    parser.add_argument("--max_wait_ms", type=float, default=5.0)
+    parser.add_argument("--max_queue_size", type=int, default=1024)
+    return parser.parse_args()
+
+
+async def run_load(route, prompts, concurrency):
+    # `concurrency` clients send their prompts back to back; returns the per-request latencies
+    latencies = []
+    prompt_iter = iter(prompts)
+
+    async def client():
+        for text in prompt_iter:
+            t0 = time.perf_counter()
+            await route(text)
+            latencies.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - t0
+
+
+def summarize_latencies(latencies, elapsed):
+    lat_ms = np.asarray(latencies) * 1000
+    return {
+        "qps": len(latencies) / elapsed,
+        "p50_ms": float(np.percentile(lat_ms, 50)),
+        "p99_ms": float(np.percentile(lat_ms, 99)),
+    }
+
+
+if __name__ == "__main__":
+    from transformers import AutoTokenizer, BertForSequenceClassification
+
+    from benchmark_batching import load_prompts
+
+    args = parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.hf_model_name)
+    save_directory = os.path.join(os.getcwd(), args.model_save_dir)
+    model = BertForSequenceClassification.from_pretrained(save_directory)
+    model.to(device)
+    id2label = {0: "ROUTE_TO_INFERIOR", 1: "ROUTE_TO_SUPERIOR"}
+    prompts = load_prompts(None, args.num_requests)
+
+    async def main():
+        # baseline: one forward pass per request, serialized on one thread as in the gradio app
+        executor = ThreadPoolExecutor(max_workers=1)
+
+        async def route_single(text):
+            return await asyncio.get_running_loop().run_in_executor(
+                executor, lambda: infer_single(text, model=model, tokenizer=tokenizer, id2label=id2label)
+            )
+
+        latencies, elapsed = await run_load(route_single, prompts, args.concurrency)
+        print("per-request:", summarize_latencies(latencies, elapsed))
+
+        batcher = MicroBatcher(
+            model,
+            tokenizer,
+            id2label,
+            max_batch_size=args.max_batch_size,
+            max_wait_ms=args.max_wait_ms,
+            max_queue_size=args.max_queue_size,
+        )
+        latencies, elapsed = await run_load(batcher.route, prompts, args.concurrency)
+        print("micro-batched:", summarize_latencies(latencies, elapsed))
+        print("batcher stats:", batcher.stats())
+        await batcher.close()
+
+    asyncio.run(main())
@@ -0,0 +1,95 @@
+import argparse
+import json
+import os
+import random
+import time
+
+from transformers import BertForSequenceClassification
+
+from run_model import InferenceDataset, device, get_data_loader, infer, load_jsonl_texts
+
+SAMPLE_PROMPTS = [
+    "Which word does not belong with the others?\ntyre, steering wheel, car, engine",
+    "What are some business etiquette norms when doing business in Japan?",
+    "Write a C++ program to find the nth Fibonacci number using recursion.",
+    "Given that f(x) = 4x^3 - 9x - 14, find the value of f(2).",
+    "Compose an engaging travel blog post about a recent trip to Hawaii, highlighting cultural experiences and must-see attractions.",
+    "Help me construct a catchy, yet scientifically accurate, headline for an article on the latest discovery in renewable bio-energy, while carefully handling the ethical dilemmas surrounding bio-energy sources. Propose 4 options.",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_save_dir",
+        type=str,
+        default="../models/bert-base-uncased-router-finetuning-20240722T133228-save",
+        help="The directory where the BERT model weights are stored (used `model.save_pretrained(...)`",
+    )
+    parser.add_argument(
+        "--hf_model_name",
+        type=str,
+        default="bert-base-uncased",
+        help="The tokenizer name in hugging face",
+    )
+    parser.add_argument(
+        "--prompts_file",
+        type=str,
+        default=None,
+        help="Optional JSONL file with a `text` (or `initial_prompt`, `question`) field per line, defaults to built-in sample prompts",
+    )
+    parser.add_argument("--num_prompts", type=int, default=256, help="Number of prompts to route per run")
+    parser.add_argument("--batch_size", type=int, default=16, help="Batch size for both batching modes")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed runs per batching mode (best is reported)")
+    return parser.parse_args()
+
+
+def load_prompts(prompts_file, num_prompts, seed=42):
+    prompts = SAMPLE_PROMPTS if prompts_file is None else load_jsonl_texts(prompts_file)
+    rng = random.Random(seed)
+    return [rng.choice(prompts) for _ in range(num_prompts)]
+
+
+def time_batching(model, prompts, tokenizer_name, batch_size, batching, repeats):
+    dataset = InferenceDataset(
+        prompts, tokenizer_name=tokenizer_name, dynamic_padding=(batching == "bucketed")
+    )
+    loader = get_data_loader(dataset, batch_size=batch_size, batching=batching)
+    best_elapsed, preds = float("inf"), None
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        preds = infer(model, loader)
+        best_elapsed = min(best_elapsed, time.perf_counter() - t0)
+    return {
+        "batching": batching,
+        "num_prompts": len(prompts),
+        "batch_size": batch_size,
+        "seconds": best_elapsed,
+        "prompts_per_sec": len(prompts) / best_elapsed,
+        "mean_tokens_per_prompt": sum(dataset.lengths()) / len(prompts),
+    }, preds
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    save_directory = os.path.join(os.getcwd(), args.model_save_dir)
+    model = BertForSequenceClassification.from_pretrained(save_directory)
+    model.to(device)
+    model.eval()
+
+    prompts = load_prompts(args.prompts_file, args.num_prompts)
+    results = {}
+    for batching in ["fixed", "bucketed"]:
+        results[batching], preds = time_batching(
+            model, prompts, args.hf_model_name, args.batch_size, batching, args.repeats
+        )
+        results[batching]["predictions"] = preds
+
+    fixed_preds = results["fixed"].pop("predictions")
+    bucketed_preds = results["bucketed"].pop("predictions")
+    mismatches = sum(int(a != b) for a, b in zip(fixed_preds, bucketed_preds))
+    for res in results.values():
+        print(json.dumps(res))
+    speedup = results["fixed"]["seconds"] / results["bucketed"]["seconds"]
+    print(f"bucketed vs fixed-512 speedup: {speedup:.2f}x, prediction mismatches: {mismatches}/{len(prompts)}")
@@ -0,0 +1,310 @@
+import argparse
+import importlib.util
+import itertools
+import json
+import os
+import platform
+import re
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from transformers import AutoTokenizer, BertConfig, BertForSequenceClassification, BertTokenizerFast
+
+from benchmark_batching import SAMPLE_PROMPTS
+from run_gradio_model import device, get_probs, infer_batch, infer_single
+from run_model import InferenceDataset, get_data_loader, infer
+
+ID2LABEL = {0: "ROUTE_TO_INFERIOR", 1: "ROUTE_TO_SUPERIOR"}
+# fields identifying a benchmark case, used to match results against a baseline
+CASE_KEYS = ["bench", "backend", "batching", "batch_size", "prompt_words", "threads"]
+
+
+def make_offline_tokenizer(out_dir, texts=SAMPLE_PROMPTS):
+    # WordPiece tokenizer with a vocabulary built from `texts` (their words plus single characters),
+    # so that the benchmark runs without downloading `bert-base-uncased`
+    words = sorted({w for t in texts for w in re.findall(r"\w+|[^\w\s]", t.lower())})
+    chars = sorted({c for t in texts for c in t.lower() if not c.isspace()})
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + chars + [f"##{c}" for c in chars] + words
+    os.makedirs(out_dir, exist_ok=True)
+    vocab_file = os.path.join(out_dir, "vocab.txt")
+    with open(vocab_file, "w") as fp:
+        fp.write("\n".join(dict.fromkeys(vocab)) + "\n")
+    tokenizer = BertTokenizerFast(vocab_file=vocab_file, do_lower_case=True)
+    tokenizer.save_pretrained(out_dir)
+    return tokenizer
+
+
+def make_tiny_model(vocab_size, num_layers=2, hidden_size=128, num_heads=2, seed=0):
+    # randomly initialized router with the same architecture as the fine-tuned one, only smaller;
+    # latencies are not the production ones but regressions in the code paths show up all the same
+    torch.manual_seed(seed)
+    config = BertConfig(
+        vocab_size=vocab_size,
+        hidden_size=hidden_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=num_heads,
+        intermediate_size=4 * hidden_size,
+        num_labels=2,
+        id2label=ID2LABEL,
+        label2id={v: k for k, v in ID2LABEL.items()},
+    )
+    return BertForSequenceClassification(config).eval()
+
+
+def make_prompts(num_prompts, num_words, seed=0):
+    # prompts of exactly `num_words` words, drawn from the sample prompts
+    words = " ".join(SAMPLE_PROMPTS).split()
+    rng = np.random.default_rng(seed)
+    starts = rng.integers(0, len(words), size=num_prompts)
+    return [" ".join(words[(s + i) % len(words)] for i in range(num_words)) for s in starts]
+
+
+def latency_stats(latencies, num_prompts):
+    latencies_ms = np.asarray(latencies) * 1000
+    total = latencies_ms.sum() / 1000
+    return {
+        "num_calls": len(latencies_ms),
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "mean_ms": float(latencies_ms.mean()),
+        "prompts_per_sec": num_prompts / total if total > 0 else 0.0,
+    }
+
+
+class TimedLoader:
+    # wraps a data loader and records, per batch, the time from fetching it to the request for the next
+    # one, i.e. collation plus whatever the consumer (`infer`) does with the batch
+    def __init__(self, loader):
+        self.loader = loader
+        self.latencies = []
+
+    def __iter__(self):
+        t0 = time.perf_counter()
+        for batch in self.loader:
+            yield batch
+            t1 = time.perf_counter()
+            self.latencies.append(t1 - t0)
+            t0 = t1
+
+
+def bench_calls(fn, inputs, warmup):
+    for x in inputs[:warmup]:
+        fn(x)
+    latencies = []
+    for x in inputs:
+        t0 = time.perf_counter()
+        fn(x)
+        latencies.append(time.perf_counter() - t0)
+    return latencies
+
+
+def run_case(case, model, tokenizer, tokenizer_dir, prompts, warmup):
+    bench, batch_size = case["bench"], case["batch_size"]
+    if bench == "get_probs":
+        latencies = bench_calls(lambda t: get_probs(t, model=model, tokenizer=tokenizer), prompts, warmup)
+    elif bench == "infer_single":
+        latencies = bench_calls(
+            lambda t: infer_single(t, model=model, tokenizer=tokenizer, id2label=ID2LABEL), prompts, warmup
+        )
+    elif bench == "infer_batch":
+        batches = [prompts[i:i + batch_size] for i in range(0, len(prompts), batch_size)]
+        latencies = bench_calls(
+            lambda b: infer_batch(b, model=model, tokenizer=tokenizer, id2label=ID2LABEL), batches, warmup
+        )
+    elif bench == "run_model.infer":
+        dataset = InferenceDataset(
+            prompts, tokenizer_name=tokenizer_dir, dynamic_padding=(case["batching"] == "bucketed")
+        )
+        loader = get_data_loader(dataset, batch_size=batch_size, batching=case["batching"])
+        infer(model, loader)  # warmup
+        timed = TimedLoader(loader)
+        infer(model, timed)
+        latencies = timed.latencies
+    else:
+        raise ValueError(f"unknown bench: {bench}")
+    return {**case, **latency_stats(latencies, len(prompts))}
+
+
+def iter_cases(args, backends):
+    for backend, threads, prompt_words in itertools.product(backends, args.threads, args.prompt_words):
+        common = {"backend": backend, "prompt_words": prompt_words, "threads": threads}
+        if "get_probs" in args.benches:
+            yield {"bench": "get_probs", "batching": "max_length", "batch_size": 1, **common}
+        if "infer_single" in args.benches:
+            yield {"bench": "infer_single", "batching": "max_length", "batch_size": 1, **common}
+        for batch_size in args.batch_sizes:
+            if "infer_batch" in args.benches:
+                yield {"bench": "infer_batch", "batching": "longest", "batch_size": batch_size, **common}
+            if "run_model.infer" in args.benches:
+                for batching in args.batching:
+                    yield {"bench": "run_model.infer", "batching": batching, "batch_size": batch_size, **common}
+
+
+def case_key(result):
+    return tuple(result[k] for k in CASE_KEYS)
+
+
+def compare_to_baseline(results, baseline_results, tolerance):
+    # a case regresses when its p50 latency grows, or its throughput drops, by more than `tolerance`
+    baseline = {case_key(r): r for r in baseline_results}
+    comparisons = []
+    for r in results:
+        b = baseline.get(case_key(r))
+        if b is None:
+            continue
+        p50_ratio = r["p50_ms"] / b["p50_ms"] if b["p50_ms"] > 0 else float("inf")
+        throughput_ratio = r["prompts_per_sec"] / b["prompts_per_sec"] if b["prompts_per_sec"] > 0 else 0.0
+        comparisons.append(
+            {
+                **{k: r[k] for k in CASE_KEYS},
+                "p50_ratio": p50_ratio,
+                "throughput_ratio": throughput_ratio,
+                "regression": bool(p50_ratio > 1 + tolerance or throughput_ratio < 1 / (1 + tolerance)),
+            }
+        )
+    return comparisons
+
+
+def environment_info(model):
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "torch": torch.__version__,
+        "device": device,
+        "cpu_count": os.cpu_count(),
+        "model": {
+            k: getattr(model.config, k)
+            for k in ["num_hidden_layers", "hidden_size", "num_attention_heads", "vocab_size"]
+        }
+        if hasattr(model, "config")
+        else {},
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_save_dir",
+        type=str,
+        default=None,
+        help="Fine-tuned router (used `model.save_pretrained(...)`), defaults to a randomly initialized tiny BERT",
+    )
+    parser.add_argument(
+        "--hf_model_name",
+        type=str,
+        default=None,
+        help="The tokenizer name in hugging face, defaults to an offline tokenizer built from sample prompts",
+    )
+    parser.add_argument(
+        "--onnx_dir",
+        type=str,
+        default=None,
+        help="Output of `onnx_backend.py` for the onnx backend, exported on the fly from the torch model if not set",
+    )
+    parser.add_argument("--tiny_layers", type=int, default=2, help="Layers of the random tiny BERT")
+    parser.add_argument("--tiny_hidden_size", type=int, default=128, help="Hidden size of the random tiny BERT")
+    parser.add_argument(
+        "--benches",
+        type=str,
+        nargs="+",
+        default=["get_probs", "infer_single", "infer_batch", "run_model.infer"],
+        choices=["get_probs", "infer_single", "infer_batch", "run_model.infer"],
+    )
+    parser.add_argument(
+        "--backends",
+        type=str,
+        nargs="+",
+        default=None,
+        choices=["torch", "onnx"],
+        help="Defaults to torch, plus onnx when onnxruntime is installed",
+    )
+    parser.add_argument("--batching", type=str, nargs="+", default=["fixed", "bucketed"], choices=["fixed", "bucketed"])
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--prompt_words", type=int, nargs="+", default=[16, 64, 256], help="Prompt lengths in words")
+    parser.add_argument("--threads", type=int, nargs="+", default=None, help="Intra-op threads, defaults to 1 and all cores")
+    parser.add_argument("--num_prompts", type=int, default=64, help="Prompts routed per case")
+    parser.add_argument("--warmup", type=int, default=3, help="Untimed calls per case")
+    parser.add_argument("--out_file", type=str, default="benchmark_router.json", help="Results as JSON")
+    parser.add_argument("--baseline", type=str, default=None, help="Results of an earlier run to compare against")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.1, help="Relative slowdown vs the baseline reported as a regression"
+    )
+    parser.add_argument(
+        "--fail_on_regression", action="store_true", help="Exit with status 1 when any case regresses"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from onnx_backend import OnnxRouterModel, export_onnx
+
+    args = parse_args()
+    args.threads = args.threads or sorted({1, os.cpu_count() or 1})
+    backends = args.backends or ["torch"] + (["onnx"] if importlib.util.find_spec("onnxruntime") else [])
+    work_dir = tempfile.mkdtemp(prefix="benchmark_router-")
+
+    if args.hf_model_name is None:
+        tokenizer_dir = os.path.join(work_dir, "tokenizer")
+        tokenizer = make_offline_tokenizer(tokenizer_dir)
+    else:
+        tokenizer_dir = args.hf_model_name
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_dir)
+    if args.model_save_dir is None:
+        model_dir = os.path.join(work_dir, "model")
+        model = make_tiny_model(len(tokenizer), args.tiny_layers, args.tiny_hidden_size, seed=args.seed)
+        model.save_pretrained(model_dir)
+    else:
+        model_dir = os.path.join(os.getcwd(), args.model_save_dir)
+        model = BertForSequenceClassification.from_pretrained(model_dir).eval()
+    model.to(device)
+
+    onnx_dir = args.onnx_dir
+    if "onnx" in backends and onnx_dir is None:
+        onnx_dir = os.path.join(work_dir, "onnx")
+        try:
+            export_onnx(model_dir, onnx_dir)
+        except Exception as e:
+            print(f"skipping the onnx backend, export failed: {e!r}")
+            backends = [b for b in backends if b != "onnx"]
+
+    prompts = {n: make_prompts(args.num_prompts, n, seed=args.seed) for n in args.prompt_words}
+    results = []
+    for case in iter_cases(args, backends):
+        torch.set_num_threads(case["threads"])
+        if case["backend"] == "onnx":
+            # one session per thread count, intra-op threads are fixed when the session is created
+            case_model = OnnxRouterModel(onnx_dir, num_threads=case["threads"])
+        else:
+            case_model = model
+        result = run_case(case, case_model, tokenizer, tokenizer_dir, prompts[case["prompt_words"]], args.warmup)
+        results.append(result)
+        print(
+            f"{result['bench']:>16} {result['backend']:>5} {result['batching']:>10} bs={result['batch_size']:<3} "
+            f"words={result['prompt_words']:<4} threads={result['threads']:<2} "
+            f"p50={result['p50_ms']:8.2f}ms p95={result['p95_ms']:8.2f}ms p99={result['p99_ms']:8.2f}ms "
+            f"{result['prompts_per_sec']:9.1f} prompts/s"
+        )
+
+    report = {"environment": environment_info(model), "args": vars(args), "results": results}
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        report["comparison"] = compare_to_baseline(results, baseline["results"], args.tolerance)
+        regressions = [c for c in report["comparison"] if c["regression"]]
+        print(f"{len(report['comparison'])} cases compared to {args.baseline}, {len(regressions)} regressions")
+        for c in regressions:
+            print(
+                "REGRESSION " + " ".join(f"{k}={c[k]}" for k in CASE_KEYS)
+                + f" p50 x{c['p50_ratio']:.2f}, throughput x{c['throughput_ratio']:.2f}"
+            )
+    with open(args.out_file, "w") as fp:
+        json.dump(report, fp, indent=2)
+    print(f"results saved to {args.out_file}")
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
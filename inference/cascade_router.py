@@ -0,0 +1,247 @@
+import argparse
+import json
+import os
+import time
+
+import joblib
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import accuracy_score, precision_recall_fscore_support
+
+FIRST_STAGE_FILENAME = "first_stage.joblib"
+CASCADE_CONFIG_FILENAME = "cascade.json"
+
+
+class HashedNgramClassifier:
+    # cheap first stage: hashed word uni/bi-grams and character 3-5-grams, logistic regression on top
+    def __init__(self, n_features=2**20, C=4.0):
+        self.n_features = n_features
+        self.word_vectorizer = HashingVectorizer(
+            n_features=n_features, ngram_range=(1, 2), alternate_sign=False, norm="l2"
+        )
+        self.char_vectorizer = HashingVectorizer(
+            n_features=n_features, analyzer="char_wb", ngram_range=(3, 5), alternate_sign=False, norm="l2"
+        )
+        self.classifier = LogisticRegression(C=C, max_iter=1000)
+
+    def _features(self, texts):
+        return self.word_vectorizer.transform(texts) + self.char_vectorizer.transform(texts)
+
+    def fit(self, texts, targets):
+        self.classifier.fit(self._features(texts), targets)
+        return self
+
+    def predict_superior_proba(self, texts):
+        return self.classifier.predict_proba(self._features(texts))[:, 1]
+
+    # the vectorizers are stateless, only the fitted classifier is stored (as plain sklearn objects,
+    # so the file loads whether this module ran as a script or was imported)
+    def save(self, path):
+        joblib.dump({"n_features": self.n_features, "classifier": self.classifier}, path)
+
+    @classmethod
+    def load(cls, path):
+        state = joblib.load(path)
+        first_stage = cls(n_features=state["n_features"])
+        first_stage.classifier = state["classifier"]
+        return first_stage
+
+
+class CascadeRouter:
+    # Routes with the first stage when it is confident (p_superior <= low or >= high) and escalates
+    # the rest, in one batch, to the BERT router.
+    def __init__(self, first_stage, model, tokenizer, id2label, low=0.2, high=0.8):
+        self.first_stage = first_stage
+        self.model = model
+        self.tokenizer = tokenizer
+        self.id2label = id2label
+        self.low = low
+        self.high = high
+
+    def route_batch(self, texts):
+        # list of ({label: prob}, stage) in input order, with stage 1 (first stage) or 2 (BERT)
+        from run_gradio_model import infer_batch
+
+        p_superior = self.first_stage.predict_superior_proba(texts)
+        confident = (p_superior <= self.low) | (p_superior >= self.high)
+        results = [
+            ({self.id2label[0]: float(1 - p), self.id2label[1]: float(p)}, 1) if c else None
+            for p, c in zip(p_superior, confident)
+        ]
+        escalated = np.flatnonzero(~confident)
+        if len(escalated):
+            bert_results = infer_batch(
+                [texts[i] for i in escalated], model=self.model, tokenizer=self.tokenizer, id2label=self.id2label
+            )
+            for i, res in zip(escalated, bert_results):
+                results[i] = (res, 2)
+        return results
+
+    # same signatures as `infer_single` / `infer_batch` of `run_gradio_model.py`, so that the cascade
+    # can stand in for them (the model arguments are the cascade's own)
+    def infer_single_compat(self, text, model=None, tokenizer=None, id2label=None):
+        return self.route_batch([text])[0][0]
+
+    def infer_batch_compat(self, texts, model=None, tokenizer=None, id2label=None):
+        return [res for res, _ in self.route_batch(texts)]
+
+
+def save_cascade(out_dir, first_stage, low, high, report=None):
+    os.makedirs(out_dir, exist_ok=True)
+    first_stage.save(os.path.join(out_dir, FIRST_STAGE_FILENAME))
+    with open(os.path.join(out_dir, CASCADE_CONFIG_FILENAME), "w") as fp:
+        json.dump({"low": low, "high": high, "report": report or {}}, fp, indent=2)
+
+
+def load_cascade(cascade_dir, model, tokenizer, id2label):
+    first_stage = HashedNgramClassifier.load(os.path.join(cascade_dir, FIRST_STAGE_FILENAME))
+    with open(os.path.join(cascade_dir, CASCADE_CONFIG_FILENAME)) as fp:
+        config = json.load(fp)
+    return CascadeRouter(first_stage, model, tokenizer, id2label, low=config["low"], high=config["high"])
+
+
+def calibrate_thresholds(p_first, bert_preds, targets, max_accuracy_drop=0.0, num_candidates=101):
+    # Picks (low, high) that let the first stage handle the most prompts while the cascade accuracy
+    # stays within `max_accuracy_drop` of BERT-only accuracy on the calibration set.
+    p_first, bert_preds, targets = np.asarray(p_first), np.asarray(bert_preds), np.asarray(targets)
+    bert_accuracy = (bert_preds == targets).mean()
+    first_correct = (p_first >= 0.5).astype(int) == targets
+    bert_correct = bert_preds == targets
+    candidates = np.unique(np.quantile(p_first, np.linspace(0, 1, num_candidates)))
+    best = (0.0, -np.inf, np.inf)  # (coverage, low, high): nothing handled by the first stage
+    for low in np.concatenate([[-np.inf], candidates[candidates < 0.5]]):
+        for high in np.concatenate([[np.inf], candidates[candidates >= 0.5]]):
+            handled = (p_first <= low) | (p_first >= high)
+            accuracy = np.where(handled, first_correct, bert_correct).mean()
+            coverage = handled.mean()
+            if accuracy >= bert_accuracy - max_accuracy_drop - 1e-12 and coverage > best[0]:
+                best = (coverage, low, high)
+    _, low, high = best
+    # thresholds are inclusive, so infinities mean "never"
+    return float(low) if np.isfinite(low) else -1.0, float(high) if np.isfinite(high) else 2.0
+
+
+def get_metrics(targets, preds):
+    accuracy = accuracy_score(targets, preds)
+    precision, recall, f1, _ = precision_recall_fscore_support(targets, preds, average="binary", zero_division=0)
+    return {"accuracy": accuracy, "precision": precision, "recall": recall, "f1": f1}
+
+
+def evaluate_cascade(cascade, texts, targets, batch_size=32):
+    # stage fractions, per-stage latency (ms per prompt) and metrics of the cascade vs BERT only
+    from run_gradio_model import get_probs_batch
+
+    t0 = time.perf_counter()
+    p_first = cascade.first_stage.predict_superior_proba(texts)
+    first_ms = (time.perf_counter() - t0) * 1000 / len(texts)
+
+    t0 = time.perf_counter()
+    bert_probs = []
+    for start in range(0, len(texts), batch_size):
+        bert_probs.extend(get_probs_batch(texts[start:start + batch_size], cascade.model, cascade.tokenizer))
+    bert_ms = (time.perf_counter() - t0) * 1000 / len(texts)
+    bert_preds = np.asarray(bert_probs).argmax(axis=1)
+
+    handled = (p_first <= cascade.low) | (p_first >= cascade.high)
+    cascade_preds = np.where(handled, (p_first >= 0.5).astype(int), bert_preds)
+    cascade_ms = first_ms + bert_ms * (1 - handled.mean())
+    bert_metrics = get_metrics(targets, bert_preds)
+    cascade_metrics = get_metrics(targets, cascade_preds)
+    return {
+        "num_prompts": len(texts),
+        "low": cascade.low,
+        "high": cascade.high,
+        "first_stage_fraction": float(handled.mean()),
+        "bert_fraction": float(1 - handled.mean()),
+        "first_stage_ms_per_prompt": first_ms,
+        "bert_ms_per_prompt": bert_ms,
+        "cascade_ms_per_prompt": cascade_ms,
+        "bert_only": bert_metrics,
+        "cascade": cascade_metrics,
+        "first_stage_only": get_metrics(targets, (p_first >= 0.5).astype(int)),
+        "accuracy_cost": bert_metrics["accuracy"] - cascade_metrics["accuracy"],
+        "f1_cost": bert_metrics["f1"] - cascade_metrics["f1"],
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_save_dir",
+        type=str,
+        default="../models/bert-base-uncased-router-finetuning-20240722T133228-save",
+        help="The directory where the BERT model weights are stored (used `model.save_pretrained(...)`",
+    )
+    parser.add_argument(
+        "--hf_model_name",
+        type=str,
+        default="bert-base-uncased",
+        help="The tokenizer name in hugging face",
+    )
+    parser.add_argument(
+        "--train_file",
+        type=str,
+        default="../final-datasets/router_dataset_all.jsonl",
+        help="Labelled synthetic dataset used to train the first stage",
+    )
+    parser.add_argument(
+        "--test_file",
+        type=str,
+        default="../final-datasets/original_questions_labelled.jsonl",
+        help="Labelled questions used to calibrate the thresholds and to report the accuracy cost",
+    )
+    parser.add_argument(
+        "--max_accuracy_drop",
+        type=float,
+        default=0.0,
+        help="Accuracy (on the test file) the cascade may lose compared to BERT only",
+    )
+    parser.add_argument(
+        "--out_dir",
+        type=str,
+        default=None,
+        help="Where to save the first stage and thresholds, defaults to `<model_save_dir>-cascade`",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from transformers import AutoTokenizer, BertForSequenceClassification
+
+    from router_datasets import (
+        import_df_from_jsonl_file,
+        import_labelled_df,
+        process_questions_dataset,
+        process_synthetic_dataset,
+    )
+    from run_gradio_model import device, get_probs_batch
+
+    args = parse_args()
+    train_df = process_synthetic_dataset(import_labelled_df(args.train_file), make_balanced=True, max_length=250)
+    test_df = process_questions_dataset(import_df_from_jsonl_file(args.test_file))
+    test_texts, test_targets = test_df["text"].tolist(), test_df["target"].to_numpy()
+
+    first_stage = HashedNgramClassifier().fit(train_df["text"].tolist(), train_df["target"].to_numpy())
+
+    tokenizer = AutoTokenizer.from_pretrained(args.hf_model_name)
+    save_directory = os.path.join(os.getcwd(), args.model_save_dir)
+    model = BertForSequenceClassification.from_pretrained(save_directory)
+    model.to(device)
+    id2label = {0: "ROUTE_TO_INFERIOR", 1: "ROUTE_TO_SUPERIOR"}
+
+    bert_preds = np.concatenate(
+        [
+            np.asarray(get_probs_batch(test_texts[start:start + 32], model, tokenizer)).argmax(axis=1)
+            for start in range(0, len(test_texts), 32)
+        ]
+    )
+    low, high = calibrate_thresholds(
+        first_stage.predict_superior_proba(test_texts), bert_preds, test_targets, args.max_accuracy_drop
+    )
+    cascade = CascadeRouter(first_stage, model, tokenizer, id2label, low=low, high=high)
+    report = evaluate_cascade(cascade, test_texts, test_targets)
+    out_dir = args.out_dir or save_directory.rstrip("/") + "-cascade"
+    save_cascade(out_dir, first_stage, low, high, report=report)
+    print(json.dumps(report, indent=2))
+    print(f"saved the cascade to {out_dir}")
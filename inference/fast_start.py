@@ -0,0 +1,376 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+ARTIFACT_FILENAME = "router_artifact.json"
+TOKENIZER_FILENAME = "tokenizer.json"
+WEIGHTS_FILENAME = "weights.pt"
+CONFIG_KEYS = [
+    "vocab_size",
+    "hidden_size",
+    "num_hidden_layers",
+    "num_attention_heads",
+    "intermediate_size",
+    "hidden_act",
+    "max_position_embeddings",
+    "type_vocab_size",
+    "layer_norm_eps",
+]
+ACTIVATIONS = {"gelu": F.gelu, "gelu_new": lambda x: F.gelu(x, approximate="tanh"), "relu": F.relu}
+WARMUP_PROMPTS = ["Warm-up prompt to load the kernels before the first request.", "Hello"]
+
+
+class StartupTimer:
+    # durations of the startup phases, plus the process uptime when the app is ready (linux only)
+    def __init__(self, start=None):
+        self.start = self.last = start if start is not None else time.perf_counter()
+        self.phases = {}
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def report(self):
+        report = {f"{phase}_seconds": round(seconds, 4) for phase, seconds in self.phases.items()}
+        report["total_seconds"] = round(self.last - self.start, 4)
+        uptime = process_uptime()
+        if uptime is not None:
+            report["process_uptime_seconds"] = round(uptime, 3)
+        return report
+
+
+def process_uptime():
+    # seconds since this process was started, including interpreter startup and module imports
+    try:
+        with open("/proc/self/stat") as fp:
+            start_ticks = int(fp.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as fp:
+            system_uptime = float(fp.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+    return system_uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+class _Module(torch.nn.Module):
+    # container with the attribute names of the hugging face BERT modules, so the state dict of a
+    # `BertForSequenceClassification` loads as is
+    def __init__(self, children=None, **kwargs):
+        super().__init__()
+        for name, child in {**(children or {}), **kwargs}.items():
+            setattr(self, name, child)
+
+
+def _embedding(num_embeddings, embedding_dim):
+    # `_weight` skips the random initialization, whose lazy import of torch._dynamo on the meta
+    # device costs seconds
+    return torch.nn.Embedding(num_embeddings, embedding_dim, _weight=torch.empty(num_embeddings, embedding_dim))
+
+
+class _BertEncoder(torch.nn.Module):
+    # `model.bert(ids, attention_mask=mask)` returns (last hidden states, pooled output) as in transformers
+    def __init__(self, config):
+        super().__init__()
+        hidden, intermediate = config.hidden_size, config.intermediate_size
+        self.config = config
+        self.embeddings = _Module(
+            word_embeddings=_embedding(config.vocab_size, hidden),
+            position_embeddings=_embedding(config.max_position_embeddings, hidden),
+            token_type_embeddings=_embedding(config.type_vocab_size, hidden),
+            LayerNorm=torch.nn.LayerNorm(hidden, eps=config.layer_norm_eps),
+        )
+        layers = []
+        for _ in range(config.num_hidden_layers):
+            # `self` is the name of the attention projections in transformers
+            attention = _Module(
+                {
+                    "self": _Module(
+                        query=torch.nn.Linear(hidden, hidden),
+                        key=torch.nn.Linear(hidden, hidden),
+                        value=torch.nn.Linear(hidden, hidden),
+                    )
+                },
+                output=_Module(
+                    dense=torch.nn.Linear(hidden, hidden), LayerNorm=torch.nn.LayerNorm(hidden, eps=config.layer_norm_eps)
+                ),
+            )
+            layers.append(
+                _Module(
+                    attention=attention,
+                    intermediate=_Module(dense=torch.nn.Linear(hidden, intermediate)),
+                    output=_Module(
+                        dense=torch.nn.Linear(intermediate, hidden),
+                        LayerNorm=torch.nn.LayerNorm(hidden, eps=config.layer_norm_eps),
+                    ),
+                )
+            )
+        self.encoder = _Module(layer=torch.nn.ModuleList(layers))
+        self.pooler = _Module(dense=torch.nn.Linear(hidden, hidden))
+        self.activation = ACTIVATIONS[config.hidden_act]
+
+    def forward(self, input_ids, attention_mask=None, token_type_ids=None):
+        batch_size, seq_len = input_ids.shape
+        num_heads = self.config.num_attention_heads
+        head_dim = self.config.hidden_size // num_heads
+        if token_type_ids is None:
+            token_type_ids = torch.zeros_like(input_ids)
+        emb = self.embeddings
+        positions = torch.arange(seq_len, device=input_ids.device)
+        h = emb.word_embeddings(input_ids) + emb.position_embeddings(positions)[None] + emb.token_type_embeddings(token_type_ids)
+        h = emb.LayerNorm(h)
+        mask = None if attention_mask is None else attention_mask[:, None, None, :].bool()
+        for layer in self.encoder.layer:
+            attn = layer.attention.self
+            q, k, v = (
+                proj(h).view(batch_size, seq_len, num_heads, head_dim).transpose(1, 2)
+                for proj in (attn.query, attn.key, attn.value)
+            )
+            context = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+            context = context.transpose(1, 2).reshape(batch_size, seq_len, -1)
+            h = layer.attention.output.LayerNorm(layer.attention.output.dense(context) + h)
+            h = layer.output.LayerNorm(layer.output.dense(self.activation(layer.intermediate.dense(h))) + h)
+        pooled = torch.tanh(self.pooler.dense(h[:, 0]))
+        return h, pooled
+
+
+class RouterBert(torch.nn.Module):
+    # Inference-only `BertForSequenceClassification` in plain torch, so serving does not import
+    # transformers: `model(ids, token_type_ids=None, attention_mask=mask)[0]` returns the logits.
+    def __init__(self, config, name_or_path=""):
+        super().__init__()
+        self.config = config
+        self.name_or_path = name_or_path
+        self.bert = _BertEncoder(config)
+        self.dropout = torch.nn.Identity()
+        self.classifier = torch.nn.Linear(config.hidden_size, len(config.id2label))
+
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None):
+        _, pooled = self.bert(input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
+        return (self.classifier(pooled),)
+
+
+class FastTokenizer:
+    # The subset of the transformers tokenizer API used by the inference code, on top of the rust
+    # `tokenizers` library (which imports in milliseconds).
+    def __init__(self, tokenizer_file, special_tokens, model_max_length=512):
+        from tokenizers import Tokenizer
+
+        self.tokenizer = Tokenizer.from_file(tokenizer_file)
+        self.pad_token_id = special_tokens["pad_token_id"]
+        self.cls_token_id = special_tokens["cls_token_id"]
+        self.sep_token_id = special_tokens["sep_token_id"]
+        self.model_max_length = model_max_length
+
+    def __call__(
+        self,
+        text,
+        add_special_tokens=True,
+        max_length=None,
+        padding=False,
+        truncation=False,
+        return_attention_mask=True,
+        return_tensors=None,
+        **kwargs,
+    ):
+        texts = [text] if isinstance(text, str) else list(text)
+        if truncation:
+            self.tokenizer.enable_truncation(max_length or self.model_max_length)
+        else:
+            self.tokenizer.no_truncation()
+        ids = [e.ids for e in self.tokenizer.encode_batch(texts, add_special_tokens=add_special_tokens)]
+        if padding in (True, "longest"):
+            pad_to = max((len(i) for i in ids), default=0)
+        elif padding == "max_length":
+            pad_to = max_length or self.model_max_length
+        else:
+            pad_to = None
+        masks = [[1] * len(i) for i in ids]
+        if pad_to is not None:
+            masks = [m + [0] * (pad_to - len(m)) for m in masks]
+            ids = [i + [self.pad_token_id] * (pad_to - len(i)) for i in ids]
+        encoding = {"input_ids": ids}
+        if return_attention_mask:
+            encoding["attention_mask"] = masks
+        if return_tensors == "pt":
+            return {k: torch.tensor(v, dtype=torch.long) for k, v in encoding.items()}
+        if isinstance(text, str):
+            return {k: v[0] for k, v in encoding.items()}
+        return encoding
+
+    def encode_plus(self, text, **kwargs):
+        return self(text, **kwargs)
+
+
+def load_artifact(artifact_dir, timer=None):
+    # (model, tokenizer, id2label) of an artifact written by `export_artifact`; the weights are
+    # memory-mapped and assigned to a model built on the meta device (no random initialization)
+    timer = timer or StartupTimer()
+    with open(os.path.join(artifact_dir, ARTIFACT_FILENAME)) as fp:
+        artifact = json.load(fp)
+    tokenizer = FastTokenizer(
+        os.path.join(artifact_dir, TOKENIZER_FILENAME), artifact["special_tokens"], artifact["max_length"]
+    )
+    timer.mark("tokenizer")
+    config = SimpleNamespace(**artifact["config"])
+    config.id2label = {int(k): v for k, v in artifact["config"]["id2label"].items()}
+    state_dict = torch.load(os.path.join(artifact_dir, WEIGHTS_FILENAME), mmap=True, weights_only=True)
+    with torch.device("meta"):
+        model = RouterBert(config, name_or_path=os.path.abspath(artifact_dir))
+    model.load_state_dict(state_dict, assign=True)
+    model.eval()
+    for p in model.parameters():
+        p.requires_grad_(False)
+    timer.mark("weights")
+    return model, tokenizer, config.id2label
+
+
+def export_artifact(model_save_dir, tokenizer_name, out_dir, max_length=512, tolerance=1e-3):
+    # Writes the tokenizer, the config and the weights of a fine-tuned router into one directory,
+    # then checks that `RouterBert` + `FastTokenizer` reproduce the transformers logits.
+    from tokenizers import Tokenizer
+    from transformers import AutoTokenizer, BertForSequenceClassification
+
+    os.makedirs(out_dir, exist_ok=True)
+    hf_tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+    hf_model = BertForSequenceClassification.from_pretrained(model_save_dir).eval()
+    config = hf_model.config
+    if config.model_type != "bert" or config.hidden_act not in ACTIVATIONS:
+        raise ValueError(f"unsupported model: {config.model_type} with {config.hidden_act} activation")
+
+    backend = Tokenizer.from_str(hf_tokenizer.backend_tokenizer.to_str())
+    backend.no_truncation()
+    backend.no_padding()
+    backend.save(os.path.join(out_dir, TOKENIZER_FILENAME))
+    expected_keys = RouterBert(
+        SimpleNamespace(**{k: getattr(config, k) for k in CONFIG_KEYS}, id2label=config.id2label)
+    ).state_dict().keys()
+    state_dict = {k: v.contiguous() for k, v in hf_model.state_dict().items() if k in expected_keys}
+    torch.save(state_dict, os.path.join(out_dir, WEIGHTS_FILENAME))
+    artifact = {
+        "config": {**{k: getattr(config, k) for k in CONFIG_KEYS}, "id2label": config.id2label},
+        "special_tokens": {
+            "pad_token_id": hf_tokenizer.pad_token_id or 0,
+            "cls_token_id": hf_tokenizer.cls_token_id,
+            "sep_token_id": hf_tokenizer.sep_token_id,
+        },
+        "max_length": max_length,
+        "source": {"model_save_dir": os.path.abspath(model_save_dir), "tokenizer": tokenizer_name},
+    }
+    with open(os.path.join(out_dir, ARTIFACT_FILENAME), "w") as fp:
+        json.dump(artifact, fp, indent=2)
+
+    model, tokenizer, _ = load_artifact(out_dir)
+    prompts = WARMUP_PROMPTS + ["Write a detailed proof that there are infinitely many primes. " * 80]
+    ours = tokenizer(prompts, max_length=max_length, padding="longest", truncation=True, return_tensors="pt")
+    theirs = hf_tokenizer(prompts, max_length=max_length, padding="longest", truncation=True, return_tensors="pt")
+    if not torch.equal(ours["input_ids"], theirs["input_ids"]):
+        raise ValueError("the exported tokenizer does not reproduce the original token ids")
+    with torch.no_grad():
+        max_abs_diff = (
+            (model(ours["input_ids"], attention_mask=ours["attention_mask"])[0] - hf_model(**theirs).logits)
+            .abs()
+            .max()
+            .item()
+        )
+    if max_abs_diff > tolerance:
+        raise ValueError(f"exported model logits differ by {max_abs_diff:.2e} from the original model")
+    artifact["parity_max_abs_diff"] = max_abs_diff
+    with open(os.path.join(out_dir, ARTIFACT_FILENAME), "w") as fp:
+        json.dump(artifact, fp, indent=2)
+    return artifact
+
+
+def probe(mode, model_dir, tokenizer_name):
+    # child process of `measure_cold_start`: loads the router like the app would, routes one prompt
+    # and prints the phase timings
+    timer = StartupTimer()
+    from run_gradio_model import get_probs, get_probs_batch
+
+    timer.mark("imports")
+    if mode == "artifact":
+        model, tokenizer, _ = load_artifact(model_dir, timer)
+    else:
+        from transformers import AutoTokenizer, BertForSequenceClassification
+
+        timer.mark("imports")
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+        timer.mark("tokenizer")
+        model = BertForSequenceClassification.from_pretrained(model_dir).eval()
+        timer.mark("weights")
+    with torch.no_grad():
+        probs = get_probs(WARMUP_PROMPTS[0], model, tokenizer)
+    timer.mark("first_route")
+    get_probs_batch(WARMUP_PROMPTS, model, tokenizer)
+    timer.mark("warmup")
+    print(json.dumps({**timer.report(), "probs": probs}), flush=True)
+
+
+def measure_cold_start(model_dir, tokenizer_name, artifact_dir, repeats=3):
+    # median time to first route of fresh processes, measured from process creation by the parent
+    script = os.path.abspath(__file__)
+    results = {}
+    for mode, path in [("baseline", model_dir), ("artifact", artifact_dir)]:
+        runs = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            out = subprocess.run(
+                [sys.executable, script, "--probe", mode, "--model_save_dir", path, "--hf_model_name", tokenizer_name],
+                capture_output=True,
+                text=True,
+                check=True,
+                cwd=os.path.dirname(script),
+            )
+            elapsed = time.perf_counter() - t0
+            report = json.loads(out.stdout.strip().splitlines()[-1])
+            report["wall_seconds"] = elapsed
+            runs.append(report)
+        results[mode] = {
+            "median_wall_seconds": float(np.median([r["wall_seconds"] for r in runs])),
+            "median_time_to_first_route": float(
+                np.median([r["process_uptime_seconds"] - r["warmup_seconds"] for r in runs if "process_uptime_seconds" in r])
+            )
+            if all("process_uptime_seconds" in r for r in runs)
+            else None,
+            "runs": runs,
+        }
+    results["speedup"] = results["baseline"]["median_wall_seconds"] / results["artifact"]["median_wall_seconds"]
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_save_dir",
+        type=str,
+        default="../models/bert-base-uncased-router-finetuning-20240722T133228-save",
+        help="The directory where the BERT model weights are stored (used `model.save_pretrained(...)`",
+    )
+    parser.add_argument("--hf_model_name", type=str, default="bert-base-uncased", help="The tokenizer name in hugging face")
+    parser.add_argument("--out_dir", type=str, default=None, help="Defaults to `<model_save_dir>-artifact`")
+    parser.add_argument("--max_length", type=int, default=512, help="Maximum tokens per prompt")
+    parser.add_argument("--measure", action="store_true", help="Compare the cold start of both loading paths")
+    parser.add_argument("--repeats", type=int, default=3, help="Fresh processes per loading path with --measure")
+    parser.add_argument("--probe", type=str, default=None, choices=["baseline", "artifact"], help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.probe is not None:
+        probe(args.probe, args.model_save_dir, args.hf_model_name)
+        sys.exit(0)
+    save_directory = os.path.join(os.getcwd(), args.model_save_dir)
+    out_dir = args.out_dir or save_directory.rstrip("/") + "-artifact"
+    artifact = export_artifact(save_directory, args.hf_model_name, out_dir, max_length=args.max_length)
+    print(f"artifact written to {out_dir} (max logit difference {artifact['parity_max_abs_diff']:.2e})")
+    if args.measure:
+        results = measure_cold_start(save_directory, args.hf_model_name, out_dir, repeats=args.repeats)
+        print(json.dumps({k: v for k, v in results.items()}, indent=2))
@@ -0,0 +1,331 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+from run_gradio_model import device
+
+LOGITS_SUFFIX = ".logits.npy"
+META_SUFFIX = ".meta.json"
+# files whose content identifies a checkpoint (`save_pretrained`, `onnx_backend.py`, `fast_start.py`)
+WEIGHT_FILENAMES = ["model.safetensors", "pytorch_model.bin", "model_quantized.onnx", "model.onnx", "weights.pt"]
+
+
+def checkpoint_hash(model_dir):
+    # hash of the weight file contents, so the same weights copied elsewhere share their logits and
+    # a re-trained checkpoint saved to the same directory does not
+    paths = [os.path.join(model_dir, f) for f in WEIGHT_FILENAMES if os.path.exists(os.path.join(model_dir, f))]
+    if not paths:
+        raise FileNotFoundError(f"no weight file in {model_dir} (expected one of {WEIGHT_FILENAMES})")
+    digest = hashlib.sha256()
+    with open(paths[0], "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 24), b""):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def dataset_hash(texts, max_length):
+    return hashlib.sha256(json.dumps([max_length, list(texts)]).encode("utf-8")).hexdigest()[:16]
+
+
+class LogitStore:
+    # Per-prompt logits of one checkpoint on one dataset: row i of `<store_dir>/<checkpoint>/<dataset>.logits.npy`
+    # (float32, memory-mapped) holds the logits of prompt i, NaN until computed. `fill` only runs the
+    # rows still missing, so an interrupted fill resumes where it stopped.
+    def __init__(self, store_dir, checkpoint, texts, max_length=512, dataset_name=None):
+        self.texts = list(texts)
+        self.max_length = max_length
+        key = dataset_hash(self.texts, max_length)
+        self.dir = os.path.join(store_dir, checkpoint)
+        self.logits_path = os.path.join(self.dir, key + LOGITS_SUFFIX)
+        self.meta_path = os.path.join(self.dir, key + META_SUFFIX)
+        os.makedirs(self.dir, exist_ok=True)
+        if os.path.exists(self.logits_path):
+            self.logits = np.load(self.logits_path, mmap_mode="r+")
+        else:
+            tmp_path = self.logits_path[: -len(".npy")] + ".tmp.npy"
+            logits = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(len(self.texts), 2))
+            logits[:] = np.nan
+            logits.flush()
+            del logits
+            os.replace(tmp_path, self.logits_path)
+            self.logits = np.load(self.logits_path, mmap_mode="r+")
+        self.meta = {"checkpoint": checkpoint, "dataset": dataset_name, "num_rows": len(self.texts), "max_length": max_length}
+
+    def missing_rows(self):
+        return np.flatnonzero(np.isnan(self.logits).any(axis=1))
+
+    def is_complete(self):
+        return not len(self.missing_rows())
+
+    def fill(self, model, tokenizer, batch_size=64, flush_every=20):
+        # batched inference over the missing rows, longest prompts first (sorted by characters, so
+        # batches pad little); returns the number of rows computed
+        missing = self.missing_rows()
+        order = missing[np.argsort([-len(self.texts[i]) for i in missing], kind="stable")]
+        for num_batches, start in enumerate(range(0, len(order), batch_size), start=1):
+            rows = order[start:start + batch_size]
+            self.logits[rows] = compute_logits([self.texts[i] for i in rows], model, tokenizer, self.max_length)
+            if num_batches % flush_every == 0:
+                self.flush()
+        self.flush()
+        return len(missing)
+
+    def flush(self):
+        self.logits.flush()
+        with open(self.meta_path, "w") as fp:
+            json.dump({**self.meta, "num_filled": int(len(self.texts) - len(self.missing_rows()))}, fp, indent=2)
+
+
+def compute_logits(texts, model, tokenizer, max_length=512):
+    encoding = tokenizer(
+        list(texts),
+        add_special_tokens=True,
+        max_length=max_length,
+        padding="longest",
+        truncation=True,
+        return_attention_mask=True,
+        return_tensors="pt",
+    )
+    with torch.no_grad():
+        logits = model(
+            encoding["input_ids"].to(device), token_type_ids=None, attention_mask=encoding["attention_mask"].to(device)
+        )[0]
+    return logits.float().cpu().numpy()
+
+
+def superior_scores(logits, temperature=1.0):
+    # P(ROUTE_TO_SUPERIOR) of the (temperature-scaled) two-class softmax
+    return 1.0 / (1.0 + np.exp(-(logits[:, 1] - logits[:, 0]) / temperature))
+
+
+def threshold_sweep(scores, targets):
+    # Metrics of routing to the superior model when `score >= threshold`, for every distinct score at
+    # once: scores sorted in decreasing order, the cumulative sums give the confusion counts.
+    order = np.argsort(-scores, kind="stable")
+    sorted_scores, sorted_targets = scores[order], np.asarray(targets)[order]
+    last = np.flatnonzero(np.r_[sorted_scores[1:] != sorted_scores[:-1], True])  # last row of each distinct score
+    tp = np.cumsum(sorted_targets == 1)[last]
+    fp = np.cumsum(sorted_targets == 0)[last]
+    num_pos, n = int((sorted_targets == 1).sum()), len(sorted_targets)
+    tn = (n - num_pos) - fp
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 1.0)
+        recall = tp / num_pos if num_pos else np.zeros(len(tp))
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+    return {
+        "threshold": sorted_scores[last],
+        "precision": precision,
+        "recall": recall,
+        "f1": f1,
+        "accuracy": (tp + tn) / n,
+        "superior_call_rate": (tp + fp) / n,
+    }
+
+
+def best_threshold(sweep, max_superior_rate=None, min_recall=None):
+    # threshold of the best F1 among those meeting the constraints (None when none does)
+    ok = np.ones(len(sweep["threshold"]), dtype=bool)
+    if max_superior_rate is not None:
+        ok &= sweep["superior_call_rate"] <= max_superior_rate
+    if min_recall is not None:
+        ok &= sweep["recall"] >= min_recall
+    if not ok.any():
+        return None
+    i = np.flatnonzero(ok)[np.argmax(sweep["f1"][ok])]
+    return {k: float(v[i]) for k, v in sweep.items()}
+
+
+def metrics_at(scores, targets, threshold=0.5):
+    preds = scores >= threshold
+    targets = np.asarray(targets) == 1
+    tp, fp, fn = int((preds & targets).sum()), int((preds & ~targets).sum()), int((~preds & targets).sum())
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    return {
+        "accuracy": float((preds == targets).mean()),
+        "precision": precision,
+        "recall": recall,
+        "f1": 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+        "superior_call_rate": float(preds.mean()),
+    }
+
+
+def nll(logits, targets, temperatures):
+    # mean negative log-likelihood for every temperature at once (one column per temperature)
+    margin = (logits[:, 1] - logits[:, 0])[:, None] / np.asarray(temperatures)[None, :]
+    signed = np.where(np.asarray(targets)[:, None] == 1, margin, -margin)
+    return np.logaddexp(0.0, -signed).mean(axis=0)
+
+
+def fit_temperature(logits, targets, max_iter=50, tol=1e-8, min_temperature=0.05, max_temperature=100.0):
+    # temperature scaling: the T minimizing the NLL of softmax(logits / T). The NLL is convex in 1/T,
+    # so Newton's method on 1/T converges in a few vectorized passes. T is kept within bounds, as an
+    # uninformative checkpoint would otherwise drive it to infinity (every score 0.5).
+    signed = np.where(np.asarray(targets) == 1, 1.0, -1.0) * (logits[:, 1] - logits[:, 0])
+    inv_t = 1.0
+    for _ in range(max_iter):
+        p_wrong = 1.0 / (1.0 + np.exp(np.clip(signed * inv_t, -500, 500)))
+        grad = -(signed * p_wrong).mean()
+        hess = (signed**2 * p_wrong * (1.0 - p_wrong)).mean()
+        if hess <= 0:
+            break
+        new_inv_t = min(max(inv_t - grad / hess, inv_t / 10, 1.0 / max_temperature), 1.0 / min_temperature)
+        converged = abs(new_inv_t - inv_t) <= tol * inv_t
+        inv_t = new_inv_t
+        if converged:
+            break
+    return float(1.0 / inv_t), float(nll(logits, targets, [1.0 / inv_t])[0])
+
+
+def expected_calibration_error(scores, targets, num_bins=15):
+    # ECE of the predicted class confidence, in equal-width confidence bins
+    preds = scores >= 0.5
+    confidence = np.where(preds, scores, 1.0 - scores)
+    correct = preds == (np.asarray(targets) == 1)
+    bins = np.minimum(((confidence - 0.5) * 2 * num_bins).astype(int), num_bins - 1)
+    counts = np.bincount(bins, minlength=num_bins)
+    gaps = np.abs(np.bincount(bins, confidence, num_bins) - np.bincount(bins, correct, num_bins))
+    return float(gaps.sum() / max(counts.sum(), 1))
+
+
+def compare_checkpoints(scores_a, scores_b, targets, threshold=0.5):
+    # agreement of two checkpoints and the McNemar test on the prompts only one gets right
+    from scipy.stats import binomtest
+
+    targets = np.asarray(targets) == 1
+    correct_a, correct_b = (scores_a >= threshold) == targets, (scores_b >= threshold) == targets
+    only_a, only_b = int((correct_a & ~correct_b).sum()), int((~correct_a & correct_b).sum())
+    return {
+        "agreement": float(((scores_a >= threshold) == (scores_b >= threshold)).mean()),
+        "only_a_correct": only_a,
+        "only_b_correct": only_b,
+        "mcnemar_p_value": float(binomtest(only_a, only_a + only_b).pvalue) if only_a + only_b else 1.0,
+        "a": metrics_at(scores_a, targets, threshold),
+        "b": metrics_at(scores_b, targets, threshold),
+    }
+
+
+def downsample_curve(sweep, num_points=101):
+    # curve points at evenly spaced superior call rates, for reports and plots
+    idx = np.unique(np.searchsorted(sweep["superior_call_rate"], np.linspace(0, 1, num_points)).clip(0, len(sweep["threshold"]) - 1))
+    return {k: v[idx].round(6).tolist() for k, v in sweep.items()}
+
+
+def load_eval_file(path):
+    # (texts, targets) of a processed dataset (`text`, `target` columns, e.g. `valid_data.jsonl` of
+    # `train_router.py`) or of labelled questions (`question`, `label`)
+    from router_datasets import import_df_from_jsonl_file, process_questions_dataset
+
+    df = import_df_from_jsonl_file(path)
+    if "target" not in df.columns:
+        df = process_questions_dataset(df)
+    return df["text"].tolist(), df["target"].to_numpy()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_save_dirs",
+        type=str,
+        nargs="+",
+        default=["../models/bert-base-uncased-router-finetuning-20240722T133228-save"],
+        help="Checkpoints to evaluate (used `model.save_pretrained(...)`); the first two are compared",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="torch",
+        choices=["torch", "onnx", "artifact"],
+        help="Router backend, as in `run_gradio_model.py`",
+    )
+    parser.add_argument("--hf_model_name", type=str, default="bert-base-uncased", help="The tokenizer name in hugging face")
+    parser.add_argument(
+        "--calibration_file",
+        type=str,
+        default="../models/bert-base-uncased-router-finetuning-20240722T133228-save/valid_data.jsonl",
+        help="Dataset the temperature and the threshold are fit on",
+    )
+    parser.add_argument("--test_file", type=str, default="../final-datasets/original_questions_labelled.jsonl")
+    parser.add_argument("--store_dir", type=str, default="../logit_store")
+    parser.add_argument("--max_length", type=int, default=512, help="Maximum tokens per prompt")
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument(
+        "--max_superior_rate", type=float, default=None, help="Only consider thresholds calling the superior model less often"
+    )
+    parser.add_argument("--min_recall", type=float, default=None, help="Only consider thresholds with at least this recall")
+    parser.add_argument("--out_file", type=str, default="logit_store_report.json")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from onnx_backend import load_router_model
+
+    args = parse_args()
+    datasets = {"calibration": load_eval_file(args.calibration_file), "test": load_eval_file(args.test_file)}
+    tokenizer = None
+    report = {"checkpoints": {}}
+    test_scores = {}
+    for model_dir in args.model_save_dirs:
+        save_directory = os.path.join(os.getcwd(), model_dir)
+        checkpoint = checkpoint_hash(save_directory)
+        stores = {
+            name: LogitStore(args.store_dir, checkpoint, texts, args.max_length, dataset_name=name)
+            for name, (texts, _) in datasets.items()
+        }
+        t0 = time.perf_counter()
+        if not all(store.is_complete() for store in stores.values()):
+            # the model is only loaded when some logits are missing
+            if args.backend == "artifact":
+                from fast_start import load_artifact
+
+                model, tokenizer, _ = load_artifact(save_directory)
+            else:
+                if tokenizer is None:
+                    from transformers import AutoTokenizer
+
+                    tokenizer = AutoTokenizer.from_pretrained(args.hf_model_name)
+                model = load_router_model(save_directory, backend=args.backend)
+            model.to(device)
+            model.eval()
+            for store in stores.values():
+                store.fill(model, tokenizer, batch_size=args.batch_size)
+        fill_seconds = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        calib_logits, calib_targets = np.asarray(stores["calibration"].logits), datasets["calibration"][1]
+        test_logits, test_targets = np.asarray(stores["test"].logits), datasets["test"][1]
+        temperature, calib_nll = fit_temperature(calib_logits, calib_targets)
+        calib_sweep = threshold_sweep(superior_scores(calib_logits, temperature), calib_targets)
+        chosen = best_threshold(calib_sweep, args.max_superior_rate, args.min_recall)
+        scores = superior_scores(test_logits, temperature)
+        test_scores[model_dir] = scores
+        test_sweep = threshold_sweep(scores, test_targets)
+        analysis_seconds = time.perf_counter() - t0
+        report["checkpoints"][model_dir] = {
+            "checkpoint_hash": checkpoint,
+            "fill_seconds": fill_seconds,
+            "analysis_ms": analysis_seconds * 1000,
+            "temperature": temperature,
+            "calibration_nll": {"before": float(nll(calib_logits, calib_targets, [1.0])[0]), "after": calib_nll},
+            "test_ece": {
+                "before": expected_calibration_error(superior_scores(test_logits), test_targets),
+                "after": expected_calibration_error(scores, test_targets),
+            },
+            "chosen_threshold": chosen,
+            "test_at_0.5": metrics_at(scores, test_targets),
+            "test_at_chosen": metrics_at(scores, test_targets, chosen["threshold"]) if chosen else None,
+            "test_curve": downsample_curve(test_sweep),
+        }
+        summary = {k: v for k, v in report["checkpoints"][model_dir].items() if k != "test_curve"}
+        print(json.dumps({model_dir: summary}, indent=2))
+    if len(args.model_save_dirs) > 1:
+        a, b = args.model_save_dirs[:2]
+        report["comparison"] = compare_checkpoints(test_scores[a], test_scores[b], datasets["test"][1])
+        print(json.dumps({"comparison": report["comparison"]}, indent=2))
+    with open(args.out_file, "w") as fp:
+        json.dump(report, fp, indent=2)
@@ -0,0 +1,119 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from run_model import WINDOW_AGGREGATIONS, aggregate_window_probs, route_token_ids, tokenize_chunk
+
+
+class LongPromptRouter:
+    # Routes prompts longer than `max_length` tokens on overlapping windows instead of their first
+    # `max_length` tokens. The windows of all prompts of a call go through the model together (in
+    # length-bucketed batches of `batch_size` windows); each prompt contributes at most `max_windows`
+    # windows, so a pasted document costs at most `max_windows` short prompts.
+    def __init__(
+        self, model, tokenizer, id2label, max_length=512, stride=128, max_windows=8, aggregation="mean", batch_size=32
+    ):
+        if aggregation not in WINDOW_AGGREGATIONS:
+            raise ValueError(f"unknown aggregation: {aggregation}, expected one of {WINDOW_AGGREGATIONS}")
+        self.model = model
+        self.tokenizer = tokenizer
+        self.id2label = id2label
+        self.max_length = max_length
+        self.stride = stride
+        self.max_windows = max_windows
+        self.aggregation = aggregation
+        self.batch_size = batch_size
+
+    def route_probs(self, texts):
+        # (probabilities per prompt, number of windows per prompt)
+        windows, owners = tokenize_chunk(
+            texts, self.max_length, tokenizer=self.tokenizer, stride=self.stride, max_windows=self.max_windows
+        )
+        window_probs = route_token_ids(
+            self.model, windows, self.batch_size, pad_token_id=self.tokenizer.pad_token_id or 0
+        )
+        probs = aggregate_window_probs(window_probs, owners, len(texts), self.aggregation)
+        return probs, np.bincount(owners, minlength=len(texts))
+
+    def route_batch(self, texts):
+        probs, _ = self.route_probs(texts)
+        return [{label: float(p[i]) for i, label in self.id2label.items()} for p in probs]
+
+    # same signatures as `infer_single` / `infer_batch` of `run_gradio_model.py`
+    def infer_single_compat(self, text, model=None, tokenizer=None, id2label=None):
+        return self.route_batch([text])[0]
+
+    def infer_batch_compat(self, texts, model=None, tokenizer=None, id2label=None):
+        return self.route_batch(texts)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_save_dir",
+        type=str,
+        default="../models/bert-base-uncased-router-finetuning-20240722T133228-save",
+        help="The directory where the BERT model weights are stored (used `model.save_pretrained(...)`",
+    )
+    parser.add_argument("--hf_model_name", type=str, default="bert-base-uncased", help="The tokenizer name in hugging face")
+    parser.add_argument(
+        "--input_file",
+        type=str,
+        default="../final-datasets/router_dataset_all.jsonl",
+        help="JSONL prompts (`text`, `initial_prompt` or `question` field)",
+    )
+    parser.add_argument("--stride", type=int, default=128, help="Tokens shared by consecutive windows")
+    parser.add_argument("--max_windows", type=int, default=8, help="Maximum number of windows routed per prompt")
+    parser.add_argument("--batch_size", type=int, default=32, help="Windows per forward pass")
+    parser.add_argument("--out_file", type=str, default=None, help="Optional JSON file for the report")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    # compares truncation with every aggregation on the long prompts of `--input_file`
+    from transformers import AutoTokenizer
+
+    from onnx_backend import load_router_model
+    from run_model import device, load_jsonl_texts
+
+    args = parse_args()
+    tokenizer = AutoTokenizer.from_pretrained(args.hf_model_name)
+    model = load_router_model(os.path.join(os.getcwd(), args.model_save_dir))
+    model.to(device)
+    model.eval()
+    id2label = {0: "ROUTE_TO_INFERIOR", 1: "ROUTE_TO_SUPERIOR"}
+
+    texts = [t or "" for t in load_jsonl_texts(args.input_file)]
+    lengths = [len(ids) for ids in tokenizer(texts, add_special_tokens=True, verbose=False)["input_ids"]]
+    long_texts = [t for t, n in zip(texts, lengths) if n > 512]
+    report = {"num_prompts": len(texts), "num_long_prompts": len(long_texts), "max_tokens": max(lengths)}
+    if long_texts:
+        truncated = route_token_ids(model, tokenize_chunk(long_texts, tokenizer=tokenizer), args.batch_size)
+        report["aggregations"] = {}
+        for aggregation in WINDOW_AGGREGATIONS:
+            router = LongPromptRouter(
+                model,
+                tokenizer,
+                id2label,
+                stride=args.stride,
+                max_windows=args.max_windows,
+                aggregation=aggregation,
+                batch_size=args.batch_size,
+            )
+            t0 = time.perf_counter()
+            probs, num_windows = router.route_probs(long_texts)
+            elapsed = time.perf_counter() - t0
+            report["aggregations"][aggregation] = {
+                "superior_fraction": float((probs.argmax(axis=1) == 1).mean()),
+                "changed_vs_truncation": float((probs.argmax(axis=1) != truncated.argmax(axis=1)).mean()),
+                "mean_windows_per_prompt": float(num_windows.mean()),
+                "ms_per_prompt": elapsed * 1000 / len(long_texts),
+            }
+        report["truncation_superior_fraction"] = float((truncated.argmax(axis=1) == 1).mean())
+    print(json.dumps(report, indent=2))
+    if args.out_file is not None:
+        with open(args.out_file, "w") as fp:
+            json.dump(report, fp, indent=2)
@@ -0,0 +1,176 @@
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+
+ONNX_FP32_FILENAME = "model.onnx"
+ONNX_INT8_FILENAME = "model_quantized.onnx"
+
+
+class OnnxRouterModel:
+    # Drop-in replacement for `BertForSequenceClassification` in `get_probs`, `infer_single` and `infer`:
+    # `model(ids, token_type_ids=None, attention_mask=mask)[0]` returns the logits as a torch tensor.
+    def __init__(self, onnx_dir, filename=ONNX_INT8_FILENAME, num_threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.name_or_path = os.path.join(onnx_dir, filename)
+        self.session = ort.InferenceSession(self.name_or_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        with open(os.path.join(onnx_dir, "config.json")) as fp:
+            config = json.load(fp)
+        self.id2label = {int(k): v for k, v in config.get("id2label", {}).items()}
+
+    def __call__(self, input_ids, token_type_ids=None, attention_mask=None):
+        feed = {
+            "input_ids": input_ids.cpu().numpy().astype(np.int64),
+            "attention_mask": attention_mask.cpu().numpy().astype(np.int64),
+        }
+        if "token_type_ids" in self.input_names:
+            if token_type_ids is None:
+                token_type_ids = torch.zeros_like(input_ids)
+            feed["token_type_ids"] = token_type_ids.cpu().numpy().astype(np.int64)
+        (logits,) = self.session.run(["logits"], feed)
+        return (torch.from_numpy(logits),)
+
+    # no-ops, so callers can treat both backends the same way
+    def to(self, device):
+        return self
+
+    def eval(self):
+        return self
+
+
+def load_router_model(model_dir, backend="torch", num_threads=None):
+    if backend == "torch":
+        from transformers import BertForSequenceClassification
+
+        return BertForSequenceClassification.from_pretrained(model_dir)
+    if backend == "onnx":
+        return OnnxRouterModel(model_dir, num_threads=num_threads)
+    if backend == "artifact":
+        from fast_start import load_artifact
+
+        return load_artifact(model_dir)[0]
+    raise ValueError(f"unknown backend: {backend}")
+
+
+def export_onnx(model_save_dir, onnx_dir, opset_version=17, quantize=True):
+    # exports a `save_pretrained` directory to `onnx_dir/model.onnx` and, optionally, an int8
+    # dynamically quantized `onnx_dir/model_quantized.onnx` (weights in int8, activations quantized at runtime)
+    from transformers import BertForSequenceClassification
+
+    os.makedirs(onnx_dir, exist_ok=True)
+    model = BertForSequenceClassification.from_pretrained(model_save_dir)
+    model.eval()
+    model.config.return_dict = False
+
+    dummy_ids = torch.ones((2, 16), dtype=torch.long)
+    dummy_mask = torch.ones((2, 16), dtype=torch.long)
+    dummy_types = torch.zeros((2, 16), dtype=torch.long)
+    fp32_path = os.path.join(onnx_dir, ONNX_FP32_FILENAME)
+    torch.onnx.export(
+        model,
+        (dummy_ids, dummy_mask, dummy_types),
+        fp32_path,
+        input_names=["input_ids", "attention_mask", "token_type_ids"],
+        output_names=["logits"],
+        dynamic_axes={
+            "input_ids": {0: "batch", 1: "sequence"},
+            "attention_mask": {0: "batch", 1: "sequence"},
+            "token_type_ids": {0: "batch", 1: "sequence"},
+            "logits": {0: "batch"},
+        },
+        opset_version=opset_version,
+        do_constant_folding=True,
+    )
+    shutil.copy(os.path.join(model_save_dir, "config.json"), os.path.join(onnx_dir, "config.json"))
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantize_dynamic(
+            fp32_path,
+            os.path.join(onnx_dir, ONNX_INT8_FILENAME),
+            weight_type=QuantType.QInt8,
+        )
+    return onnx_dir
+
+
+def check_parity(reference_model, candidate_model, tokenizer, texts, batch_size=32, max_length=512):
+    # route disagreement rate and max |prob delta| of `candidate_model` against `reference_model`
+    from run_gradio_model import get_probs_batch
+
+    ref_probs, cand_probs = [], []
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
+        ref_probs.extend(get_probs_batch(batch, reference_model, tokenizer, max_length=max_length))
+        cand_probs.extend(get_probs_batch(batch, candidate_model, tokenizer, max_length=max_length))
+    ref_probs, cand_probs = np.asarray(ref_probs), np.asarray(cand_probs)
+    disagreements = ref_probs.argmax(axis=1) != cand_probs.argmax(axis=1)
+    return {
+        "num_prompts": len(texts),
+        "disagreement_rate": float(disagreements.mean()) if len(texts) else 0.0,
+        "num_disagreements": int(disagreements.sum()),
+        "max_prob_delta": float(np.abs(ref_probs - cand_probs).max()) if len(texts) else 0.0,
+        "mean_prob_delta": float(np.abs(ref_probs - cand_probs).mean()) if len(texts) else 0.0,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_save_dir",
+        type=str,
+        default="../models/bert-base-uncased-router-finetuning-20240722T133228-save",
+        help="The directory where the BERT model weights are stored (used `model.save_pretrained(...)`",
+    )
+    parser.add_argument(
+        "--onnx_dir",
+        type=str,
+        default=None,
+        help="Output directory of the ONNX graphs, defaults to `<model_save_dir>-onnx`",
+    )
+    parser.add_argument(
+        "--hf_model_name",
+        type=str,
+        default="bert-base-uncased",
+        help="The tokenizer name in hugging face",
+    )
+    parser.add_argument(
+        "--parity_file",
+        type=str,
+        default=None,
+        help="Held-out JSONL (e.g. `original_questions_labelled.jsonl`) for the accuracy-parity check",
+    )
+    parser.add_argument("--no_quantize", action="store_true", help="Only export the fp32 graph")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from transformers import AutoTokenizer, BertForSequenceClassification
+
+    from run_model import load_jsonl_texts
+
+    args = parse_args()
+    model_save_dir = os.path.join(os.getcwd(), args.model_save_dir)
+    onnx_dir = args.onnx_dir or model_save_dir.rstrip("/") + "-onnx"
+    export_onnx(model_save_dir, onnx_dir, quantize=not args.no_quantize)
+    print(f"exported ONNX graphs to {onnx_dir}")
+
+    if args.parity_file is not None:
+        tokenizer = AutoTokenizer.from_pretrained(args.hf_model_name)
+        torch_model = BertForSequenceClassification.from_pretrained(model_save_dir)
+        torch_model.eval()
+        texts = load_jsonl_texts(args.parity_file)
+        filenames = [ONNX_FP32_FILENAME] if args.no_quantize else [ONNX_FP32_FILENAME, ONNX_INT8_FILENAME]
+        for filename in filenames:
+            onnx_model = OnnxRouterModel(onnx_dir, filename=filename)
+            parity = check_parity(torch_model, onnx_model, tokenizer, texts)
+            print(json.dumps({"graph": filename, **parity}))
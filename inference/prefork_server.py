@@ -0,0 +1,355 @@
+import argparse
+import gc
+import glob
+import hashlib
+import itertools
+import json
+import multiprocessing as mp
+import multiprocessing.connection
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from run_gradio_model import infer_batch
+
+MMAP_WEIGHTS_DIR = os.path.join(os.path.expanduser("~"), ".cache", "llm-router", "mmap_weights")
+
+
+def mmap_weights_path(model, mmap_dir):
+    # `<checkpoint path hash>-<weights identity>.pt`: a checkpoint re-saved in place gets a new file
+    # (its files' size/mtime change), and the files of its older weights are removed
+    from route_cache import get_model_identity
+
+    path_key = hashlib.sha256(os.path.realpath(model.name_or_path).encode("utf-8")).hexdigest()[:16]
+    path = os.path.join(mmap_dir, f"{path_key}-{get_model_identity(model)}.pt")
+    for old_path in glob.glob(os.path.join(mmap_dir, f"{path_key}-*.pt")):
+        if old_path != path:
+            os.remove(old_path)
+    return path
+
+
+def load_shared_model(model_dir, mmap_weights=False, mmap_dir=None):
+    # Loads the router once in the front process; forked workers then share its weights.
+    # With `mmap_weights`, the weights are re-saved once as a torch file in `mmap_dir` (a cache
+    # outside the checkpoint by default) and memory-mapped, so they live in the page cache (clean,
+    # file-backed pages) instead of anonymous memory of the front process.
+    from transformers import BertForSequenceClassification
+
+    model = BertForSequenceClassification.from_pretrained(model_dir)
+    if mmap_weights:
+        mmap_dir = mmap_dir or MMAP_WEIGHTS_DIR
+        os.makedirs(mmap_dir, exist_ok=True)
+        path = mmap_weights_path(model, mmap_dir)
+        if not os.path.exists(path):
+            # written under a temporary name first, so an interrupted save is never memory-mapped
+            tmp_path = f"{path}.tmp"
+            torch.save(model.state_dict(), tmp_path)
+            os.replace(tmp_path, path)
+        state_dict = torch.load(path, mmap=True, weights_only=True)
+        model.load_state_dict(state_dict, assign=True)
+    model.eval()
+    for p in model.parameters():
+        p.requires_grad_(False)
+    return model
+
+
+def split_cores(num_workers, cores=None):
+    # contiguous, disjoint core sets, one per worker (workers share cores if there are more workers than cores)
+    cores = sorted(cores if cores is not None else os.sched_getaffinity(0))
+    if num_workers >= len(cores):
+        return [[cores[i % len(cores)]] for i in range(num_workers)]
+    return [[int(c) for c in chunk] for chunk in np.array_split(cores, num_workers)]
+
+
+def _worker_main(worker_id, model, tokenizer, id2label, cores, num_threads, requests, results):
+    # the model and tokenizer are inherited from the front process through fork, not pickled
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(num_threads)
+    while True:
+        item = requests.get()
+        if item is None:
+            break
+        request_id, texts = item
+        try:
+            res = infer_batch(texts, model=model, tokenizer=tokenizer, id2label=id2label)
+            results.send((request_id, res, None))
+        except Exception as e:
+            results.send((request_id, None, repr(e)))
+
+
+class PreforkRouter:
+    # Forks `num_workers` processes from the front process after the model is loaded, so all workers
+    # share the weight pages copy-on-write (`gc.freeze()` keeps the garbage collector from touching,
+    # and thus copying, the objects inherited from the front process). Each worker is pinned to its own
+    # cores with a matching intra-op thread count, so replicas do not oversubscribe the CPU. `route` sends
+    # a request to the worker with the fewest requests in flight.
+    # Every worker has its own request queue and result pipe, so a worker killed while holding one of
+    # their locks cannot block the others. The collector thread also waits on the workers' process
+    # sentinels: when a worker dies (OOM kill, segfault), the requests it had in flight fail with a
+    # `RuntimeError` and it is forked again. `route` / `route_batch` wait at most `timeout` seconds.
+    # The front process must not run inference, before or after the workers are forked: OpenMP thread
+    # pools do not survive a fork.
+    def __init__(
+        self, model, tokenizer, id2label, num_workers=None, threads_per_worker=None, pin_cores=True, timeout=60.0
+    ):
+        if hasattr(os, "sched_getaffinity"):
+            cores = sorted(os.sched_getaffinity(0))
+        else:
+            cores = list(range(os.cpu_count() or 1))
+        self.num_workers = num_workers or len(cores)
+        core_sets = split_cores(self.num_workers, cores)
+        self.ctx = mp.get_context("fork")
+        self.requests = [None] * self.num_workers
+        self.results = [None] * self.num_workers
+        self.workers = [None] * self.num_workers
+        self.in_flight = [0] * self.num_workers
+        self.futures = {}  # request id -> (future, worker id)
+        self.request_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.timeout = timeout
+        self.closing = False
+        self.restarts = 0
+        self.stop_reader, self.stop_writer = self.ctx.Pipe(duplex=False)
+
+        self.model, self.tokenizer, self.id2label = model, tokenizer, id2label
+        self.core_sets = [core_set if pin_cores else None for core_set in core_sets]
+        self.threads = [threads_per_worker or len(core_set) for core_set in core_sets]
+        gc.collect()
+        gc.freeze()
+        for i in range(self.num_workers):
+            self._start_worker(i)
+        gc.unfreeze()
+        self.collector = threading.Thread(target=self._collect_results, daemon=True)
+        self.collector.start()
+
+    def _start_worker(self, worker_id):
+        self.requests[worker_id] = self.ctx.Queue()
+        reader, writer = self.ctx.Pipe(duplex=False)
+        worker = self.ctx.Process(
+            target=_worker_main,
+            args=(
+                worker_id,
+                self.model,
+                self.tokenizer,
+                self.id2label,
+                self.core_sets[worker_id],
+                self.threads[worker_id],
+                self.requests[worker_id],
+                writer,
+            ),
+            daemon=True,
+        )
+        worker.start()
+        writer.close()  # only the worker holds the writing end
+        self.results[worker_id], self.workers[worker_id] = reader, worker
+
+    def _deliver(self, worker_id, item):
+        request_id, res, error = item
+        with self.lock:
+            entry = self.futures.pop(request_id, None)
+            if entry is not None:
+                self.in_flight[worker_id] -= 1
+        if entry is None:
+            return
+        if error is not None:
+            entry[0].set_exception(RuntimeError(f"worker {worker_id} failed: {error}"))
+        else:
+            entry[0].set_result(res)
+
+    def _replace_worker(self, worker_id):
+        # routes the results the worker sent before dying, fails the rest of its requests, forks a new one
+        reader, worker = self.results[worker_id], self.workers[worker_id]
+        try:
+            while reader.poll():
+                self._deliver(worker_id, reader.recv())
+        except (EOFError, OSError):
+            pass
+        reader.close()
+        worker.join()
+        with self.lock:
+            if self.closing:
+                return
+            lost = [rid for rid, (_, wid) in self.futures.items() if wid == worker_id]
+            failed = [self.futures.pop(rid)[0] for rid in lost]
+            self.in_flight[worker_id] = 0
+            gc.freeze()
+            self._start_worker(worker_id)
+            gc.unfreeze()
+            self.restarts += 1
+        for future in failed:
+            future.set_exception(RuntimeError(f"worker {worker_id} died (exit code {worker.exitcode}), request not routed"))
+
+    def _collect_results(self):
+        while True:
+            # the workers stopped while closing are not replaced
+            readers = {reader: i for i, reader in enumerate(self.results) if not reader.closed}
+            sentinels = {worker.sentinel: i for i, worker in enumerate(self.workers) if worker.exitcode is None}
+            ready = mp.connection.wait([self.stop_reader, *readers, *sentinels])
+            if self.stop_reader in ready:
+                break
+            for conn in ready:
+                if conn in readers:
+                    try:
+                        self._deliver(readers[conn], conn.recv())
+                    except EOFError:  # the worker died, its sentinel is ready too
+                        pass
+            for worker_id in sorted(sentinels[s] for s in ready if s in sentinels):
+                self._replace_worker(worker_id)
+
+    def submit(self, texts):
+        future = Future()
+        with self.lock:
+            request_id = next(self.request_ids)
+            worker_id = min(range(self.num_workers), key=self.in_flight.__getitem__)
+            self.in_flight[worker_id] += 1
+            self.futures[request_id] = (future, worker_id)
+            # under the lock, so a request either fails with its dead worker or goes to the replacement
+            self.requests[worker_id].put((request_id, list(texts)))
+        return future
+
+    def route_batch(self, texts):
+        return self.submit(texts).result(timeout=self.timeout)
+
+    def route(self, text):
+        return self.route_batch([text])[0]
+
+    # same signatures as `infer_single` / `infer_batch` of `run_gradio_model.py` (the model arguments
+    # are the workers' own)
+    def infer_single_compat(self, text, model=None, tokenizer=None, id2label=None):
+        return self.route(text)
+
+    def infer_batch_compat(self, texts, model=None, tokenizer=None, id2label=None):
+        return self.route_batch(texts)
+
+    def worker_pids(self):
+        return [w.pid for w in self.workers]
+
+    def close(self):
+        with self.lock:
+            self.closing = True
+        for q in self.requests:
+            q.put(None)
+        for w in self.workers:
+            w.join(timeout=10)
+        self.stop_writer.send(None)
+        self.collector.join(timeout=10)
+
+
+def process_memory(pid):
+    # resident (RSS), proportional (PSS: shared pages divided among the processes sharing them) and
+    # private memory of a process in MB, from /proc (linux only)
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as fp:
+            for line in fp:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                    fields[parts[0][:-1]] = int(parts[1]) / 1024
+    except OSError:
+        return {}
+    return {
+        "rss_mb": fields.get("Rss", 0.0),
+        "pss_mb": fields.get("Pss", 0.0),
+        "shared_mb": fields.get("Shared_Clean", 0.0) + fields.get("Shared_Dirty", 0.0),
+        "private_mb": fields.get("Private_Clean", 0.0) + fields.get("Private_Dirty", 0.0),
+    }
+
+
+def run_load(router, prompts, concurrency):
+    # `concurrency` client threads send their prompts back to back; returns the per-request latencies
+    latencies = []
+    prompt_iter = iter(prompts)
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                text = next(prompt_iter, None)
+            if text is None:
+                return
+            t0 = time.perf_counter()
+            router.route(text)
+            latencies.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for f in [executor.submit(client) for _ in range(concurrency)]:
+            f.result()
+    return latencies, time.perf_counter() - t0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_save_dir",
+        type=str,
+        default="../models/bert-base-uncased-router-finetuning-20240722T133228-save",
+        help="The directory where the BERT model weights are stored (used `model.save_pretrained(...)`",
+    )
+    parser.add_argument(
+        "--hf_model_name",
+        type=str,
+        default="bert-base-uncased",
+        help="The tokenizer name in hugging face",
+    )
+    parser.add_argument(
+        "--max_workers", type=int, default=None, help="Measure 1 to this many workers, defaults to all cores"
+    )
+    parser.add_argument(
+        "--mmap_weights", action="store_true", help="Memory-map the weights instead of sharing them copy-on-write"
+    )
+    parser.add_argument("--num_requests", type=int, default=256, help="Number of simulated requests per run")
+    parser.add_argument("--concurrency", type=int, default=None, help="Concurrent clients, defaults to 2 per worker")
+    parser.add_argument("--out_file", type=str, default=None, help="Optional JSON file for the results")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from transformers import AutoTokenizer
+
+    from benchmark_batching import load_prompts
+
+    args = parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.hf_model_name)
+    save_directory = os.path.join(os.getcwd(), args.model_save_dir)
+    mmap_dir = tempfile.mkdtemp(prefix="prefork-") if args.mmap_weights else None
+    model = load_shared_model(save_directory, mmap_weights=args.mmap_weights, mmap_dir=mmap_dir)
+    id2label = {0: "ROUTE_TO_INFERIOR", 1: "ROUTE_TO_SUPERIOR"}
+    prompts = load_prompts(None, args.num_requests)
+
+    max_workers = args.max_workers or len(os.sched_getaffinity(0))
+    results = []
+    for num_workers in range(1, max_workers + 1):
+        router = PreforkRouter(model, tokenizer, id2label, num_workers=num_workers)
+        concurrency = args.concurrency or 2 * num_workers
+        run_load(router, prompts[: 4 * num_workers], concurrency)  # warmup
+        latencies, elapsed = run_load(router, prompts, concurrency)
+        lat_ms = np.asarray(latencies) * 1000
+        memory = [process_memory(pid) for pid in router.worker_pids()]
+        res = {
+            "num_workers": num_workers,
+            "threads_per_worker": router.threads,
+            "qps": len(latencies) / elapsed,
+            "p50_ms": float(np.percentile(lat_ms, 50)),
+            "p99_ms": float(np.percentile(lat_ms, 99)),
+            "front_memory": process_memory(os.getpid()),
+            "worker_memory": memory,
+            "mean_worker_pss_mb": float(np.mean([m.get("pss_mb", 0.0) for m in memory])),
+        }
+        if results:
+            res["speedup_vs_1_worker"] = res["qps"] / results[0]["qps"]
+        results.append(res)
+        print(json.dumps({k: v for k, v in res.items() if k not in ("worker_memory", "front_memory")}))
+        router.close()
+
+    if args.out_file is not None:
+        with open(args.out_file, "w") as fp:
+            json.dump(results, fp, indent=2)
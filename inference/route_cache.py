@@ -0,0 +1,254 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# rough per-entry bookkeeping overhead (dict slots, timestamps) added to the key and value sizes
+ENTRY_OVERHEAD_BYTES = 200
+
+
+def normalize_prompt(text, lowercase=True):
+    # bert-base-uncased lowercases anyway, so case and whitespace variants route identically
+    text = unicodedata.normalize("NFC", text)
+    text = " ".join(text.split())
+    return text.lower() if lowercase else text
+
+
+def make_cache_key(text, model_id, lowercase=True):
+    normalized = normalize_prompt(text, lowercase=lowercase)
+    return hashlib.sha256(f"{model_id}\0{normalized}".encode("utf-8")).hexdigest()
+
+
+def get_model_identity(model):
+    # identity of the loaded weights: their path plus size and mtime of the files there, so a model
+    # re-saved and reloaded from the same directory gets a new identity (and stale entries are dropped)
+    identity = getattr(model, "_route_cache_identity", None)
+    if identity is not None:
+        return identity
+    path = getattr(model, "name_or_path", "") or ""
+    parts = [path]
+    if os.path.isdir(path):
+        filenames = sorted(os.listdir(path))
+        paths = [os.path.join(path, f) for f in filenames]
+    else:
+        paths = [path] if os.path.isfile(path) else []
+    for p in paths:
+        st = os.stat(p)
+        parts.append(f"{os.path.basename(p)}:{st.st_size}:{st.st_mtime_ns}")
+    if len(parts) == 1:
+        # no files to fingerprint (e.g. a randomly initialized model): fall back to the object itself
+        parts.append(f"pid{os.getpid()}-obj{id(model)}")
+    identity = hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()[:16]
+    model._route_cache_identity = identity
+    return identity
+
+
+def entry_size(key, value):
+    return len(key) + len(json.dumps(value)) + ENTRY_OVERHEAD_BYTES
+
+
+class RouteCache:
+    # In-process LRU cache of routing decisions with optional TTL and byte cap.
+    def __init__(self, max_entries=100_000, max_bytes=None, ttl_seconds=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()  # key -> (value, created_at, size)
+        self.num_bytes = 0
+        self.model_id = None
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def bind_model(self, model_id):
+        # entries of a previous model are stale: drop them as soon as a new model is seen
+        with self.lock:
+            if model_id != self.model_id:
+                self.entries.clear()
+                self.num_bytes = 0
+                self.model_id = model_id
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, created_at, size = entry
+            if self.ttl_seconds is not None and time.monotonic() - created_at > self.ttl_seconds:
+                del self.entries[key]
+                self.num_bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = entry_size(key, value)
+        with self.lock:
+            if key in self.entries:
+                self.num_bytes -= self.entries.pop(key)[2]
+            self.entries[key] = (value, time.monotonic(), size)
+            self.num_bytes += size
+            while self.entries and (
+                len(self.entries) > self.max_entries
+                or (self.max_bytes is not None and self.num_bytes > self.max_bytes)
+            ):
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.num_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.num_bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.num_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class SharedRouteCache:
+    # Same interface as `RouteCache`, backed by a SQLite file so that several worker processes
+    # (e.g. replicas of the gradio app on one node) share their routing decisions.
+    # Counters are per process; entries, LRU order and the bound model are shared.
+    def __init__(self, path, max_entries=100_000, max_bytes=None, ttl_seconds=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.local = threading.local()
+        self.model_id = None
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS routes "
+                "(key TEXT PRIMARY KEY, value TEXT, created_at REAL, accessed_at REAL, size INTEGER)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS routes_accessed_at ON routes (accessed_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def bind_model(self, model_id):
+        # keys include the model id, so only the first call per model needs to touch the database
+        if model_id == self.model_id:
+            return
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE name = 'model_id'").fetchone()
+            if row is None or row[0] != model_id:
+                conn.execute("DELETE FROM routes")
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('model_id', ?)", (model_id,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self.model_id = model_id
+
+    def get(self, key):
+        conn = self._conn()
+        row = conn.execute("SELECT value, created_at FROM routes WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        now = time.time()
+        if self.ttl_seconds is not None and now - row[1] > self.ttl_seconds:
+            conn.execute("DELETE FROM routes WHERE key = ?", (key,))
+            self.expirations += 1
+            self.misses += 1
+            return None
+        conn.execute("UPDATE routes SET accessed_at = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(value), now, now, entry_size(key, value)),
+            )
+            num_entries, num_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM routes").fetchone()
+            while num_entries > 0 and (
+                num_entries > self.max_entries or (self.max_bytes is not None and num_bytes > self.max_bytes)
+            ):
+                evicted = conn.execute(
+                    "SELECT key, size FROM routes ORDER BY accessed_at LIMIT 1"
+                ).fetchone()
+                conn.execute("DELETE FROM routes WHERE key = ?", (evicted[0],))
+                num_entries -= 1
+                num_bytes -= evicted[1]
+                self.evictions += 1
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def clear(self):
+        self._conn().execute("DELETE FROM routes")
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM routes").fetchone()[0]
+
+    def stats(self):
+        num_entries, num_bytes = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM routes"
+        ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "entries": num_entries,
+            "bytes": num_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def make_route_cache(max_entries=100_000, max_bytes=None, ttl_seconds=None, shared_path=None):
+    if shared_path is not None:
+        return SharedRouteCache(shared_path, max_entries=max_entries, max_bytes=max_bytes, ttl_seconds=ttl_seconds)
+    return RouteCache(max_entries=max_entries, max_bytes=max_bytes, ttl_seconds=ttl_seconds)
+
+
+def cached_infer_single(text, model, tokenizer, id2label, cache, infer_fn=None):
+    # `infer_fn` has the signature of `infer_single` (the default), e.g. a cascade router
+    if infer_fn is None:
+        from run_gradio_model import infer_single as infer_fn
+
+    model_id = get_model_identity(model)
+    cache.bind_model(model_id)
+    key = make_cache_key(text, model_id)
+    res = cache.get(key)
+    if res is None:
+        res = infer_fn(text, model=model, tokenizer=tokenizer, id2label=id2label)
+        cache.put(key, res)
+    return res
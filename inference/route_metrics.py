@@ -0,0 +1,237 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# stages of `get_probs` / `get_probs_batch`, in order
+STAGES = ["tokenize", "to_device", "forward", "postprocess"]
+SECONDS_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+TOKEN_BUCKETS = [8, 16, 32, 64, 128, 256, 384, 512]
+BATCH_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128]
+FRACTION_BUCKETS = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+CONFIDENCE_EDGES = [0.6, 0.7, 0.8, 0.9]
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + ([extra] if extra is not None else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.label_names, label_values)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    # cumulative buckets as in the Prometheus text format; one series per combination of label values
+    def __init__(self, name, help_text, buckets, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = list(buckets)
+        self.label_names = tuple(label_names)
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        counts, total = self.series.get(label_values, ([0] * (len(self.buckets) + 1), 0.0))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.series[label_values] = (counts, total + value)
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for le, count in zip(self.buckets + ["+Inf"], counts):
+                cumulative += count
+                le_label = ("le", le if le == "+Inf" else _format_value(float(le)))
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.label_names, label_values, le_label)} {cumulative}"
+                )
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def confidence_bucket(confidence):
+    # the winning class probability of a binary router is in [0.5, 1]
+    lower = [0.5] + CONFIDENCE_EDGES
+    upper = CONFIDENCE_EDGES + [1.0]
+    i = bisect.bisect_right(CONFIDENCE_EDGES, confidence)
+    return f"{lower[i]:.1f}-{upper[i]:.1f}"
+
+
+class RouteMetrics:
+    # Aggregates the records of instrumented `get_probs` / `get_probs_batch` calls: per-stage timings,
+    # token lengths, padding waste and route decisions. Hooks added with `add_hook` get every record
+    # too, e.g. to forward them to another metrics system. A record is a dict with
+    #   fn: "get_probs" or "get_probs_batch", stages: {stage: seconds}, total_seconds,
+    #   num_tokens: [real tokens per prompt], padded_length, probs: [[p_label_0, p_label_1], ...]
+    def __init__(self, id2label=None):
+        self.id2label = id2label or {0: "ROUTE_TO_INFERIOR", 1: "ROUTE_TO_SUPERIOR"}
+        self.lock = threading.Lock()
+        self.hooks = []
+        self.stage_seconds = Histogram(
+            "router_stage_seconds", "Time spent per routing stage", SECONDS_BUCKETS, ["fn", "stage"]
+        )
+        self.call_seconds = Histogram("router_call_seconds", "Time per routing call", SECONDS_BUCKETS, ["fn"])
+        self.prompt_tokens = Histogram("router_prompt_tokens", "Tokens per prompt (without padding)", TOKEN_BUCKETS)
+        self.padding_waste = Histogram(
+            "router_padding_waste_ratio", "Fraction of padding tokens per forward pass", FRACTION_BUCKETS, ["fn"]
+        )
+        self.batch_size = Histogram("router_batch_size", "Prompts per forward pass", BATCH_BUCKETS, ["fn"])
+        self.decisions = Counter(
+            "router_route_decisions_total", "Routing decisions by label and confidence", ["label", "confidence"]
+        )
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def record(self, record):
+        fn = record["fn"]
+        num_tokens = record["num_tokens"]
+        padded_total = record["padded_length"] * len(num_tokens)
+        with self.lock:
+            for stage, seconds in record["stages"].items():
+                self.stage_seconds.observe(seconds, fn, stage)
+            self.call_seconds.observe(record["total_seconds"], fn)
+            for n in num_tokens:
+                self.prompt_tokens.observe(n)
+            if padded_total:
+                self.padding_waste.observe(1 - sum(num_tokens) / padded_total, fn)
+            self.batch_size.observe(len(num_tokens), fn)
+            for probs in record["probs"]:
+                label_id = max(range(len(probs)), key=probs.__getitem__)
+                self.decisions.inc(self.id2label.get(label_id, label_id), confidence_bucket(probs[label_id]))
+        for hook in list(self.hooks):
+            hook(record)
+
+    def expose(self):
+        # Prometheus text exposition format (version 0.0.4)
+        with self.lock:
+            metrics = [
+                self.stage_seconds,
+                self.call_seconds,
+                self.prompt_tokens,
+                self.padding_waste,
+                self.batch_size,
+                self.decisions,
+            ]
+            lines = [line for m in metrics for line in m.expose()]
+        return "\n".join(lines) + "\n"
+
+
+class StageTimer:
+    # created per call by `start_timer`; `mark(stage)` closes the stage that just ran
+    def __init__(self, recorder, fn, sync_cuda):
+        self.recorder = recorder
+        self.fn = fn
+        self.sync_cuda = sync_cuda
+        self.stages = {}
+        self.started_at = self.last = time.perf_counter()
+
+    def mark(self, stage):
+        if self.sync_cuda:
+            # kernels run asynchronously, without a sync their time would land in a later stage
+            import torch
+
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.stages[stage] = now - self.last
+        self.last = now
+
+    def finish(self, attention_mask, probs):
+        self.recorder.record(
+            {
+                "fn": self.fn,
+                "stages": self.stages,
+                "total_seconds": self.last - self.started_at,
+                "num_tokens": attention_mask.sum(dim=1).tolist(),
+                "padded_length": attention_mask.shape[1],
+                "probs": probs,
+            }
+        )
+
+
+class _NullTimer:
+    # what `start_timer` returns while instrumentation is off: no clock reads, no allocations
+    def mark(self, stage):
+        pass
+
+    def finish(self, attention_mask, probs):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+_recorder = None
+_sync_cuda = False
+
+
+def enable_instrumentation(recorder=None, sync_cuda=None):
+    # `sync_cuda` defaults to True on GPU, so that stage timings are exact (at the cost of a sync per stage)
+    global _recorder, _sync_cuda
+    if sync_cuda is None:
+        import torch
+
+        sync_cuda = torch.cuda.is_available()
+    _recorder = recorder or RouteMetrics()
+    _sync_cuda = sync_cuda
+    return _recorder
+
+
+def disable_instrumentation():
+    global _recorder
+    _recorder = None
+
+
+def get_recorder():
+    return _recorder
+
+
+def start_timer(fn):
+    if _recorder is None:
+        return NULL_TIMER
+    return StageTimer(_recorder, fn, _sync_cuda)
+
+
+def start_metrics_server(recorder, port=9100, host="0.0.0.0"):
+    # serves `recorder.expose()` on http://host:port/metrics from a daemon thread
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = recorder.expose().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,56 @@
+import os
+import sys
+
+import pandas as pd
+
+# the data preparation of the fine-tuning notebook, for the scripts that train or evaluate routers
+TAGS2NUMS = {"ROUTE_TO_INFERIOR": 0, "ROUTE_TO_SUPERIOR": 1}
+CREATE_DATASET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "create_dataset")
+
+
+def import_df_from_jsonl_file(filepath):
+    return pd.read_json(filepath, lines=True)
+
+
+def import_labelled_df(path):
+    # labelled synthetic dataset as a dataframe with the columns of the labelling output
+    # (conversation_id, initial_prompt, gpt_content), from a JSONL file, a dataset store directory
+    # or a memory-mapped Arrow snapshot of `create_dataset/dataset_store.py`
+    if not (os.path.isdir(path) or path.endswith(".arrow")):
+        return import_df_from_jsonl_file(path)
+    sys.path.append(CREATE_DATASET_DIR)
+    from dataset_store import load_table, read_snapshot
+
+    table = read_snapshot(path) if path.endswith(".arrow") else load_table(path)
+    df = table.select(["conversation_id", "prompt", "label"]).to_pandas()
+    return df.rename(columns={"prompt": "initial_prompt", "label": "gpt_content"})
+
+
+def process_synthetic_dataset(df, make_balanced, max_length, seed=42, near_dup_threshold=None):
+    df = df.drop_duplicates(subset="conversation_id", keep="first")  # drop duplicate conversations
+    df = df.rename(columns={"initial_prompt": "text", "gpt_content": "label_tag"})
+    df = df[df["label_tag"].isin(TAGS2NUMS.keys())].copy()
+    df["target"] = df["label_tag"].map(TAGS2NUMS)
+    assert not df["target"].isna().any()
+    if max_length > 0:  # drop really large prompts
+        df = df[df["text"].str.len() < max_length]
+    if near_dup_threshold is not None:  # keep one prompt per cluster of near-duplicates
+        sys.path.append(CREATE_DATASET_DIR)
+        from near_dedup import near_duplicate_keep_mask
+
+        keep, _ = near_duplicate_keep_mask(df["text"].tolist(), threshold=near_dup_threshold)
+        df = df[keep]
+    if make_balanced:
+        count_min = min((df["target"] == 0).sum(), (df["target"] == 1).sum())
+        df_0 = df[df["target"] == 0].sample(n=count_min, random_state=seed)
+        df_1 = df[df["target"] == 1].sample(n=count_min, random_state=seed)
+        df = pd.concat([df_0, df_1]).sample(frac=1, random_state=seed)  # combine and shuffle
+    return df[["text", "target"]].reset_index(drop=True)
+
+
+def process_questions_dataset(df):
+    df = df[df["label"] != "ROUTE_NOT"].dropna()
+    df = df.rename(columns={"question": "text"}).reset_index()
+    df["target"] = df["label"].map(TAGS2NUMS)
+    assert not df["target"].isna().any()
+    return df[["text", "target"]]
@@ -0,0 +1,407 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import Counter, deque
+
+import aiohttp
+import numpy as np
+from aiohttp import web
+
+from batching_server import MicroBatcher, QueueFullError
+
+CREATE_DATASET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "create_dataset")
+# hop-by-hop and body-dependent headers are not copied between the client and the upstream
+SKIPPED_HEADERS = {"host", "content-length", "content-encoding", "transfer-encoding", "connection", "keep-alive"}
+
+
+class Upstream:
+    # An OpenAI-compatible backend with its own pool of persistent connections. At most
+    # `max_concurrency` requests are in flight; the others wait for a slot, and `queue_latency()`
+    # estimates how long a new request would wait.
+    def __init__(self, name, base_url, model=None, api_key=None, max_concurrency=64, timeout_s=600.0):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        self.timeout = aiohttp.ClientTimeout(total=timeout_s, sock_connect=10)
+        self.session = None
+        self.semaphore = None
+        self.waiting = deque()
+        self.in_flight = 0
+        self.recent_wait = 0.0
+        self.recent_service = 0.0
+        self.stats = Counter()
+
+    async def start(self):
+        # the session and the semaphore are bound to the running event loop
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60, ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout, auto_decompress=True)
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    def queue_latency(self):
+        # 0 with a free slot; else the longest of: the wait of the oldest queued request, the wait of
+        # the last requests to get a slot, and the time the queued requests (plus this one) will hold
+        # the slots at the recent service time (so a burst arriving at once is not seen as free)
+        if self.in_flight < self.max_concurrency:
+            return 0.0
+        oldest_wait = time.perf_counter() - self.waiting[0] if self.waiting else 0.0
+        backlog = (len(self.waiting) + 1) * self.recent_service / self.max_concurrency
+        return max(oldest_wait, self.recent_wait, backlog)
+
+    async def acquire(self):
+        t0 = time.perf_counter()
+        self.waiting.append(t0)
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting.remove(t0)
+        wait = time.perf_counter() - t0
+        self.recent_wait = 0.8 * self.recent_wait + 0.2 * wait
+        self.in_flight += 1
+        return wait
+
+    def release(self, service_seconds):
+        # `service_seconds`: how long the request held its slot
+        self.recent_service = 0.8 * self.recent_service + 0.2 * service_seconds if self.recent_service else service_seconds
+        self.in_flight -= 1
+        self.semaphore.release()
+
+    def request_headers(self, client_headers):
+        headers = {k: v for k, v in client_headers.items() if k.lower() not in SKIPPED_HEADERS}
+        headers["Content-Type"] = "application/json"
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    def request_body(self, body):
+        return {**body, "model": self.model} if self.model else body
+
+
+def routing_text(body):
+    # the router is trained on single prompts: route on the last user message (text parts only)
+    for message in reversed(body.get("messages") or []):
+        if message.get("role") != "user":
+            continue
+        content = message.get("content")
+        if isinstance(content, list):
+            content = " ".join(part.get("text", "") for part in content if part.get("type") == "text")
+        return content or ""
+    return ""
+
+
+def openai_error(status, message, error_type):
+    return web.json_response({"error": {"message": message, "type": error_type}}, status=status)
+
+
+async def end_stream_with_error(request, response, message):
+    event = {"error": {"message": message, "type": "upstream_error"}}
+    try:
+        await response.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+        await response.write_eof()
+    except ConnectionError:
+        # the client is gone too: drop the connection
+        if request.transport is not None:
+            request.transport.close()
+
+
+class RoutingProxy:
+    # `/v1/chat/completions` routes every request with the classifier (micro-batched, see
+    # `batching_server.py`) and forwards it unchanged, except for the upstream `model`, to the inferior
+    # or superior upstream. Streamed answers are written to the client chunk by chunk as they arrive.
+    # An inferior request spills over to the superior upstream when the inferior queue latency is above
+    # `spillover_ms`.
+    def __init__(self, batcher, inferior, superior, superior_threshold=0.5, spillover_ms=None):
+        self.batcher = batcher
+        self.upstreams = {"ROUTE_TO_INFERIOR": inferior, "ROUTE_TO_SUPERIOR": superior}
+        self.superior_threshold = superior_threshold
+        self.spillover = spillover_ms / 1000 if spillover_ms is not None else None
+        self.stats = Counter()
+        self.route_seconds = deque(maxlen=10_000)
+
+    def make_app(self):
+        app = web.Application(client_max_size=16 * 1024**2)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_get("/router/stats", self.get_stats)
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+    async def _on_startup(self, app):
+        for upstream in self.upstreams.values():
+            await upstream.start()
+
+    async def _on_cleanup(self, app):
+        for upstream in self.upstreams.values():
+            await upstream.close()
+        await self.batcher.close()
+
+    async def choose_upstream(self, body):
+        t0 = time.perf_counter()
+        probs = await self.batcher.route(routing_text(body))
+        self.route_seconds.append(time.perf_counter() - t0)
+        route = "ROUTE_TO_SUPERIOR" if probs["ROUTE_TO_SUPERIOR"] >= self.superior_threshold else "ROUTE_TO_INFERIOR"
+        upstream = self.upstreams[route]
+        spilled = (
+            route == "ROUTE_TO_INFERIOR"
+            and self.spillover is not None
+            and upstream.queue_latency() > self.spillover
+        )
+        if spilled:
+            upstream = self.upstreams["ROUTE_TO_SUPERIOR"]
+        self.stats[route] += 1
+        self.stats["spillovers"] += spilled
+        return route, upstream, spilled, probs
+
+    async def chat_completions(self, request):
+        try:
+            body = await request.json()
+        except ValueError:
+            return openai_error(400, "request body is not valid JSON", "invalid_request_error")
+        try:
+            route, upstream, spilled, probs = await self.choose_upstream(body)
+        except QueueFullError as e:
+            self.stats["rejected"] += 1
+            return openai_error(503, str(e), "server_overloaded")
+        router_headers = {
+            "x-router-route": route,
+            "x-router-upstream": upstream.name,
+            "x-router-spillover": str(int(spilled)),
+            "x-router-superior-prob": f"{probs['ROUTE_TO_SUPERIOR']:.4f}",
+        }
+        wait = await upstream.acquire()
+        upstream.stats["requests"] += 1
+        router_headers["x-router-queue-ms"] = f"{wait * 1000:.1f}"
+        slot_start = time.perf_counter()
+        response = None
+        try:
+            async with upstream.session.post(
+                f"{upstream.base_url}/chat/completions",
+                json=upstream.request_body(body),
+                headers=upstream.request_headers(request.headers),
+            ) as upstream_response:
+                headers = {"Content-Type": upstream_response.headers.get("Content-Type", "application/json")}
+                if not body.get("stream") or upstream_response.status != 200:
+                    return web.Response(
+                        body=await upstream_response.read(),
+                        status=upstream_response.status,
+                        headers={**headers, **router_headers},
+                    )
+                response = web.StreamResponse(
+                    status=upstream_response.status, headers={**headers, "Cache-Control": "no-cache", **router_headers}
+                )
+                await response.prepare(request)
+                # whatever bytes have arrived, without waiting for full lines or events
+                async for chunk in upstream_response.content.iter_any():
+                    await response.write(chunk)
+                await response.write_eof()
+                return response
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            upstream.stats["errors"] += 1
+            message = f"upstream {upstream.name} failed: {e!r}"
+            if response is None or not response.prepared:
+                return openai_error(502, message, "upstream_error")
+            # the 200 and part of the stream are sent already: end the stream with an error event
+            # (OpenAI clients raise on it) instead of leaving the client waiting
+            await end_stream_with_error(request, response, message)
+            return response
+        finally:
+            upstream.release(time.perf_counter() - slot_start)
+
+    def stats_dict(self):
+        route_ms = np.asarray(self.route_seconds) * 1000
+        return {
+            "routes": {k: v for k, v in self.stats.items()},
+            "route_p50_ms": float(np.percentile(route_ms, 50)) if len(route_ms) else None,
+            "route_p99_ms": float(np.percentile(route_ms, 99)) if len(route_ms) else None,
+            "upstreams": {
+                u.name: {**u.stats, "in_flight": u.in_flight, "queue_latency_ms": u.queue_latency() * 1000}
+                for u in self.upstreams.values()
+            },
+            "batcher": self.batcher.stats(),
+        }
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats_dict())
+
+
+async def run_load_test(proxy_url, prompts, concurrency, stream=True, model="router"):
+    # `concurrency` clients send the prompts back to back through the proxy; reports time to first
+    # byte, total latency and where the requests went
+    prompt_iter = iter(prompts)
+    results = []
+
+    async def client(session):
+        for text in prompt_iter:
+            body = {"model": model, "messages": [{"role": "user", "content": text}], "stream": stream}
+            t0 = time.perf_counter()
+            async with session.post(f"{proxy_url}/chat/completions", json=body) as response:
+                ttfb = None
+                async for _ in response.content.iter_any():
+                    if ttfb is None:
+                        ttfb = time.perf_counter() - t0
+                results.append(
+                    {
+                        "status": response.status,
+                        "upstream": response.headers.get("x-router-upstream"),
+                        "spillover": response.headers.get("x-router-spillover") == "1",
+                        "ttfb": ttfb or 0.0,
+                        "latency": time.perf_counter() - t0,
+                    }
+                )
+
+    t0 = time.perf_counter()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - t0
+    ttfb_ms = np.asarray([r["ttfb"] for r in results]) * 1000
+    lat_ms = np.asarray([r["latency"] for r in results]) * 1000
+    return {
+        "requests": len(results),
+        "qps": len(results) / elapsed,
+        "status": dict(Counter(r["status"] for r in results)),
+        "upstreams": dict(Counter(r["upstream"] for r in results)),
+        "spillovers": sum(r["spillover"] for r in results),
+        "ttfb_p50_ms": float(np.percentile(ttfb_ms, 50)),
+        "ttfb_p99_ms": float(np.percentile(ttfb_ms, 99)),
+        "latency_p50_ms": float(np.percentile(lat_ms, 50)),
+        "latency_p99_ms": float(np.percentile(lat_ms, 99)),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_save_dir",
+        type=str,
+        default="../models/bert-base-uncased-router-finetuning-20240722T133228-save",
+        help="The directory where the BERT model weights are stored (used `model.save_pretrained(...)`",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="torch",
+        choices=["torch", "onnx", "artifact"],
+        help="Router backend, as in `run_gradio_model.py`",
+    )
+    parser.add_argument("--hf_model_name", type=str, default="bert-base-uncased", help="The tokenizer name in hugging face")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8400)
+    parser.add_argument("--inferior_url", type=str, default="http://127.0.0.1:8401/v1", help="Base url of the inferior upstream")
+    parser.add_argument("--inferior_model", type=str, default="gpt-3.5-turbo", help="`model` sent to the inferior upstream")
+    parser.add_argument("--inferior_api_key", type=str, default=os.environ.get("INFERIOR_API_KEY"))
+    parser.add_argument("--inferior_max_concurrency", type=int, default=64, help="Requests in flight to the inferior upstream")
+    parser.add_argument("--superior_url", type=str, default="http://127.0.0.1:8402/v1", help="Base url of the superior upstream")
+    parser.add_argument("--superior_model", type=str, default="gpt-4", help="`model` sent to the superior upstream")
+    parser.add_argument("--superior_api_key", type=str, default=os.environ.get("SUPERIOR_API_KEY"))
+    parser.add_argument("--superior_max_concurrency", type=int, default=64, help="Requests in flight to the superior upstream")
+    parser.add_argument(
+        "--superior_threshold", type=float, default=0.5, help="Route to the superior upstream from this probability"
+    )
+    parser.add_argument(
+        "--spillover_ms",
+        type=float,
+        default=None,
+        help="Send inferior requests to the superior upstream while the inferior queue latency is above this",
+    )
+    parser.add_argument("--max_batch_size", type=int, default=32, help="Maximum number of prompts per routing forward pass")
+    parser.add_argument("--max_wait_ms", type=float, default=2.0, help="Maximum wait for more prompts to route together")
+    parser.add_argument("--max_queue_size", type=int, default=1024, help="Prompts waiting for routing beyond this are rejected")
+    parser.add_argument(
+        "--stand_in_upstreams",
+        action="store_true",
+        help="Serve local stand-ins for both upstreams (`fake_openai_server.py`) instead of the configured urls",
+    )
+    parser.add_argument("--stand_in_latency_ms", type=float, nargs=2, default=[100.0, 300.0], help="Inferior, superior")
+    parser.add_argument("--stand_in_chunk_delay_ms", type=float, default=5.0)
+    parser.add_argument(
+        "--load_test",
+        type=int,
+        default=None,
+        help="Send this many requests through the proxy, print the report and exit",
+    )
+    parser.add_argument("--load_test_concurrency", type=int, default=32)
+    parser.add_argument("--load_test_prompts_file", type=str, default=None, help="JSONL of prompts (sample prompts if not set)")
+    parser.add_argument("--no_stream", action="store_true", help="Load test without streaming")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from onnx_backend import load_router_model
+    from run_gradio_model import device
+
+    args = parse_args()
+    save_directory = os.path.join(os.getcwd(), args.model_save_dir)
+    if args.backend == "artifact":
+        from fast_start import load_artifact
+
+        model, tokenizer, _ = load_artifact(save_directory)
+    else:
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(args.hf_model_name)
+        model = load_router_model(save_directory, backend=args.backend)
+    model.to(device)
+    id2label = {0: "ROUTE_TO_INFERIOR", 1: "ROUTE_TO_SUPERIOR"}
+
+    stand_in_stops = []
+    if args.stand_in_upstreams:
+        sys.path.append(CREATE_DATASET_DIR)
+        from fake_openai_server import make_app, start_server_in_thread
+
+        urls = []
+        for latency_ms in args.stand_in_latency_ms:
+            url, stop = start_server_in_thread(make_app(latency_ms=latency_ms, chunk_delay_ms=args.stand_in_chunk_delay_ms))
+            urls.append(url)
+            stand_in_stops.append(stop)
+        args.inferior_url, args.superior_url = urls
+        print(f"stand-in upstreams: inferior {urls[0]}, superior {urls[1]}")
+
+    batcher = MicroBatcher(
+        model,
+        tokenizer,
+        id2label,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+        max_queue_size=args.max_queue_size,
+    )
+    proxy = RoutingProxy(
+        batcher,
+        Upstream("inferior", args.inferior_url, args.inferior_model, args.inferior_api_key, args.inferior_max_concurrency),
+        Upstream("superior", args.superior_url, args.superior_model, args.superior_api_key, args.superior_max_concurrency),
+        superior_threshold=args.superior_threshold,
+        spillover_ms=args.spillover_ms,
+    )
+
+    if args.load_test is None:
+        web.run_app(proxy.make_app(), host=args.host, port=args.port)
+    else:
+        from benchmark_batching import load_prompts
+
+        async def main():
+            runner = web.AppRunner(proxy.make_app())
+            await runner.setup()
+            site = web.TCPSite(runner, args.host, args.port)
+            await site.start()
+            try:
+                report = await run_load_test(
+                    f"http://{args.host}:{args.port}/v1",
+                    load_prompts(args.load_test_prompts_file, args.load_test),
+                    args.load_test_concurrency,
+                    stream=not args.no_stream,
+                )
+                report["proxy"] = proxy.stats_dict()
+            finally:
+                await runner.cleanup()
+            return report
+
+        print(json.dumps(asyncio.run(main()), indent=2))
+    for stop in stand_in_stops:
+        stop()
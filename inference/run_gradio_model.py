@@ -1,16 +1,23 @@
+import time
+
+START_TIME = time.perf_counter()
+
+import json
 import numpy as np
 import os
 import torch
 from torch.utils.data import Dataset, DataLoader
-from transformers import AutoTokenizer, BertForSequenceClassification
 import argparse
-import gradio as gr
+
+from route_metrics import start_timer
+from run_model import WINDOW_AGGREGATIONS
 
 torch.cuda.empty_cache()
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
 
 def get_probs(text, model, tokenizer, max_length=512):
+    timer = start_timer("get_probs")
     encoding = tokenizer.encode_plus(
         text,
         add_special_tokens=True,
@@ -20,13 +27,45 @@ def get_probs(text, model, tokenizer, max_length=512):
         return_attention_mask=True,
         return_tensors="pt",
     )
+    timer.mark("tokenize")
     mask = encoding["attention_mask"].to(device)
     ids = encoding["input_ids"].to(device)
+    timer.mark("to_device")
     logits = model(ids, token_type_ids=None, attention_mask=mask)[0]
+    timer.mark("forward")
     probs = torch.nn.functional.softmax(
         logits, dim=1
     )  # softmax to convert logits to probabilities
-    return probs.flatten().tolist()
+    probs = probs.flatten().tolist()
+    timer.mark("postprocess")
+    timer.finish(encoding["attention_mask"], [probs])
+    return probs
+
+
+def get_probs_batch(texts, model, tokenizer, max_length=512):
+    # one forward pass for many prompts, padded only to the longest prompt of the batch
+    timer = start_timer("get_probs_batch")
+    encoding = tokenizer(
+        list(texts),
+        add_special_tokens=True,
+        max_length=max_length,
+        padding="longest",
+        truncation=True,
+        return_attention_mask=True,
+        return_tensors="pt",
+    )
+    timer.mark("tokenize")
+    mask = encoding["attention_mask"].to(device)
+    ids = encoding["input_ids"].to(device)
+    timer.mark("to_device")
+    with torch.no_grad():
+        logits = model(ids, token_type_ids=None, attention_mask=mask)[0]
+        timer.mark("forward")
+        probs = torch.nn.functional.softmax(logits, dim=1)
+    probs = probs.tolist()
+    timer.mark("postprocess")
+    timer.finish(encoding["attention_mask"], probs)
+    return probs
 
 
 def infer_single(text, model, tokenizer, id2label):
@@ -35,6 +74,11 @@ def infer_single(text, model, tokenizer, id2label):
     return res
 
 
+def infer_batch(texts, model, tokenizer, id2label):
+    batch_probs = get_probs_batch(texts, model=model, tokenizer=tokenizer)
+    return [{label: probs[i] for i, label in id2label.items()} for probs in batch_probs]
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -43,31 +87,276 @@ def parse_args():
         default="../models/bert-base-uncased-router-finetuning-20240722T133228-save",
         help="The directory where the BERT model weights are stored (used `model.save_pretrained(...)`",
     )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="torch",
+        choices=["torch", "onnx", "artifact"],
+        help="`onnx` runs the int8 ONNX Runtime graph; `--model_save_dir` then points to the output of `onnx_backend.py`. "
+        "`artifact` loads the self-contained output of `fast_start.py` (tokenizer included) without importing transformers",
+    )
     parser.add_argument(
         "--hf_model_name",
         type=str,
         default="bert-base-uncased",
         help="The tokenizer name in hugging face",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--micro_batching",
+        action="store_true",
+        help="Group concurrent requests into batched forward passes (see `batching_server.py`)",
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=32,
+        help="Maximum number of prompts per forward pass when micro-batching",
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=5.0,
+        help="Maximum time the first prompt of a batch waits for more prompts when micro-batching",
+    )
+    parser.add_argument(
+        "--max_queue_size",
+        type=int,
+        default=1024,
+        help="Prompts waiting beyond this are rejected when micro-batching",
+    )
+    parser.add_argument(
+        "--cascade_dir",
+        type=str,
+        default=None,
+        help="Output of `cascade_router.py`: confident prompts are routed by its cheap first stage, the rest by BERT",
+    )
+    parser.add_argument(
+        "--semantic_index_dir",
+        type=str,
+        default=None,
+        help="Output of `semantic_index.py`: prompts close to an indexed prompt reuse its route (if built with `--encoder_dir`)",
+    )
+    parser.add_argument(
+        "--semantic_threshold",
+        type=float,
+        default=0.95,
+        help="Cosine similarity from which the route of the nearest indexed prompt is reused",
+    )
+    parser.add_argument(
+        "--window_stride",
+        type=int,
+        default=None,
+        help="Route prompts over 512 tokens on overlapping windows sharing this many tokens (truncated if not set)",
+    )
+    parser.add_argument(
+        "--max_windows",
+        type=int,
+        default=8,
+        help="Maximum number of windows routed per prompt with `--window_stride`",
+    )
+    parser.add_argument(
+        "--window_aggregation",
+        type=str,
+        default="mean",
+        choices=WINDOW_AGGREGATIONS,
+        help="How the window probabilities of a long prompt are combined (see `run_model.aggregate_window_probs`)",
+    )
+    parser.add_argument(
+        "--route_cache_size",
+        type=int,
+        default=0,
+        help="Cache up to this many routing decisions (0 disables the cache)",
+    )
+    parser.add_argument(
+        "--route_cache_max_bytes",
+        type=int,
+        default=None,
+        help="Optional size cap of the route cache in bytes",
+    )
+    parser.add_argument(
+        "--route_cache_ttl",
+        type=float,
+        default=None,
+        help="Optional time-to-live of cached routing decisions in seconds",
+    )
+    parser.add_argument(
+        "--route_cache_path",
+        type=str,
+        default=None,
+        help="SQLite file to share the route cache between worker processes (in-process cache if not set)",
+    )
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        default=None,
+        help="Instrument the routing path and serve Prometheus metrics on http://<host>:<port>/metrics",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Fork this many CPU worker processes sharing the weights, each pinned to its own cores (see `prefork_server.py`); torch backend only",
+    )
+    parser.add_argument(
+        "--mmap_weights",
+        action="store_true",
+        help="With `--workers`, memory-map the weights (re-saved once to `~/.cache/llm-router/mmap_weights`) instead of sharing them copy-on-write",
+    )
+    args = parser.parse_args()
+    if args.workers is not None and (
+        args.micro_batching or args.cascade_dir or args.semantic_index_dir or args.metrics_port is not None
+    ):
+        parser.error(
+            "--workers can not be combined with --micro_batching, --cascade_dir, --semantic_index_dir or --metrics_port"
+        )
+    if args.workers is not None and args.backend != "torch":
+        # the workers share the torch weights loaded by `prefork_server.load_shared_model`
+        parser.error(f"--workers only supports --backend torch, not --backend {args.backend}")
+    if sum(x is not None for x in (args.cascade_dir, args.semantic_index_dir, args.window_stride)) > 1:
+        parser.error("only one of --cascade_dir, --semantic_index_dir and --window_stride can be set")
+    if args.workers is not None and args.window_stride is not None:
+        parser.error("--workers can not be combined with --window_stride")
+    return args
 
 
 if __name__ == "__main__":
-    args = parse_args()
+    from fast_start import WARMUP_PROMPTS, StartupTimer
+    from onnx_backend import load_router_model
 
-    tokenizer = AutoTokenizer.from_pretrained(args.hf_model_name)
+    startup = StartupTimer(START_TIME)
+    args = parse_args()
+    startup.mark("imports")
 
     save_directory = os.path.join(os.getcwd(), args.model_save_dir)
-    model = BertForSequenceClassification.from_pretrained(save_directory)
-    model.to(device)
-
-    def demo_infer_single(text):
-        return infer_single(
-            text,
-            model=model,
-            tokenizer=tokenizer,
-            id2label={0: "ROUTE_TO_INFERIOR", 1: "ROUTE_TO_SUPERIOR"},
+    if args.backend == "artifact":
+        from fast_start import load_artifact
+
+        model, tokenizer, _ = load_artifact(save_directory, startup)
+        model.to(device)
+    else:
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(args.hf_model_name)
+        startup.mark("tokenizer")
+        if args.workers is not None:
+            from prefork_server import load_shared_model
+
+            model = load_shared_model(save_directory, mmap_weights=args.mmap_weights)
+        else:
+            model = load_router_model(save_directory, backend=args.backend)
+            model.to(device)
+        startup.mark("weights")
+
+    id2label = {0: "ROUTE_TO_INFERIOR", 1: "ROUTE_TO_SUPERIOR"}
+
+    if args.metrics_port is not None:
+        from route_metrics import RouteMetrics, enable_instrumentation, start_metrics_server
+
+        recorder = enable_instrumentation(RouteMetrics(id2label))
+        start_metrics_server(recorder, port=args.metrics_port)
+
+    cache = None
+    if args.route_cache_size > 0:
+        from route_cache import make_route_cache
+
+        cache = make_route_cache(
+            max_entries=args.route_cache_size,
+            max_bytes=args.route_cache_max_bytes,
+            ttl_seconds=args.route_cache_ttl,
+            shared_path=args.route_cache_path,
+        )
+
+    infer_single_fn, infer_batch_fn = infer_single, infer_batch
+    if args.cascade_dir is not None:
+        from cascade_router import load_cascade
+
+        cascade = load_cascade(args.cascade_dir, model, tokenizer, id2label)
+        infer_single_fn, infer_batch_fn = cascade.infer_single_compat, cascade.infer_batch_compat
+    if args.semantic_index_dir is not None:
+        from semantic_index import load_semantic_router
+
+        semantic = load_semantic_router(
+            args.semantic_index_dir, model, tokenizer, id2label, threshold=args.semantic_threshold
         )
+        if not semantic.reuse:
+            print("the semantic index was built with the router itself: routes are not reused, only hits are counted")
+        infer_single_fn, infer_batch_fn = semantic.infer_single_compat, semantic.infer_batch_compat
+    if args.window_stride is not None:
+        from long_prompt_router import LongPromptRouter
+
+        long_router = LongPromptRouter(
+            model,
+            tokenizer,
+            id2label,
+            stride=args.window_stride,
+            max_windows=args.max_windows,
+            aggregation=args.window_aggregation,
+        )
+        infer_single_fn, infer_batch_fn = long_router.infer_single_compat, long_router.infer_batch_compat
+
+    if args.workers is not None:
+        from prefork_server import PreforkRouter
+
+        # forked before any inference runs in this process
+        prefork = PreforkRouter(model, tokenizer, id2label, num_workers=args.workers)
+        infer_single_fn, infer_batch_fn = prefork.infer_single_compat, prefork.infer_batch_compat
+
+    startup.mark("routing_setup")
+    # the first forward pass pays for lazy initialization (allocator, kernels, thread pools):
+    # pay it before reporting ready, through the workers when there are (no inference in this process)
+    if args.workers is not None:
+        infer_batch_fn(WARMUP_PROMPTS, model=model, tokenizer=tokenizer, id2label=id2label)
+    else:
+        with torch.no_grad():
+            get_probs(WARMUP_PROMPTS[0], model, tokenizer)
+        get_probs_batch(WARMUP_PROMPTS, model, tokenizer)
+    startup.mark("warmup")
 
-    demo = gr.Interface(fn=demo_infer_single, inputs="text", outputs="label")
+    if args.micro_batching:
+        from batching_server import MicroBatcher
+
+        batcher = MicroBatcher(
+            model,
+            tokenizer,
+            id2label,
+            max_batch_size=args.max_batch_size,
+            max_wait_ms=args.max_wait_ms,
+            max_queue_size=args.max_queue_size,
+            cache=cache,
+            infer_batch_fn=infer_batch_fn,
+        )
+
+        async def demo_infer_single(text):
+            return await batcher.route(text)
+
+        concurrency_limit = args.max_queue_size
+    else:
+
+        def demo_infer_single(text):
+            if cache is not None:
+                from route_cache import cached_infer_single
+
+                return cached_infer_single(
+                    text, model=model, tokenizer=tokenizer, id2label=id2label, cache=cache, infer_fn=infer_single_fn
+                )
+            return infer_single_fn(
+                text,
+                model=model,
+                tokenizer=tokenizer,
+                id2label=id2label,
+            )
+
+        # one request in flight per worker, and one queued behind it
+        concurrency_limit = 2 * args.workers if args.workers is not None else 1
+
+    import gradio as gr
+
+    startup.mark("ui_import")
+    print(f"startup: {json.dumps(startup.report())}")
+    demo = gr.Interface(
+        fn=demo_infer_single,
+        inputs="text",
+        outputs="label",
+        concurrency_limit=concurrency_limit,
+    )
     demo.launch()
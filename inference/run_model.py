@@ -1,19 +1,64 @@
+import argparse
+import collections
+import functools
+import json
+import multiprocessing as mp
 import numpy as np
 import os
+import sys
+import time
 import torch
-from torch.utils.data import Dataset, DataLoader
-from transformers import AutoTokenizer, BertForSequenceClassification
+from torch.utils.data import Dataset, DataLoader, Sampler
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def load_jsonl_texts(filepath):
+    # prompts of the synthetic dataset (`initial_prompt`), the original questions (`question`) or plain `text`
+    texts = []
+    with open(filepath) as fp:
+        for line in fp:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            texts.append(row.get('text') or row.get('initial_prompt') or row.get('question'))
+    return texts
+
 
 class InferenceDataset(Dataset):
-    def __init__(self, texts, tokenizer_name, max_length=512):
+    def __init__(self, texts, tokenizer_name, max_length=512, dynamic_padding=False):
+        from transformers import AutoTokenizer
+
         self.texts = texts
         self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
         self.max_length = max_length
-        
+        self.dynamic_padding = dynamic_padding
+        self.encodings = None
+        if dynamic_padding:
+            # tokenize everything once, without padding; batches are padded in `pad_collate`
+            self.encodings = self.tokenizer(
+                list(texts),
+                add_special_tokens=True,
+                max_length=max_length,
+                truncation=True,
+                return_attention_mask=True,
+            )
+
     def __len__(self):
         return len(self.texts)
-    
+
+    def lengths(self):
+        if self.encodings is not None:
+            return [len(ids) for ids in self.encodings['input_ids']]
+        return [self.max_length] * len(self.texts)
+
     def __getitem__(self, idx):
+        if self.encodings is not None:
+            return {
+                'input_ids': torch.as_tensor(self.encodings['input_ids'][idx], dtype=torch.long),
+                'attention_mask': torch.as_tensor(self.encodings['attention_mask'][idx], dtype=torch.long),
+                'idx': idx,
+            }
         text = self.texts[idx]
         encoding = self.tokenizer.encode_plus(
             text,
@@ -30,10 +75,60 @@ class InferenceDataset(Dataset):
         return {
             'input_ids': torch.as_tensor(input_ids, dtype=torch.long),
             'attention_mask': torch.as_tensor(attention_mask, dtype=torch.long),
+            'idx': idx,
         }
-    
+
+
+class LengthBucketSampler(Sampler):
+    # yields batches of indices with similar token lengths, so that padding per batch is minimal
+    def __init__(self, lengths, batch_size):
+        self.batch_size = batch_size
+        self.order = np.argsort(np.asarray(lengths), kind='stable').tolist()
+
+    def __len__(self):
+        return (len(self.order) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        for start in range(0, len(self.order), self.batch_size):
+            yield self.order[start:start + self.batch_size]
+
+
+def pad_collate(batch, pad_token_id=0):
+    # pad every sequence only up to the longest sequence of the batch
+    max_len = max(len(item['input_ids']) for item in batch)
+    input_ids = torch.full((len(batch), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(batch), max_len), dtype=torch.long)
+    for i, item in enumerate(batch):
+        n = len(item['input_ids'])
+        input_ids[i, :n] = item['input_ids']
+        attention_mask[i, :n] = item['attention_mask']
+    return {
+        'input_ids': input_ids,
+        'attention_mask': attention_mask,
+        'idx': torch.as_tensor([item['idx'] for item in batch], dtype=torch.long),
+    }
+
+
+def get_data_loader(dataset, batch_size, batching='fixed'):
+    # batching='fixed': every prompt padded to `max_length` (original behaviour)
+    # batching='bucketed': prompts grouped by token length and padded per batch
+    if batching == 'fixed':
+        return DataLoader(dataset, batch_size=batch_size)
+    if batching == 'bucketed':
+        if not dataset.dynamic_padding:
+            raise ValueError("bucketed batching requires an `InferenceDataset` with `dynamic_padding=True`")
+        pad_token_id = dataset.tokenizer.pad_token_id or 0
+        return DataLoader(
+            dataset,
+            batch_sampler=LengthBucketSampler(dataset.lengths(), batch_size),
+            collate_fn=functools.partial(pad_collate, pad_token_id=pad_token_id),
+        )
+    raise ValueError(f"unknown batching mode: {batching}")
+
+
 def infer(model, data_loader):
-    predictions = []
+    # predictions are returned in the original dataset order, whatever order the loader yields
+    predictions = {}
     for data in data_loader:
         mask = data["attention_mask"].to(device)
         ids = data["input_ids"].to(device)
@@ -41,21 +136,403 @@ def infer(model, data_loader):
             logits = model(ids, token_type_ids=None, attention_mask=mask)[0]
             logits = logits.detach().cpu().numpy()
             flat_predictions = np.argmax(logits, axis=1).flatten()
-            predictions.extend(flat_predictions)
-    return predictions
+            for idx, pred in zip(data["idx"].tolist(), flat_predictions):
+                predictions[idx] = pred
+    return [predictions[idx] for idx in sorted(predictions)]
+
+
+# candidate fields, in order, when `--text_field` / `--id_field` are not given
+TEXT_FIELDS = ['text', 'initial_prompt', 'question']
+ID_FIELDS = ['id', 'prompt_id', 'conversation_id', 'question_id']
+
+
+def pick_field(names, candidates, what):
+    for name in candidates:
+        if name in names:
+            return name
+    if what is None:
+        return None
+    raise ValueError(f"no {what} field among {sorted(names)}, set it explicitly")
+
+
+def iter_prompt_chunks(path, chunk_size=4096, text_field=None, id_field=None, skip_rows=0):
+    # Lazily reads a JSONL or parquet file as chunks of (prompt ids, texts), skipping the first
+    # `skip_rows` rows. Without an id field, the row number is the prompt id.
+    row = 0
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        pf = pq.ParquetFile(path)
+        names = pf.schema_arrow.names
+        text_field = text_field or pick_field(names, TEXT_FIELDS, 'text')
+        id_field = id_field or pick_field(names, ID_FIELDS, None)
+        columns = [text_field] + ([id_field] if id_field else [])
+        for batch in pf.iter_batches(batch_size=chunk_size, columns=columns):
+            if row + batch.num_rows <= skip_rows:
+                row += batch.num_rows
+                continue
+            offset = max(skip_rows - row, 0)
+            batch = batch.slice(offset)
+            texts = batch.column(text_field).to_pylist()
+            row += offset
+            ids = batch.column(id_field).to_pylist() if id_field else list(range(row, row + len(texts)))
+            row += len(texts)
+            yield ids, texts
+        return
+    ids, texts = [], []
+    with open(path) as fp:
+        for line in fp:
+            if not line.strip():
+                continue
+            if row < skip_rows:
+                row += 1
+                continue
+            record = json.loads(line)
+            if text_field is None:
+                text_field = pick_field(record, TEXT_FIELDS, 'text')
+                id_field = id_field or pick_field(record, ID_FIELDS, None)
+            ids.append(record[id_field] if id_field else row)
+            texts.append(record[text_field])
+            row += 1
+            if len(texts) == chunk_size:
+                yield ids, texts
+                ids, texts = [], []
+    if texts:
+        yield ids, texts
+
+
+_worker_tokenizer = None
+
+
+def _init_tokenizer_worker(tokenizer_name):
+    global _worker_tokenizer
+    from transformers import AutoTokenizer
+
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+    _worker_tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+
+
+WINDOW_AGGREGATIONS = ['mean', 'max', 'geometric', 'first']
+
+
+def split_windows(token_ids, cls_id, sep_id, max_length=512, stride=128, max_windows=8):
+    # Overlapping windows of `max_length` tokens (special tokens included) over a prompt tokenized
+    # without special tokens; consecutive windows share `stride` tokens and the last one ends with the
+    # prompt. Prompts with more than `max_windows` windows keep that many, evenly spaced (the first and
+    # last always included), which caps the compute per prompt.
+    body = max_length - 2
+    if len(token_ids) <= body:
+        return [[cls_id] + list(token_ids) + [sep_id]]
+    step = max(body - stride, 1)
+    starts = list(range(0, len(token_ids) - body, step)) + [len(token_ids) - body]
+    if len(starts) > max_windows:
+        starts = [starts[i] for i in np.unique(np.linspace(0, len(starts) - 1, max_windows).round().astype(int))]
+    return [[cls_id] + list(token_ids[s:s + body]) + [sep_id] for s in starts]
+
+
+def aggregate_window_probs(window_probs, owners, num_prompts, aggregation='mean', positive_index=1):
+    # one probability row per prompt from the probabilities of its windows (`owners[i]` is the prompt
+    # of window i, windows of a prompt in order):
+    # mean: average of the windows; max: the window most likely to need the superior model (any part of
+    # the prompt can make it hard); geometric: normalized geometric mean; first: the first window
+    # only, i.e. the truncation behaviour
+    if aggregation not in WINDOW_AGGREGATIONS:
+        raise ValueError(f"unknown aggregation: {aggregation}, expected one of {WINDOW_AGGREGATIONS}")
+    window_probs = np.asarray(window_probs, dtype=np.float32)
+    owners = np.asarray(owners)
+    if num_prompts == 0:
+        return np.zeros((0, window_probs.shape[1]), dtype=np.float32)
+    # windows are grouped by prompt: one reduction per group instead of a mask per prompt
+    starts = np.r_[0, np.flatnonzero(np.diff(owners)) + 1]
+    if len(starts) != num_prompts or owners[0] != 0 or np.any(np.diff(owners) < 0):
+        raise ValueError('expected at least one window per prompt, grouped by prompt in prompt order')
+    counts = np.diff(np.r_[starts, len(owners)])[:, None]
+    if aggregation == 'mean':
+        return (np.add.reduceat(window_probs, starts, axis=0) / counts).astype(np.float32)
+    if aggregation == 'max':
+        positive = window_probs[:, positive_index]
+        is_best = positive == np.repeat(np.maximum.reduceat(positive, starts), counts[:, 0])
+        # first window reaching its prompt's maximum, like `np.argmax`
+        best = np.minimum.reduceat(np.where(is_best, np.arange(len(owners)), len(owners)), starts)
+        return window_probs[best]
+    if aggregation == 'geometric':
+        log_p = np.add.reduceat(np.log(np.maximum(window_probs, 1e-12)), starts, axis=0) / counts
+        p = np.exp(log_p - log_p.max(axis=1, keepdims=True))
+        return (p / p.sum(axis=1, keepdims=True)).astype(np.float32)
+    return window_probs[starts]  # first
+
+
+def tokenize_chunk(texts, max_length=512, tokenizer=None, stride=None, max_windows=8):
+    # unpadded token ids; runs in a tokenizer worker process unless `tokenizer` is given.
+    # With `stride`, long prompts are split into windows instead of truncated: returns the token ids
+    # of all windows and the index of the prompt of each window.
+    tokenizer = tokenizer or _worker_tokenizer
+    texts = ['' if t is None else t for t in texts]
+    if stride is None:
+        return tokenizer(
+            texts,
+            add_special_tokens=True,
+            max_length=max_length,
+            truncation=True,
+            return_attention_mask=False,
+        )['input_ids']
+    windows, owners = [], []
+    token_ids = tokenizer(texts, add_special_tokens=False, return_attention_mask=False, verbose=False)['input_ids']
+    for i, ids in enumerate(token_ids):
+        prompt_windows = split_windows(
+            ids, tokenizer.cls_token_id, tokenizer.sep_token_id, max_length, stride=stride, max_windows=max_windows
+        )
+        windows.extend(prompt_windows)
+        owners.extend([i] * len(prompt_windows))
+    return windows, owners
+
+
+def route_token_ids(model, token_ids, batch_size, pad_token_id=0):
+    # probabilities of every prompt, in input order; batches group prompts of similar length
+    probs = np.zeros((len(token_ids), 2), dtype=np.float32)
+    sampler = LengthBucketSampler([len(ids) for ids in token_ids], batch_size)
+    with torch.no_grad():
+        for batch_idx in sampler:
+            batch = pad_collate(
+                [
+                    {
+                        'input_ids': torch.as_tensor(token_ids[i], dtype=torch.long),
+                        'attention_mask': torch.ones(len(token_ids[i]), dtype=torch.long),
+                        'idx': i,
+                    }
+                    for i in batch_idx
+                ],
+                pad_token_id=pad_token_id,
+            )
+            logits = model(
+                batch['input_ids'].to(device), token_type_ids=None, attention_mask=batch['attention_mask'].to(device)
+            )[0]
+            probs[batch_idx] = torch.nn.functional.softmax(logits, dim=1).cpu().numpy()
+    return probs
+
+
+def bulk_route(
+    model,
+    input_file,
+    out_file,
+    tokenizer_name,
+    id2label,
+    batch_size=64,
+    chunk_size=4096,
+    num_workers=2,
+    prefetch_chunks=None,
+    checkpoint_rows=50_000,
+    resume=False,
+    text_field=None,
+    id_field=None,
+    max_length=512,
+    window_stride=None,
+    max_windows=8,
+    aggregation='mean',
+):
+    # Routes every prompt of `input_file` and appends {prompt_id, <label>: prob, ..., route} lines to
+    # `out_file`. Chunks are tokenized by `num_workers` processes while the model routes earlier chunks;
+    # at most `prefetch_chunks` chunks are in flight, so memory stays bounded whatever the file size.
+    # Rows are committed (fsync + manifest) every `checkpoint_rows` rows; `resume` continues after
+    # the last committed row, and only if the run used the same input, weights and routing settings.
+    # With `window_stride`, prompts longer than `max_length` tokens are routed on up to `max_windows`
+    # overlapping windows (see `split_windows`) whose probabilities are combined with `aggregation`.
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'create_dataset'))
+    from labeling_checkpoint import CheckpointWriter
+    from route_cache import get_model_identity
+
+    # everything that changes the routes: a resumed run must not mix the rows of two routers
+    run_info = {
+        'input_file': os.path.abspath(input_file),
+        'model': str(getattr(model, 'name_or_path', '')),
+        'model_identity': get_model_identity(model),
+        'tokenizer': tokenizer_name,
+        'text_field': text_field,
+        'id_field': id_field,
+        'max_length': max_length,
+        'window_stride': window_stride,
+        'max_windows': max_windows if window_stride is not None else None,
+        'aggregation': aggregation if window_stride is not None else None,
+    }
+    if os.path.exists(out_file) and not resume:
+        raise FileExistsError(f"{out_file} exists, pass --resume to continue it or remove it")
+    writer = CheckpointWriter(out_file, run_info=run_info)
+    previous = writer.manifest['run_info']
+    changed = [key for key in run_info if previous.get(key) != run_info[key]]
+    if changed:
+        raise ValueError(
+            f"{out_file} was written with other settings, can not resume it: "
+            + ', '.join(f"{key} {previous.get(key)!r} != {run_info[key]!r}" for key in changed)
+        )
+    skip_rows = writer.manifest['num_labelled']
+    if skip_rows:
+        print(f"resuming after {skip_rows} routed prompts")
+
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+    pad_token_id = tokenizer.pad_token_id or 0
+    pool = None
+    if num_workers > 0:
+        pool = mp.get_context('spawn').Pool(
+            num_workers, initializer=_init_tokenizer_worker, initargs=(tokenizer_name,)
+        )
+    prefetch_chunks = prefetch_chunks or 2 * max(num_workers, 1)
+
+    chunks = iter_prompt_chunks(input_file, chunk_size, text_field=text_field, id_field=id_field, skip_rows=skip_rows)
+    pending = collections.deque()
+    buffer = []
+    num_routed = 0
+    t0 = time.perf_counter()
+
+    def submit_next():
+        chunk = next(chunks, None)
+        if chunk is None:
+            return False
+        ids, texts = chunk
+        if pool is not None:
+            pending.append((ids, pool.apply_async(tokenize_chunk, (texts, max_length, None, window_stride, max_windows))))
+        else:
+            pending.append(
+                (ids, tokenize_chunk(texts, max_length, tokenizer=tokenizer, stride=window_stride, max_windows=max_windows))
+            )
+        return True
+
+    try:
+        while len(pending) < prefetch_chunks and submit_next():
+            pass
+        while pending:
+            ids, token_ids = pending.popleft()
+            token_ids = token_ids.get() if pool is not None else token_ids
+            submit_next()
+            if window_stride is None:
+                probs = route_token_ids(model, token_ids, batch_size, pad_token_id=pad_token_id)
+            else:
+                windows, owners = token_ids
+                window_probs = route_token_ids(model, windows, batch_size, pad_token_id=pad_token_id)
+                probs = aggregate_window_probs(window_probs, owners, len(ids), aggregation)
+            for prompt_id, p in zip(ids, probs.tolist()):
+                row = {'prompt_id': prompt_id}
+                row.update({label: p[i] for i, label in id2label.items()})
+                row['route'] = id2label[int(np.argmax(p))]
+                buffer.append(row)
+            num_routed += len(ids)
+            if len(buffer) >= checkpoint_rows:
+                writer.write_batch(buffer)
+                buffer = []
+                elapsed = time.perf_counter() - t0
+                print(f"{skip_rows + num_routed} prompts routed ({num_routed / elapsed:.1f} prompts/sec)")
+        writer.write_batch(buffer)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    elapsed = time.perf_counter() - t0
+    return {
+        'num_routed': num_routed,
+        'num_skipped': skip_rows,
+        'seconds': elapsed,
+        'prompts_per_sec': num_routed / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--model_save_dir',
+        type=str,
+        default='../models/bert-base-uncased-router-finetuning-20240715T135747-save',
+        help='The directory where the BERT model weights are stored (used `model.save_pretrained(...)`',
+    )
+    parser.add_argument(
+        '--hf_model_name', type=str, default='bert-base-uncased', help='The tokenizer name in hugging face'
+    )
+    parser.add_argument(
+        '--backend',
+        type=str,
+        default='torch',
+        choices=['torch', 'onnx'],
+        help='`onnx` runs the int8 graph exported by `onnx_backend.py` (`--model_save_dir` points to its output)',
+    )
+    parser.add_argument(
+        '--input_file',
+        type=str,
+        default=None,
+        help='JSONL or parquet prompts to route; without it, a few sample prompts are routed and printed',
+    )
+    parser.add_argument(
+        '--out_file', type=str, default=None, help='JSONL routes, defaults to `<input_file>.routes.jsonl`'
+    )
+    parser.add_argument(
+        '--text_field', type=str, default=None, help='Defaults to the first of: ' + ', '.join(TEXT_FIELDS)
+    )
+    parser.add_argument(
+        '--id_field',
+        type=str,
+        default=None,
+        help='Defaults to the first of: ' + ', '.join(ID_FIELDS) + ' (or the row number)',
+    )
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument(
+        '--batching',
+        type=str,
+        default='bucketed',
+        choices=['fixed', 'bucketed'],
+        help='Batching of the sample prompts (`fixed` pads every prompt to 512 tokens); bulk routing always buckets',
+    )
+    parser.add_argument('--chunk_size', type=int, default=4096, help='Prompts read and tokenized at a time')
+    parser.add_argument('--num_workers', type=int, default=2, help='Tokenizer processes (0 tokenizes in this process)')
+    parser.add_argument('--checkpoint_rows', type=int, default=50_000, help='Commit the output every this many prompts')
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted run from its last checkpoint')
+    parser.add_argument(
+        '--window_stride',
+        type=int,
+        default=None,
+        help='Route prompts over 512 tokens on overlapping windows sharing this many tokens (truncated if not set)',
+    )
+    parser.add_argument('--max_windows', type=int, default=8, help='Maximum number of windows routed per prompt')
+    parser.add_argument(
+        '--aggregation',
+        type=str,
+        default='mean',
+        choices=WINDOW_AGGREGATIONS,
+        help='How the window probabilities of a long prompt are combined (see `aggregate_window_probs`)',
+    )
+    return parser.parse_args()
+
 
 if __name__ == "__main__":
     torch.cuda.empty_cache()
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
-    HF_MODEL_NAME = "bert-base-uncased"
-    RELATIVE_FOLDER_PATH = "../models/bert-base-uncased-router-finetuning-20240715T135747-save"
-    SAVE_DIRECTORY = os.path.join(os.path.dirname(__file__), RELATIVE_FOLDER_PATH)
-    BATCH_SIZE = 16
+    args = parse_args()
+    save_directory = os.path.join(os.getcwd(), args.model_save_dir)
 
-    model = BertForSequenceClassification.from_pretrained(SAVE_DIRECTORY)
-    tokenizer = AutoTokenizer.from_pretrained(HF_MODEL_NAME)
+    from onnx_backend import load_router_model
+    model = load_router_model(save_directory, backend=args.backend)
     model.to(device)
+    model.eval()
+
+    id2label ={ 0: "ROUTE_TO_INFERIOR", 1: "ROUTE_TO_SUPERIOR" }
+
+    if args.input_file is not None:
+        stats = bulk_route(
+            model,
+            args.input_file,
+            args.out_file or args.input_file.rsplit('.', 1)[0] + '.routes.jsonl',
+            tokenizer_name=args.hf_model_name,
+            id2label=id2label,
+            batch_size=args.batch_size,
+            chunk_size=args.chunk_size,
+            num_workers=args.num_workers,
+            checkpoint_rows=args.checkpoint_rows,
+            resume=args.resume,
+            text_field=args.text_field,
+            id_field=args.id_field,
+            window_stride=args.window_stride,
+            max_windows=args.max_windows,
+            aggregation=args.aggregation,
+        )
+        print(json.dumps(stats))
+        sys.exit(0)
 
     data = [
         "Compose an engaging travel blog post about a recent trip to Hawaii, highlighting cultural experiences and must-see attractions.",
@@ -113,10 +590,8 @@ if __name__ == "__main__":
     #     'What are some business etiquette norms when doing business in Japan?'
     # ]
 
-    dataset = InferenceDataset(data, tokenizer_name=HF_MODEL_NAME)
-    loader = DataLoader(dataset, batch_size=BATCH_SIZE)
-
-    id2label ={ 0: "ROUTE_TO_INFERIOR", 1: "ROUTE_TO_SUPERIOR" }
+    dataset = InferenceDataset(data, tokenizer_name=args.hf_model_name, dynamic_padding=(args.batching == 'bucketed'))
+    loader = get_data_loader(dataset, batch_size=args.batch_size, batching=args.batching)
 
     preds = infer(model, loader)
     for pred_id, text in zip(preds, data):
@@ -0,0 +1,456 @@
+import argparse
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import torch
+
+from run_gradio_model import device, infer_batch
+
+META_FILENAME = "meta.json"
+INT8_SCALE = 127.0
+
+
+class RouterEncoder:
+    # Embeds prompts with the pooled [CLS] representation of a `BertForSequenceClassification`, i.e.
+    # the input of its classifier head, L2-normalized. With the router itself as encoder, `encode` also
+    # returns the route probabilities from the same forward pass (the head is a single linear layer);
+    # a cheaper encoder (e.g. a student of `distill_router.py`) only provides the embeddings.
+    def __init__(self, model, tokenizer, max_length=512, batch_size=64):
+        if not hasattr(model, "bert"):
+            raise ValueError("the encoder needs a torch `BertForSequenceClassification` (not the onnx backend)")
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.dim = model.config.hidden_size
+        path = getattr(model, "name_or_path", "")
+        self.path = os.path.realpath(path) if os.path.isdir(path) else None
+
+    def encode(self, texts):
+        embeddings, probs = [], []
+        with torch.no_grad():
+            for start in range(0, len(texts), self.batch_size):
+                encoding = self.tokenizer(
+                    list(texts[start:start + self.batch_size]),
+                    max_length=self.max_length,
+                    padding="longest",
+                    truncation=True,
+                    return_tensors="pt",
+                )
+                pooled = self.model.bert(
+                    encoding["input_ids"].to(device), attention_mask=encoding["attention_mask"].to(device)
+                )[1]
+                logits = self.model.classifier(self.model.dropout(pooled))
+                probs.append(torch.softmax(logits, dim=1).float().cpu().numpy())
+                embeddings.append(torch.nn.functional.normalize(pooled, dim=1).float().cpu().numpy())
+        if not embeddings:
+            return np.zeros((0, self.dim), dtype=np.float32), np.zeros((0, 2), dtype=np.float32)
+        return np.concatenate(embeddings), np.concatenate(probs)
+
+
+def kmeans(vectors, num_clusters, num_iters=10, seed=0):
+    # spherical k-means on normalized vectors (assignment by max dot product)
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=num_clusters, replace=False)].copy()
+    for _ in range(num_iters):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        for c in range(num_clusters):
+            members = vectors[assignments == c]
+            if len(members):
+                centroid = members.sum(axis=0)
+                centroids[c] = centroid / max(np.linalg.norm(centroid), 1e-12)
+    return centroids.astype(np.float32)
+
+
+class EmbeddingIndex:
+    # Contiguous matrix of normalized embeddings (float32, or int8 scaled by 127) with the route
+    # probabilities of every row, stored as memory-mapped `.npy` files in `path`. Inserts append to the
+    # files (doubling their capacity when full); `meta.json`, written atomically after the arrays are
+    # flushed, holds the number of valid rows, so a crash never exposes half-written rows.
+    # After `train_ivf`, search is approximate: only the rows of the `nprobe` clusters closest to the
+    # query are scored (inverted file index); otherwise every row is scored.
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILENAME)) as fp:
+            self.meta = json.load(fp)
+        self.dim = self.meta["dim"]
+        self.dtype = np.dtype(self.meta["dtype"])
+        self.lock = threading.Lock()
+        self._open_arrays()
+        self.centroids = None
+        self.lists = None
+        if os.path.exists(self._file("centroids")):
+            self.centroids = np.load(self._file("centroids"))
+            assignments = np.asarray(self.assignments[: len(self)])
+            self.lists = [list(np.flatnonzero(assignments == c)) for c in range(len(self.centroids))]
+
+    @classmethod
+    def create(cls, path, dim, dtype="float32", capacity=1024, encoder_path=None):
+        os.makedirs(path, exist_ok=True)
+        dtype = np.dtype(dtype)
+        if dtype not in (np.float32, np.int8):
+            raise ValueError(f"unsupported dtype: {dtype}")
+        np.lib.format.open_memmap(os.path.join(path, "vectors.npy"), mode="w+", dtype=dtype, shape=(capacity, dim))
+        np.lib.format.open_memmap(os.path.join(path, "probs.npy"), mode="w+", dtype=np.float32, shape=(capacity, 2))
+        np.lib.format.open_memmap(os.path.join(path, "assignments.npy"), mode="w+", dtype=np.int32, shape=(capacity,))
+        meta = {
+            "dim": dim,
+            "dtype": dtype.name,
+            "size": 0,
+            "capacity": capacity,
+            "encoder_path": encoder_path,
+        }
+        _write_json_atomic(os.path.join(path, META_FILENAME), meta)
+        return cls(path)
+
+    def _file(self, name):
+        return os.path.join(self.path, f"{name}.npy")
+
+    def _open_arrays(self):
+        self.vectors = np.load(self._file("vectors"), mmap_mode="r+")
+        self.probs = np.load(self._file("probs"), mmap_mode="r+")
+        self.assignments = np.load(self._file("assignments"), mmap_mode="r+")
+
+    def __len__(self):
+        return self.meta["size"]
+
+    def _grow(self, min_capacity):
+        capacity = max(min_capacity, 2 * self.meta["capacity"])
+        size = len(self)
+        for name, array in [("vectors", self.vectors), ("probs", self.probs), ("assignments", self.assignments)]:
+            tmp_path = self._file(f"{name}.tmp")
+            grown = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=array.dtype, shape=(capacity,) + array.shape[1:])
+            grown[:size] = array[:size]
+            grown.flush()
+            del grown
+            os.replace(tmp_path, self._file(name))
+        self.meta["capacity"] = capacity
+        self._open_arrays()
+
+    def _quantize(self, vectors):
+        if self.dtype == np.int8:
+            return np.clip(np.round(vectors * INT8_SCALE), -127, 127).astype(np.int8)
+        return vectors.astype(np.float32)
+
+    def add(self, vectors, probs):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        probs = np.asarray(probs, dtype=np.float32).reshape(-1, 2)
+        with self.lock:
+            start = len(self)
+            end = start + len(vectors)
+            if end > self.meta["capacity"]:
+                self._grow(end)
+            self.vectors[start:end] = self._quantize(vectors)
+            self.probs[start:end] = probs
+            if self.centroids is not None:
+                assignments = np.argmax(vectors @ self.centroids.T, axis=1)
+                self.assignments[start:end] = assignments
+                for i, c in enumerate(assignments):
+                    self.lists[c].append(start + i)
+            self.meta["size"] = end
+        return list(range(start, end))
+
+    def flush(self):
+        with self.lock:
+            for array in (self.vectors, self.probs, self.assignments):
+                array.flush()
+            _write_json_atomic(os.path.join(self.path, META_FILENAME), self.meta)
+
+    def train_ivf(self, num_lists=None, num_iters=10, seed=0):
+        # clusters the current rows; later inserts are assigned to the nearest cluster
+        with self.lock:
+            vectors = self._dequantize(self.vectors[: len(self)])
+            num_lists = num_lists or max(1, int(np.sqrt(len(vectors))))
+            self.centroids = kmeans(vectors, min(num_lists, len(vectors)), num_iters=num_iters, seed=seed)
+            assignments = np.argmax(vectors @ self.centroids.T, axis=1)
+            self.assignments[: len(self)] = assignments
+            self.lists = [list(np.flatnonzero(assignments == c)) for c in range(len(self.centroids))]
+            np.save(self._file("centroids"), self.centroids)
+
+    def _dequantize(self, vectors):
+        if self.dtype == np.int8:
+            return vectors.astype(np.float32) / INT8_SCALE
+        return np.asarray(vectors)
+
+    def _score(self, rows, query):
+        # cosine similarity of `query` with `rows` (int8 rows are scored in chunks to bound memory)
+        if self.dtype == np.float32:
+            return rows @ query
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), 65_536):
+            scores[start:start + 65_536] = rows[start:start + 65_536].astype(np.float32) @ query
+        return scores / INT8_SCALE
+
+    def search(self, queries, k=1, nprobe=8, exact=False):
+        # top-`k` (similarities, row ids) per query, -1 where there are fewer than `k` candidates
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        sims = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        size = len(self)
+        if size == 0:
+            return sims, ids
+        for qi, query in enumerate(queries):
+            if self.centroids is None or exact:
+                candidates = None
+                scores = self._score(self.vectors[:size], query)
+            else:
+                probe = np.argsort(-(self.centroids @ query))[:nprobe]
+                candidates = np.fromiter((i for c in probe for i in self.lists[c]), dtype=np.int64)
+                if len(candidates) == 0:
+                    continue
+                scores = self._score(self.vectors[candidates], query)
+            top = np.argsort(-scores)[:k]
+            sims[qi, : len(top)] = scores[top]
+            ids[qi, : len(top)] = top if candidates is None else candidates[top]
+        return sims, ids
+
+
+def _write_json_atomic(path, obj):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump(obj, fp, indent=2)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
+
+
+def build_index(path, encoder, texts, probs=None, dtype="float32", num_lists=None):
+    # indexes `texts` with `probs` as their routes (defaults to the encoder's own routes, only valid
+    # when the encoder is the router)
+    embeddings, encoder_probs = encoder.encode(texts)
+    index = EmbeddingIndex.create(
+        path,
+        encoder.dim,
+        dtype=dtype,
+        capacity=max(1024, len(texts)),
+        encoder_path=encoder.path,
+    )
+    index.add(embeddings, encoder_probs if probs is None else probs)
+    if num_lists != 0 and len(texts) >= 2:
+        index.train_ivf(num_lists)
+    index.flush()
+    return index
+
+
+class SemanticRouter:
+    # Reuses the route of the nearest indexed prompt when its cosine similarity is at least `threshold`.
+    # Other prompts are routed by the router: if the encoder is the router, its probabilities come from
+    # the same forward pass; otherwise `model` routes them. Routed prompts are added to the index
+    # (recent traffic) until it holds `max_entries` rows, and persisted every `flush_every` inserts.
+    # Reuse only saves work with a cheaper encoder (e.g. a student of `distill_router.py`): when the
+    # encoder is the router, its fresh probabilities are already there, so by default (`reuse=None`)
+    # they are returned and the index only counts the hits.
+    def __init__(
+        self,
+        index,
+        encoder,
+        model,
+        tokenizer,
+        id2label,
+        threshold=0.95,
+        nprobe=8,
+        insert_misses=True,
+        max_entries=1_000_000,
+        flush_every=1024,
+        reuse=None,
+    ):
+        if index.dim != encoder.dim or index.meta.get("encoder_path") not in (None, encoder.path):
+            raise ValueError("the index was built with another encoder, its embeddings are not comparable")
+        self.index = index
+        self.encoder = encoder
+        self.model = model
+        self.tokenizer = tokenizer
+        self.id2label = id2label
+        self.threshold = threshold
+        self.nprobe = nprobe
+        self.insert_misses = insert_misses
+        self.max_entries = max_entries
+        self.flush_every = flush_every
+        self.unflushed = 0
+        self.encoder_is_router = encoder.model is model
+        self.reuse = not self.encoder_is_router if reuse is None else reuse
+        self.hits = self.misses = 0
+
+    def route_batch(self, texts):
+        # list of ({label: prob}, similarity of the neighbour within `threshold` or None) in input order
+        embeddings, encoder_probs = self.encoder.encode(texts)
+        sims, ids = self.index.search(embeddings, k=1, nprobe=self.nprobe)
+        is_hit = (ids[:, 0] >= 0) & (sims[:, 0] >= self.threshold)
+        self.hits += int(is_hit.sum())
+        self.misses += int((~is_hit).sum())
+        probs = np.empty((len(texts), 2), dtype=np.float32)
+        routed = np.flatnonzero(~is_hit) if self.reuse else np.arange(len(texts))
+        if self.reuse:
+            probs[is_hit] = self.index.probs[ids[is_hit, 0]]
+        if len(routed):
+            if self.encoder_is_router:
+                probs[routed] = encoder_probs[routed]
+            else:
+                res = infer_batch(
+                    [texts[i] for i in routed], model=self.model, tokenizer=self.tokenizer, id2label=self.id2label
+                )
+                probs[routed] = [[r[self.id2label[j]] for j in sorted(self.id2label)] for r in res]
+        missed = np.flatnonzero(~is_hit)
+        if len(missed) and self.insert_misses and len(self.index) + len(missed) <= self.max_entries:
+            self.index.add(embeddings[missed], probs[missed])
+            self.unflushed += len(missed)
+            if self.unflushed >= self.flush_every:
+                self.index.flush()
+                self.unflushed = 0
+        return [
+            ({label: float(p[j]) for j, label in self.id2label.items()}, float(sim) if hit else None)
+            for p, sim, hit in zip(probs, sims[:, 0], is_hit)
+        ]
+
+    # same signatures as `infer_single` / `infer_batch` of `run_gradio_model.py`
+    def infer_single_compat(self, text, model=None, tokenizer=None, id2label=None):
+        return self.route_batch([text])[0][0]
+
+    def infer_batch_compat(self, texts, model=None, tokenizer=None, id2label=None):
+        return [res for res, _ in self.route_batch(texts)]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self.index), "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+def load_semantic_router(index_dir, model, tokenizer, id2label, threshold=0.95, **kwargs):
+    # the encoder is the router unless the index was built with another model
+    from transformers import BertForSequenceClassification
+
+    index = EmbeddingIndex(index_dir)
+    encoder_model = model
+    encoder_path = index.meta.get("encoder_path")
+    if encoder_path and encoder_path != RouterEncoder(model, tokenizer).path:
+        encoder_model = BertForSequenceClassification.from_pretrained(encoder_path).to(device).eval()
+    return SemanticRouter(index, RouterEncoder(encoder_model, tokenizer), model, tokenizer, id2label, threshold, **kwargs)
+
+
+def benchmark_index(index, queries, k=1, nprobe_values=(1, 4, 8, 16)):
+    # recall@k of the approximate search against the exact search, and latency per query
+    t0 = time.perf_counter()
+    _, exact_ids = index.search(queries, k=k, exact=True)
+    exact_ms = (time.perf_counter() - t0) * 1000 / len(queries)
+    report = {"num_rows": len(index), "dtype": index.dtype.name, "num_queries": len(queries), "exact_ms_per_query": exact_ms}
+    if index.centroids is not None:
+        report["num_lists"] = len(index.centroids)
+        report["ivf"] = []
+        for nprobe in nprobe_values:
+            t0 = time.perf_counter()
+            _, ids = index.search(queries, k=k, nprobe=nprobe)
+            ms = (time.perf_counter() - t0) * 1000 / len(queries)
+            recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(ids.tolist(), exact_ids.tolist())])
+            report["ivf"].append({"nprobe": nprobe, "recall_at_k": float(recall), "ms_per_query": ms})
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_save_dir",
+        type=str,
+        default="../models/bert-base-uncased-router-finetuning-20240722T133228-save",
+        help="The router (used `model.save_pretrained(...)`)",
+    )
+    parser.add_argument(
+        "--encoder_dir",
+        type=str,
+        default=None,
+        help="Cheaper encoder, e.g. a student of `distill_router.py` (defaults to the router itself)",
+    )
+    parser.add_argument("--hf_model_name", type=str, default="bert-base-uncased", help="The tokenizer name in hugging face")
+    parser.add_argument(
+        "--train_file",
+        type=str,
+        default="../final-datasets/router_dataset_all.jsonl",
+        help="Labelled synthetic dataset to index",
+    )
+    parser.add_argument(
+        "--test_file",
+        type=str,
+        default="../final-datasets/original_questions_labelled.jsonl",
+        help="Prompts used as queries of the benchmark",
+    )
+    parser.add_argument(
+        "--labels",
+        type=str,
+        default="router",
+        choices=["router", "dataset"],
+        help="Index the router's probabilities or the dataset labels (as one-hot probabilities)",
+    )
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "int8"])
+    parser.add_argument("--num_lists", type=int, default=None, help="IVF clusters (defaults to sqrt(rows), 0 disables)")
+    parser.add_argument("--threshold", type=float, default=0.95, help="Similarity from which a route is reused")
+    parser.add_argument("--out_dir", type=str, default=None, help="Defaults to `<model_save_dir>-semantic-index`")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from transformers import AutoTokenizer, BertForSequenceClassification
+
+    from router_datasets import (
+        import_df_from_jsonl_file,
+        import_labelled_df,
+        process_questions_dataset,
+        process_synthetic_dataset,
+    )
+
+    args = parse_args()
+    tokenizer = AutoTokenizer.from_pretrained(args.hf_model_name)
+    save_directory = os.path.join(os.getcwd(), args.model_save_dir)
+    model = BertForSequenceClassification.from_pretrained(save_directory).to(device).eval()
+    encoder_model = model
+    if args.encoder_dir is not None:
+        encoder_model = BertForSequenceClassification.from_pretrained(os.path.join(os.getcwd(), args.encoder_dir))
+        encoder_model.to(device).eval()
+    encoder = RouterEncoder(encoder_model, tokenizer)
+    id2label = {0: "ROUTE_TO_INFERIOR", 1: "ROUTE_TO_SUPERIOR"}
+
+    train_df = process_synthetic_dataset(import_labelled_df(args.train_file), make_balanced=False, max_length=0)
+    texts = train_df["text"].tolist()
+    if args.labels == "dataset":
+        probs = np.eye(2, dtype=np.float32)[train_df["target"].to_numpy()]
+    elif encoder_model is model:
+        probs = None
+    else:
+        # the router's own probabilities, in batches (`encode` also returns the classifier probabilities)
+        _, probs = RouterEncoder(model, tokenizer).encode(texts)
+    out_dir = args.out_dir or save_directory.rstrip("/") + "-semantic-index"
+    t0 = time.perf_counter()
+    index = build_index(out_dir, encoder, texts, probs=probs, dtype=args.dtype, num_lists=args.num_lists)
+    print(f"indexed {len(index)} prompts in {time.perf_counter() - t0:.1f}s into {out_dir}")
+
+    test_texts = process_questions_dataset(import_df_from_jsonl_file(args.test_file))["text"].tolist()
+    queries, _ = encoder.encode(test_texts)
+    report = benchmark_index(index, queries)
+
+    # route reuse on the test prompts: how many reuse a route, and how often it agrees with the router
+    # (reuse forced on, to measure what it costs even when the encoder is the router)
+    router = SemanticRouter(
+        index, encoder, model, tokenizer, id2label, threshold=args.threshold, insert_misses=False, reuse=True
+    )
+    t0 = time.perf_counter()
+    reused = router.route_batch(test_texts)
+    semantic_ms = (time.perf_counter() - t0) * 1000 / len(test_texts)
+    t0 = time.perf_counter()
+    full = [
+        res
+        for start in range(0, len(test_texts), 32)
+        for res in infer_batch(test_texts[start:start + 32], model, tokenizer, id2label)
+    ]
+    full_ms = (time.perf_counter() - t0) * 1000 / len(test_texts)
+    hits = [(res, f) for (res, sim), f in zip(reused, full) if sim is not None]
+    report["reuse"] = {
+        "threshold": args.threshold,
+        "hit_rate": len(hits) / len(test_texts),
+        "agreement_on_hits": float(np.mean([max(a, key=a.get) == max(b, key=b.get) for a, b in hits])) if hits else None,
+        "semantic_ms_per_prompt": semantic_ms,
+        "router_ms_per_prompt": full_ms,
+    }
+    with open(os.path.join(out_dir, "benchmark.json"), "w") as fp:
+        json.dump(report, fp, indent=2)
+    print(json.dumps(report, indent=2))
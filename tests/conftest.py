@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# the scripts import each other from their own directories, as when run from there
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+for subdir in ["inference", "create_dataset", "finetuning_model"]:
+    sys.path.append(os.path.join(ROOT_DIR, subdir))
+
+
+@pytest.fixture(scope="session")
+def tiny_router(tmp_path_factory):
+    # (model, tokenizer, id2label): randomly initialized tiny BERT and offline tokenizer of `benchmark_router.py`
+    from benchmark_router import ID2LABEL, make_offline_tokenizer, make_tiny_model
+
+    tokenizer = make_offline_tokenizer(str(tmp_path_factory.mktemp("tokenizer")))
+    model = make_tiny_model(len(tokenizer), num_layers=1, hidden_size=32, num_heads=2)
+    return model, tokenizer, ID2LABEL
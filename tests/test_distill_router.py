@@ -0,0 +1,82 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+from transformers import BertForSequenceClassification
+
+from benchmark_batching import SAMPLE_PROMPTS
+from benchmark_router import make_offline_tokenizer, make_tiny_model
+from distill_router import build_report, distillation_loss, get_logits, iter_batches, make_student, train_student
+
+TEXTS = [f"{prompt} ({i})" for i in range(4) for prompt in SAMPLE_PROMPTS]
+
+
+def mean_distillation_loss(student, texts, teacher_logits, targets, tokenizer, args):
+    teacher_probs = torch.softmax(torch.as_tensor(teacher_logits) / args.temperature, dim=1)
+    logits = torch.as_tensor(get_logits(student, texts, tokenizer, max_length=args.max_length))
+    return distillation_loss(
+        logits, teacher_probs, torch.as_tensor(targets, dtype=torch.long), args.temperature, args.alpha
+    ).item()
+
+
+def test_tiny_student_trains_on_cpu_and_saves(tmp_path):
+    torch.manual_seed(0)
+    tokenizer = make_offline_tokenizer(str(tmp_path / "tokenizer"))
+    teacher = make_tiny_model(len(tokenizer), num_layers=2, hidden_size=64, num_heads=2)
+    args = SimpleNamespace(temperature=2.0, alpha=0.9, epochs=15, batch_size=8, lr=1e-3, max_length=64, seed=0)
+    targets = np.arange(len(TEXTS)) % 2
+    teacher_logits = get_logits(teacher, TEXTS, tokenizer, max_length=args.max_length)
+
+    student = make_student(teacher, num_layers=1, hidden_size=32, num_heads=2)
+    assert student.config.num_hidden_layers == 1 and student.config.intermediate_size == 128
+    loss_before = mean_distillation_loss(student, TEXTS, teacher_logits, targets, tokenizer, args)
+    student = train_student(student, TEXTS, teacher_logits, targets, tokenizer, args)
+    assert mean_distillation_loss(student, TEXTS, teacher_logits, targets, tokenizer, args) < loss_before
+
+    out_dir = tmp_path / "student"
+    student.save_pretrained(out_dir)
+    reloaded = BertForSequenceClassification.from_pretrained(out_dir).eval()
+    np.testing.assert_allclose(
+        get_logits(reloaded, TEXTS, tokenizer, max_length=args.max_length),
+        get_logits(student, TEXTS, tokenizer, max_length=args.max_length),
+        atol=1e-5,
+    )
+
+    report = build_report(teacher, student, TEXTS, targets, tokenizer, args.max_length)
+    for name in ["teacher", "student"]:
+        assert {"num_params", "size_mb", "latency_ms_batch_1", "latency_ms_batch_32"} <= report[name].keys()
+        assert {"accuracy", "precision", "recall", "f1"} <= report[name]["test"].keys()
+    assert report["student"]["num_params"] < report["teacher"]["num_params"]
+    assert 0 < report["size_ratio"] < 1
+    assert 0 <= report["student_teacher_agreement"] <= 1
+
+
+def test_same_width_student_starts_from_teacher_layers(tmp_path):
+    tokenizer = make_offline_tokenizer(str(tmp_path / "tokenizer"))
+    teacher = make_tiny_model(len(tokenizer), num_layers=4, hidden_size=32, num_heads=2)
+    student = make_student(teacher, num_layers=2, hidden_size=32, num_heads=2)
+    # evenly spaced teacher layers: 0 and 3
+    for student_layer, teacher_id in zip(student.bert.encoder.layer, [0, 3]):
+        for (name, p), (_, q) in zip(
+            student_layer.named_parameters(), teacher.bert.encoder.layer[teacher_id].named_parameters()
+        ):
+            assert torch.equal(p, q), name
+    _, ids, mask = next(iter_batches(TEXTS[:2], tokenizer, 2, 64))
+    assert student(ids, attention_mask=mask)[0].shape == (2, 2)
+
+
+def test_narrower_student_starts_from_the_pretrained_compact_bert(tmp_path):
+    tokenizer = make_offline_tokenizer(str(tmp_path / "tokenizer"))
+    teacher = make_tiny_model(len(tokenizer), num_layers=2, hidden_size=64, num_heads=2)
+    # stands in for a pretrained compact BERT of the student's shape, e.g. google/bert_uncased_L-4_H-384_A-6
+    compact = make_tiny_model(len(tokenizer), num_layers=1, hidden_size=32, num_heads=2)
+    compact.save_pretrained(tmp_path / "compact")
+
+    student = make_student(teacher, num_layers=1, hidden_size=32, num_heads=2, init_from=str(tmp_path / "compact"))
+    for (name, p), (_, q) in zip(student.bert.named_parameters(), compact.bert.named_parameters()):
+        assert torch.equal(p, q), name
+    assert student.config.id2label == teacher.config.id2label
+
+    with pytest.raises(ValueError, match="pick the matching"):
+        make_student(teacher, num_layers=2, hidden_size=32, num_heads=2, init_from=str(tmp_path / "compact"))
@@ -0,0 +1,78 @@
+import asyncio
+import time
+
+from fake_openai_server import fake_label, make_app, start_server
+from labeling_engine import RateLimiter, TokenBucket, label_prompts, make_async_client
+
+PROMPTS = [f"* Question: {'word ' * (i * 3)}question {i}\n* Label: ____" for i in range(12)]
+EXPECTED = [fake_label(p) for p in PROMPTS]
+
+
+def run_labelling(app_kwargs=None, **kwargs):
+    # labels `PROMPTS` against a `fake_openai_server.py` stand-in; returns (results, on_result calls, server stats)
+    async def main():
+        app = make_app(**{"latency_ms": 0, "seed": 0, **(app_kwargs or {})})
+        runner, base_url = await start_server(app)
+        client = make_async_client(api_key="test", base_url=base_url)
+        calls = []
+        try:
+            results = await label_prompts(
+                PROMPTS, model="fake", client=client, on_result=lambda i, c: calls.append((i, c)), **kwargs
+            )
+        finally:
+            await client.close()
+            await runner.cleanup()
+        return results, calls, app["stats"]
+
+    return asyncio.run(main())
+
+
+def test_labels_in_input_order():
+    # retried 500s finish the prompts out of order, `on_result` still sees them in input order
+    results, calls, stats = run_labelling({"error_rate_500": 0.3}, concurrency=4, base_delay=0.01)
+    assert results == EXPECTED
+    assert calls == list(enumerate(EXPECTED))
+    assert stats["errors_500"] > 0
+    assert stats["requests"] == len(PROMPTS) + stats["errors_500"]
+
+
+def test_retries_429_after_the_retry_after_header():
+    # the stand-in sends `retry-after: 0.05`: with a 30s backoff instead, this would take minutes
+    t0 = time.perf_counter()
+    results, _, stats = run_labelling({"error_rate_429": 0.5}, concurrency=4, base_delay=30.0)
+    assert results == EXPECTED
+    assert stats["errors_429"] > 0
+    assert time.perf_counter() - t0 < 10
+
+
+def test_gives_up_with_none_after_max_retries():
+    results, calls, stats = run_labelling({"error_rate_500": 1.0}, max_retries=2, base_delay=0.001)
+    assert results == [None] * len(PROMPTS)
+    assert calls == [(i, None) for i in range(len(PROMPTS))]
+    assert stats["requests"] == 3 * len(PROMPTS)
+
+
+def test_rate_limiter_paces_the_requests():
+    # 1200 requests per minute with room for a single request: 12 prompts take at least 11 / 20 s
+    limiter = RateLimiter()
+    limiter.requests = TokenBucket(1200, capacity=1)
+    t0 = time.perf_counter()
+    results, _, _ = run_labelling(concurrency=8, limiter=limiter)
+    assert results == EXPECTED
+    assert time.perf_counter() - t0 >= 0.5
+
+
+def test_token_bucket_refills_at_its_rate():
+    async def main():
+        bucket = TokenBucket(rate_per_min=6000, capacity=50)
+        t0 = time.perf_counter()
+        await bucket.acquire(50)  # a full bucket: no wait
+        burst = time.perf_counter() - t0
+        await bucket.acquire(5)  # 5 units at 100 per second
+        # bigger than the bucket: only waits for a full one
+        await bucket.acquire(500)
+        return burst, time.perf_counter() - t0
+
+    burst, elapsed = asyncio.run(main())
+    assert burst < 0.05
+    assert 0.54 <= elapsed < 1.5
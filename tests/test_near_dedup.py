@@ -0,0 +1,51 @@
+import itertools
+import random
+import tracemalloc
+
+import numpy as np
+
+from near_dedup import make_permutations, minhash_signatures, near_duplicate_keep_mask, shingle_hashes
+
+WORDS = [f"w{i}" for i in range(2000)]
+
+
+def random_texts(lengths, seed=0):
+    rng = random.Random(seed)
+    return [" ".join(rng.choices(WORDS, k=length)) for length in lengths]
+
+
+def reference_signatures(texts, num_perm=128, ngram=3, seed=1):
+    # the definition: the minimum of every permutation over the shingles of each prompt
+    a, b = make_permutations(num_perm, seed)
+    signatures = []
+    for text in texts:
+        hashes = np.array(shingle_hashes(text, ngram), dtype=np.uint64)
+        signatures.append((((hashes[:, None] * a[None, :] + b[None, :]) >> np.uint64(32)).astype(np.uint32)).min(axis=0))
+    return np.stack(signatures)
+
+
+def test_signatures_do_not_depend_on_the_block_size():
+    texts = random_texts(itertools.islice(itertools.cycle([0, 1, 3, 4, 60, 700, 2]), 70))
+    expected = reference_signatures(texts)
+    for block_shingles in [1, 5, 64, 1000, 16_384]:
+        np.testing.assert_array_equal(minhash_signatures(texts, block_shingles=block_shingles), expected)
+
+
+def test_memory_stays_flat_for_very_long_prompts():
+    # all shingles at once would be 16 * 20k * 128 * 8 bytes = 330 MB of uint64 products
+    texts = random_texts([20_000] * 16)
+    tracemalloc.start()
+    try:
+        minhash_signatures(texts, block_shingles=16_384)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert peak < 64 * 2**20
+
+
+def test_keeps_the_first_of_near_duplicates():
+    base = random_texts([200, 200], seed=1)
+    texts = [base[0], base[0] + " extra words", base[1], base[0].upper()]
+    keep, labels = near_duplicate_keep_mask(texts, threshold=0.8)
+    assert keep.tolist() == [True, False, True, False]
+    assert labels.tolist() == [0, 0, 2, 0]
@@ -0,0 +1,38 @@
+import os
+import signal
+
+import pytest
+
+from prefork_server import PreforkRouter
+
+
+@pytest.fixture
+def prefork(tiny_router):
+    model, tokenizer, id2label = tiny_router
+    router = PreforkRouter(model, tokenizer, id2label, num_workers=2, threads_per_worker=1, timeout=30)
+    yield router
+    router.close()
+
+
+def test_routes_through_the_workers(prefork):
+    results = prefork.route_batch(["hello", "how do I sort a list in python?"])
+    assert len(results) == 2
+    assert all(set(r) == {"ROUTE_TO_INFERIOR", "ROUTE_TO_SUPERIOR"} for r in results)
+
+
+def test_a_dead_worker_fails_its_requests_and_is_replaced(prefork):
+    prefork.route("warm up")
+    dead_pid = prefork.worker_pids()[0]
+    # stopped, the worker cannot pick up the request before it is killed
+    os.kill(dead_pid, signal.SIGSTOP)
+    future = prefork.submit(["hello"])
+    assert prefork.in_flight == [1, 0]
+    os.kill(dead_pid, signal.SIGKILL)
+
+    with pytest.raises(RuntimeError, match="worker 0 died"):
+        future.result(timeout=10)
+    assert prefork.restarts == 1
+    assert prefork.worker_pids()[0] != dead_pid
+    # both workers route again, the replacement included
+    for _ in range(4):
+        assert len(prefork.route_batch(["hello"])) == 1
@@ -0,0 +1,125 @@
+import asyncio
+import json
+
+import aiohttp
+from aiohttp import web
+
+from batching_server import MicroBatcher
+from fake_openai_server import make_app, start_server
+from routing_proxy import RoutingProxy, Upstream
+
+# `superior_threshold` pins the route: above 1 everything goes to the inferior upstream, at 0 to the superior one
+ALWAYS_INFERIOR, ALWAYS_SUPERIOR = 1.1, 0.0
+
+
+def run_with_proxy(tiny_router, check, superior_threshold=ALWAYS_INFERIOR, inferior_url=None, **kwargs):
+    # serves the proxy in front of two `fake_openai_server.py` stand-ins and runs `check(proxy_url, session)`
+    inferior_app_kwargs = kwargs.pop("inferior_app_kwargs", {})
+    inferior_max_concurrency = kwargs.pop("inferior_max_concurrency", 8)
+
+    async def main():
+        model, tokenizer, id2label = tiny_router
+        inferior_runner, stand_in_url = await start_server(make_app(**{"latency_ms": 0, **inferior_app_kwargs}))
+        superior_runner, superior_url = await start_server(make_app(latency_ms=0))
+        proxy = RoutingProxy(
+            MicroBatcher(model, tokenizer, id2label),
+            Upstream("inferior", inferior_url or stand_in_url, "small", max_concurrency=inferior_max_concurrency),
+            Upstream("superior", superior_url, "big"),
+            superior_threshold=superior_threshold,
+            **kwargs,
+        )
+        runner = web.AppRunner(proxy.make_app())
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        proxy_url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/v1"
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
+                return await check(proxy_url, session)
+        finally:
+            await runner.cleanup()
+            await inferior_runner.cleanup()
+            await superior_runner.cleanup()
+
+    return asyncio.run(main())
+
+
+def chat_body(text, stream=False):
+    return {"model": "router", "messages": [{"role": "user", "content": text}], "stream": stream}
+
+
+def sse_events(raw):
+    return [line[len("data: "):] for line in raw.decode("utf-8").split("\n\n") if line.startswith("data: ")]
+
+
+def test_forwards_to_the_routed_upstream(tiny_router):
+    async def check(proxy_url, session):
+        async with session.post(f"{proxy_url}/chat/completions", json=chat_body("hello")) as response:
+            return response.status, dict(response.headers), await response.json()
+
+    for threshold, upstream, model in [(ALWAYS_INFERIOR, "inferior", "small"), (ALWAYS_SUPERIOR, "superior", "big")]:
+        status, headers, completion = run_with_proxy(tiny_router, check, superior_threshold=threshold)
+        assert status == 200
+        assert headers["x-router-upstream"] == upstream
+        assert completion["model"] == model
+        assert completion["choices"][0]["message"]["content"] == "ROUTE_TO_INFERIOR"
+
+
+def test_streams_the_upstream_events(tiny_router):
+    async def check(proxy_url, session):
+        async with session.post(f"{proxy_url}/chat/completions", json=chat_body("hello", stream=True)) as response:
+            return response.status, response.headers["Content-Type"], await response.read()
+
+    status, content_type, raw = run_with_proxy(tiny_router, check)
+    assert status == 200
+    assert content_type.startswith("text/event-stream")
+    events = sse_events(raw)
+    assert events[-1] == "[DONE]"
+    content = "".join(json.loads(e)["choices"][0]["delta"].get("content", "") for e in events[:-1])
+    assert content == "ROUTE_TO_INFERIOR"
+
+
+def test_upstream_dropping_mid_stream_ends_the_stream_with_an_error(tiny_router):
+    async def check(proxy_url, session):
+        async with session.post(f"{proxy_url}/chat/completions", json=chat_body("hello", stream=True)) as response:
+            # the client times out (and the test fails) if the proxy leaves the stream open
+            return response.status, await response.read()
+
+    status, raw = run_with_proxy(tiny_router, check, inferior_app_kwargs={"stream_disconnect_after": 2})
+    assert status == 200
+    events = sse_events(raw)
+    assert json.loads(events[0])["object"] == "chat.completion.chunk"
+    assert json.loads(events[-1])["error"]["type"] == "upstream_error"
+
+
+def test_unreachable_upstream_is_a_502(tiny_router):
+    async def check(proxy_url, session):
+        async with session.post(f"{proxy_url}/chat/completions", json=chat_body("hello", stream=True)) as response:
+            return response.status, await response.json()
+
+    # nothing listens on port 9 (discard) locally
+    status, error = run_with_proxy(tiny_router, check, inferior_url="http://127.0.0.1:9/v1")
+    assert status == 502
+    assert error["error"]["type"] == "upstream_error"
+
+
+def test_spills_over_when_the_inferior_queue_is_slow(tiny_router):
+    async def check(proxy_url, session):
+        async def send():
+            async with session.post(f"{proxy_url}/chat/completions", json=chat_body("hello")) as response:
+                await response.read()
+                return response.headers["x-router-upstream"], response.headers["x-router-spillover"]
+
+        # one request first, so the proxy knows how long the inferior upstream takes, then a burst
+        first = await send()
+        return [first] + await asyncio.gather(*(send() for _ in range(8)))
+
+    results = run_with_proxy(
+        tiny_router,
+        check,
+        inferior_app_kwargs={"latency_ms": 200},
+        inferior_max_concurrency=1,
+        spillover_ms=20,
+    )
+    assert ("inferior", "0") in results
+    assert ("superior", "1") in results
@@ -0,0 +1,35 @@
+import numpy as np
+
+from benchmark_router import make_tiny_model
+from semantic_index import RouterEncoder, SemanticRouter, build_index
+
+TEXTS = ["how do I sort a list in python?", "write a poem about the sea", "what is 2 + 2?"]
+
+
+def test_router_as_encoder_keeps_its_own_routes(tiny_router, tmp_path):
+    model, tokenizer, id2label = tiny_router
+    encoder = RouterEncoder(model, tokenizer)
+    # the stored routes are the opposite of the router's: a reused route would show
+    index = build_index(str(tmp_path / "index"), encoder, TEXTS, probs=1 - encoder.encode(TEXTS)[1], num_lists=0)
+    router = SemanticRouter(index, encoder, model, tokenizer, id2label, insert_misses=False)
+    assert not router.reuse
+
+    _, fresh = encoder.encode(TEXTS)
+    results = router.route_batch(TEXTS)
+    assert all(sim is not None for _, sim in results)
+    np.testing.assert_allclose([[res[id2label[j]] for j in sorted(id2label)] for res, _ in results], fresh, atol=1e-6)
+    assert router.stats()["hits"] == len(TEXTS)
+
+
+def test_separate_encoder_reuses_the_neighbour_route(tiny_router, tmp_path):
+    model, tokenizer, id2label = tiny_router
+    encoder = RouterEncoder(make_tiny_model(len(tokenizer), num_layers=1, hidden_size=32, num_heads=2), tokenizer)
+    stored = np.array([[1.0, 0.0], [0.0, 1.0], [1.0, 0.0]], dtype=np.float32)
+    index = build_index(str(tmp_path / "index"), encoder, TEXTS, probs=stored, num_lists=0)
+    router = SemanticRouter(index, encoder, model, tokenizer, id2label, insert_misses=False)
+    assert router.reuse
+
+    results = router.route_batch(TEXTS + ["something else entirely, far from the indexed prompts"])
+    for (res, sim), probs in zip(results, stored):
+        assert sim is not None
+        assert [res[id2label[j]] for j in sorted(id2label)] == probs.tolist()